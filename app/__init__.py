@@ -4,20 +4,24 @@
 
 import os
 import sys
+import queue
+import atexit
+import sqlite3
 import logging
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 from os.path import dirname, join, realpath, isfile
-from codecarbon import EmissionsTracker
 from decouple import Config, RepositoryEnv
 from dotenv import load_dotenv
 
 # Import flask and template operators
-from flask import Flask, render_template, request, flash, abort, send_from_directory
+from flask import Flask, Response, render_template, request, flash, abort, send_from_directory
 from flask_admin import Admin, AdminIndexView
 
 # Import SQLAlchemy
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+from sqlalchemy import event
 
 # Root path
 dir_path = dirname(dirname(realpath(__file__)))
@@ -25,26 +29,10 @@ dir_path = dirname(dirname(realpath(__file__)))
 # Server host
 SERVER_HOST = "0.0.0.0:9090"
 
-# Initialise emission tracking
-CARBON_TRACKING = False
-CARBON_DIR = None
-tracker = None
-if CARBON_TRACKING:
-    CARBON_DIR = join(dir_path,'emission_tracking')
-    Path(CARBON_DIR).mkdir(exist_ok=True, parents=True)
-    tracker = EmissionsTracker(output_dir=CARBON_DIR, project_name="PeARS OMD emission tracking")
-
 # Make sure user data directories exist
-Path(join(dir_path, 'app', 'pods')).mkdir(parents=True, exist_ok=True)
 Path(join(dir_path, 'app', 'userdata')).mkdir(parents=True, exist_ok=True)
 
 
-def configure_logging():
-    # register root logging
-    logging.basicConfig(level=logging.ERROR)
-    logging.getLogger('werkzeug').setLevel(logging.ERROR)
-configure_logging()
-
 # Define the WSGI application object
 app = Flask(__name__)
 
@@ -57,6 +45,39 @@ except:
     sys.exit()
 
 
+def configure_logging():
+    """ Set the log level of the app, and of single modules, from
+    pears.ini, e.g. LOG_LEVELS=app.search=DEBUG,app.indexer=INFO.
+    With LOG_ASYNC, records are handed to a queue and written by a
+    background thread, so that requests do not wait on stdout.
+    """
+    root = logging.getLogger()
+    logging.basicConfig()
+    root.setLevel(os.getenv('LOG_LEVEL', 'WARNING').upper())
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    for item in os.getenv('LOG_LEVELS', '').split(','):
+        if '=' in item:
+            name, level = item.split('=', 1)
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+    if os.getenv('LOG_ASYNC', 'false').lower() == 'true':
+        handlers = root.handlers
+        queue_handler = QueueHandler(queue.SimpleQueue())
+        root.handlers = [queue_handler]
+        listeners = []
+
+        def start_listener():
+            # Forked processes inherit the queue handler, but not the
+            # thread that writes the queue out: each gets its own
+            queue_handler.queue = queue.SimpleQueue()
+            listeners[:] = [QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)]
+            listeners[0].start()
+
+        start_listener()
+        os.register_at_fork(after_in_child=start_listener)
+        atexit.register(lambda: listeners[0].stop())
+configure_logging()
+
+
 # Configurations
 try:
     AUTH_TOKEN = os.getenv('AUTH_TOKEN')
@@ -65,6 +86,31 @@ try:
     FILE_SIZE_LIMIT = int(os.getenv('FILE_SIZE_LIMIT'))
     GATEWAY_TIMEZONE = os.getenv('GATEWAY_TIMEZONE')
     LOCAL_MODE = True if os.getenv("LOCAL_MODE", "false").lower() == 'true' else False
+    INDEXING_WORKERS = int(os.getenv('INDEXING_WORKERS', 0))
+    SITES_CACHE_TTL = int(os.getenv('SITES_CACHE_TTL', 300))
+    TOKEN_CACHE_TTL = int(os.getenv('TOKEN_CACHE_TTL', 300))
+    GATEWAY_POOL_SIZE = int(os.getenv('GATEWAY_POOL_SIZE', 20))
+    GATEWAY_RETRIES = int(os.getenv('GATEWAY_RETRIES', 3))
+    # Megabytes of pod data a search may hold at once (0: no limit)
+    SEARCH_MEMORY_BUDGET = int(os.getenv('SEARCH_MEMORY_BUDGET', 0)) * 1024 * 1024
+
+    # Emission tracking: one operation in CARBON_SAMPLE_RATE is measured,
+    # and summaries are written every CARBON_REPORT_INTERVAL seconds
+    CARBON_TRACKING = True if os.getenv('CARBON_TRACKING', 'false').lower() == 'true' else False
+    CARBON_SAMPLE_RATE = int(os.getenv('CARBON_SAMPLE_RATE', 100))
+    CARBON_REPORT_INTERVAL = int(os.getenv('CARBON_REPORT_INTERVAL', 300))
+    CARBON_DIR = join(dir_path, 'emission_tracking')
+    if CARBON_TRACKING:
+        Path(CARBON_DIR).mkdir(exist_ok=True, parents=True)
+
+    # Database: SQLite by default, or any SQLAlchemy URL (e.g. PostgreSQL)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', app.config['SQLALCHEMY_DATABASE_URI'])
+    DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+    SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT', 30))
+    SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 268435456))
+    # Pod files (.npz and .pos), next to the database
+    POD_DIR = os.getenv('POD_DIR', join(dir_path, 'app', 'pods'))
+    Path(POD_DIR).mkdir(parents=True, exist_ok=True)
     LOGO_PATH = os.getenv('LOGO_PATH', '')
     if LOGO_PATH == '' or not isfile(join(LOGO_PATH, "logo.png")):
         LOGO_PATH = join(dir_path,'app', 'static','assets')
@@ -86,24 +132,44 @@ except:
     sys.exit()
 
 
-# Load pretrained models
-from app.readers import read_vocab
-from sklearn.feature_extraction.text import CountVectorizer
+# Pretrained models, loaded on first use
+from app.readers import load_vocab
+
+
+def vocab_path(lang):
+    return join(dir_path, f'app/api/models/{lang}/{lang}wiki.vocab')
 
-models = dict()
-for LANG in LANGS:
-    models[LANG] = {}
-    spm_vocab_path = join(dir_path, f'app/api/models/{LANG}/{LANG}wiki.vocab')
-    logging.info(f"Loading SPM vocab from '{spm_vocab_path}' ...")
-    vocab, inverted_vocab, logprobs = read_vocab(spm_vocab_path)
-    vectorizer = CountVectorizer(vocabulary=vocab, lowercase=True, token_pattern='[^ ]+')
-    models[LANG]['vocab'] = vocab
-    models[LANG]['inverted_vocab'] = inverted_vocab
-    models[LANG]['logprobs'] = logprobs
-    models[LANG]['vectorizer'] = vectorizer
+
+class LanguageModels(dict):
+    """ The vocab, vectorizer and tokenizer of each language, loaded
+    when a language is first looked up, so that workers and CLI
+    commands only pay for the languages they use.
+    """
+
+    def __missing__(self, lang):
+        if lang not in LANGS:
+            raise KeyError(lang)
+        import sentencepiece as spm
+        from sklearn.feature_extraction.text import CountVectorizer
+        logging.info(f"Loading SPM vocab from '{vocab_path(lang)}' ...")
+        vocab, inverted_vocab, logprobs = load_vocab(vocab_path(lang))
+        vectorizer = CountVectorizer(vocabulary=vocab, lowercase=True, token_pattern='[^ ]+')
+        tokenizer = spm.SentencePieceProcessor(model_file=join(dir_path, f'app/api/models/{lang}/{lang}wiki.model'))
+        self[lang] = {'vocab': vocab, 'inverted_vocab': inverted_vocab,
+                      'logprobs': logprobs, 'vectorizer': vectorizer, 'tokenizer': tokenizer}
+        return self[lang]
+
+    def preload(self):
+        """ Load every language, e.g. in a server process before
+        it forks its workers.
+        """
+        for lang in LANGS:
+            self[lang]
+
+models = LanguageModels()
 
 # All vocabs have the same vector size
-VEC_SIZE = len(models[LANGS[0]]['vocab'])
+VEC_SIZE = len(load_vocab(vocab_path(LANGS[0]))[0])
 
 
 # Load .pearsignore
@@ -113,10 +179,32 @@ logging.info("IGNORED EXTENSIONS: "+' '.join(IGNORED_EXTENSIONS))
 
 # Define the database object which is imported
 # by modules and controllers
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': DB_POOL_SIZE, 'connect_args': {'timeout': SQLITE_BUSY_TIMEOUT}}
+else:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': DB_POOL_SIZE, 'pool_pre_ping': True}
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 
 
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """ Tune each new SQLite connection. In WAL mode, searches
+    keep reading while a crawl commits, and writers wait for the
+    lock instead of failing with 'database is locked'.
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT * 1000}")
+    cursor.close()
+
+with app.app_context():
+    event.listen(db.engine, 'connect', set_sqlite_pragmas)
+
+
 # Import a module / component using its blueprint handler variable (mod_auth)
 from app.auth.controllers import auth as auth_module
 from app.indexer.controllers import indexer as indexer_module
@@ -151,7 +239,7 @@ from flask_admin.contrib.sqla.view import ModelView
 from flask_admin.model.template import EndpointLinkRowAction
 
 from app.auth.controllers import login_required
-import requests
+from app.auth.tokens import validate_token
 
 # Flask and Flask-SQLAlchemy initialization here
 
@@ -161,17 +249,13 @@ def can_access_flaskadmin():
         access_token = request.cookies.get('OMD_SESSION_ID')  
     if not access_token:
         return abort(404)
-    url = join(OMD_PATH, 'signin/')
-    data = {'action': 'getUserInfo', 'session_id': access_token}
-    resp = requests.post(url, json=data, timeout=30 if LOCAL_MODE else None, headers={'accept':'application/json', 'Authorization': 'token:'+access_token})
-    if resp.json()['valid']:
+    username, is_admin = validate_token(access_token)
+    if username is not None:
         # for local mode
         if LOCAL_MODE:
-            if resp.status_code < 400:
-                return True # This does the trick rendering the view only if the user is signed in
+            return True # This does the trick rendering the view only if the user is signed in
         # for non-local mode
         else: 
-            is_admin = resp.json().get('isAdmin')
             if is_admin:
                 return is_admin # This does the trick rendering the view only if the user is admin
             else:
@@ -352,4 +436,12 @@ def serve_logos(path):
     return send_from_directory(LOGO_PATH, path)
 
 
+from app.metrics import metrics_response
+
+@app.route('/metrics')
+def metrics():
+    body, content_type = metrics_response()
+    return Response(body, content_type=content_type)
+
+
 
@@ -3,18 +3,40 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 
 
+import logging
 from os.path import dirname, join, realpath, basename
 from flask import Blueprint, jsonify, request, session, flash, render_template
-from app.utils_db import delete_url, delete_pod
+from app.utils_db import delete_url, delete_pod, get_index_stats
+from app.gateway import gateway
 from app.api.models import Urls, Pods
-from app import db, OMD_PATH, AUTH_TOKEN
+from app import db, OMD_PATH, AUTH_TOKEN, POD_DIR
 from app.auth.controllers import login_required
 
 # Define the blueprint:
 api = Blueprint('api', __name__, url_prefix='/api')
 
 dir_path = dirname(dirname(realpath(__file__)))
-pod_dir = join(dir_path,'pods')
+pod_dir = POD_DIR
+
+LOG = logging.getLogger(__name__)
+
+
+@api.route('/stats', methods=["GET"])
+@login_required
+def api_stats():
+    """ JSON statistics on the index: number of documents and
+    bytes on disk, per permission class and for the user's pods.
+    """
+    return jsonify(get_index_stats(session.get('username')))
+
+
+@api.route('/stats/gateway', methods=["GET"])
+@login_required
+def api_gateway_stats():
+    """ JSON statistics on the requests this process made to
+    the gateway: calls, errors and latency per host and method.
+    """
+    return jsonify(gateway.get_stats())
 
 
 @api.route('/urls/delete', methods=["GET"])
@@ -22,7 +44,7 @@ pod_dir = join(dir_path,'pods')
 def api_delete():
     path = request.args.get('path')
     success, message = return_url_delete(path)
-    print(success, message)
+    LOG.debug("api_delete: %s %s", success, message)
     return render_template('search/user.html', welcome = message)
 
 
@@ -37,14 +59,12 @@ def return_url_delete(path):
         message = "URL not found in the database"
         return False, message
     access_token = request.headers.get('Token') #Get token from request header
-    print(">> return_url_delete: access_token: OMD_SESSION_ID", access_token)
     if access_token:
         if access_token == AUTH_TOKEN: #if it equals to system-wide security token, then it is call from OMD backend
             delete_url(u.url)
             message = "Deleted document with url "+u.url+'.'
             return True, message
     try:
-        print(session['username'], pod.owner.split(','))
         assert session['username'] in pod.owner.split(',') or path.startswith(join(OMD_PATH,'shared/')) or path.startswith(join(OMD_PATH,'sites/'))
     except AssertionError as err:
         message = "You cannot delete other users' documents."
@@ -62,14 +82,12 @@ def return_pod_delete(path):
         message = "URL not found in the database"
         return False, message
     access_token = request.headers.get('Token') #Get token from request header
-    print(">> return_url_delete: access_token: OMD_SESSION_ID", access_token)
     if access_token:
         if access_token == AUTH_TOKEN: #if it equals to system-wide security token, then it is call from OMD backend
             delete_pod(p.url)
             message = "Deleted pod with path "+p.url+'.'
             return True, message
     try:
-        print(session['username'], p.owner.split(','))
         assert session['username'] in p.owner.split(',')
     except AssertionError as err:
         message = "You cannot delete other users' pods."
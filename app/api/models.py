@@ -5,11 +5,8 @@
 from os.path import isdir, exists, join, dirname, realpath
 from glob import glob
 from datetime import datetime
-import sentencepiece as spm
 from app import db, GATEWAY_TIMEZONE
 
-sp = spm.SentencePieceProcessor()
-
 dir_path = dirname(dirname(realpath(__file__)))
 
 def get_installed_languages():
@@ -38,13 +35,19 @@ class Base(db.Model):
 
 
 class Urls(Base):
+    __table_args__ = (db.Index('ix_urls_pod_id_vector', 'pod_id', 'vector'),)
+
     id = db.Column(db.Integer, primary_key=True)
-    url = db.Column(db.String(1000))
+    url = db.Column(db.String(1000), index=True)
     title = db.Column(db.String(1000))
     vector = db.Column(db.Integer)
     snippet = db.Column(db.String(1000))
+    # Pod path, kept alongside pod_id since it locates the pod files
     pod = db.Column(db.String(1000))
+    pod_id = db.Column(db.Integer, db.ForeignKey('pods.id'))
     description = db.Column(db.String(1000))
+    # Whether the doc was cut at FILE_SIZE_LIMIT before indexing
+    truncated = db.Column(db.Boolean, default=False)
 
     def __init__(self,
                  url=None,
@@ -52,13 +55,17 @@ class Urls(Base):
                  vector=None,
                  snippet=None,
                  pod=None,
-                 description=None):
+                 pod_id=None,
+                 description=None,
+                 truncated=False):
         self.url = url
         self.title = title
         self.vector = vector
         self.snippet = snippet
         self.pod = pod
+        self.pod_id = pod_id
         self.description = description
+        self.truncated = truncated
 
     def __repr__(self):
         return self.url
@@ -72,6 +79,7 @@ class Urls(Base):
             'vector': self.vector,
             'snippet': self.snippet,
             'pod': self.pod,
+            'pod_id': self.pod_id,
             'notes': self.description
         }
 
@@ -80,24 +88,43 @@ class Urls(Base):
 
 
 class Pods(Base):
+    """A pod's url is its path, owner_hash/device/language/permission_class.
+    The components are also stored in their own columns, with name
+    holding the owner hash.
+    """
+    __table_args__ = (db.Index('ix_pods_language_permission_class', 'language', 'permission_class'),)
+
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(1000))
-    url = db.Column(db.String(1000))
+    name = db.Column(db.String(1000), index=True)
+    url = db.Column(db.String(1000), index=True)
     description = db.Column(db.String(7000))
     language = db.Column(db.String(1000))
     owner = db.Column(db.String(2000))
+    device = db.Column(db.String(1000))
+    permission_class = db.Column(db.String(20))  # user, group, others or sites
+    # Statistics, maintained by the indexer and deleter
+    num_urls = db.Column(db.Integer, default=0)
+    num_bytes = db.Column(db.BigInteger, default=0)
+    num_postings_bytes = db.Column(db.BigInteger, default=0)  # size of the unpickled postings
 
     def __init__(self,
                  name=None,
                  url=None,
                  description=None,
                  language=None,
-                 owner=None):
+                 owner=None,
+                 device=None,
+                 permission_class=None):
         self.name = name
         self.url = url
         self.description = description
         self.language = language
         self.owner = owner
+        self.device = device
+        self.permission_class = permission_class
+        self.num_urls = 0
+        self.num_bytes = 0
+        self.num_postings_bytes = 0
 
     @property
     def serialize(self):
@@ -106,7 +133,12 @@ class Pods(Base):
             'url': self.url,
             'description': self.description,
             'language': self.language,
-            'owner': self.owner
+            'owner': self.owner,
+            'device': self.device,
+            'permission_class': self.permission_class,
+            'num_urls': self.num_urls,
+            'num_bytes': self.num_bytes,
+            'num_postings_bytes': self.num_postings_bytes
         }
 
     def as_dict(self):
@@ -115,9 +147,16 @@ class Pods(Base):
 
 class Locations(Base):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(1000))
+    name = db.Column(db.String(1000), index=True)
     device = db.Column(db.Boolean)
     subscribed = db.Column(db.Boolean)
+    # Fingerprint of the last crawled listing, and HTTP validators sent by the gateway
+    fingerprint = db.Column(db.String(64))
+    etag = db.Column(db.String(200))
+    last_modified = db.Column(db.String(100))
+    # Subfolders seen in the last crawled listing, as a JSON list, to be
+    # crawled even when the gateway answers that the listing is unchanged
+    subfolders = db.Column(db.Text)
 
     def __init__(self, name=None, device=False, subscribed=False):
         self.name = name
@@ -129,7 +168,8 @@ class Locations(Base):
             return {
                 'name': self.name,
                 'device': self.device,
-                'subscribed': self.subscribed
+                'subscribed': self.subscribed,
+                'fingerprint': self.fingerprint
                 }
 
     def as_dict(self):
@@ -190,3 +230,95 @@ class Sites(Base):
     def as_dict(self):
        return {c.name: str(getattr(self, c.name)) for c in self.__table__.columns}
 
+
+
+class Jobs(Base):
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(200))
+    kind = db.Column(db.String(20))  # crawl, delete or cleanup
+    status = db.Column(db.String(20))  # queued, running, done or failed
+    priority = db.Column(db.Integer)  # lower runs first
+    worker = db.Column(db.String(100))
+    heartbeat = db.Column(db.DateTime)  # last sign of life of the worker
+    force = db.Column(db.Boolean)
+    current = db.Column(db.String(1000))
+    num_folders = db.Column(db.Integer)
+    num_docs = db.Column(db.Integer)
+    num_indexed = db.Column(db.Integer)
+    message = db.Column(db.String(1000))
+
+    def __init__(self, username=None, kind='crawl', status='queued', priority=0, force=False):
+        self.username = username
+        self.kind = kind
+        self.status = status
+        self.priority = priority
+        self.worker = None
+        self.heartbeat = None
+        self.force = force
+        self.current = ""
+        self.num_folders = 0
+        self.num_docs = 0
+        self.num_indexed = 0
+        self.message = ""
+
+    @property
+    def serialize(self):
+            return {
+                'id': self.id,
+                'username': self.username,
+                'kind': self.kind,
+                'status': self.status,
+                'priority': self.priority,
+                'worker': self.worker,
+                'current': self.current,
+                'num_folders': self.num_folders,
+                'num_docs': self.num_docs,
+                'num_indexed': self.num_indexed,
+                'message': self.message
+                }
+
+    def as_dict(self):
+       return {c.name: str(getattr(self, c.name)) for c in self.__table__.columns}
+
+
+class FrontierLinks(Base):
+    """Folders to crawl for a job. A link is done once all
+    its docs have been processed (checkpoint). For delete
+    jobs, the url prefixes to remove from the index.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('jobs.id'), index=True)
+    url = db.Column(db.String(1000))
+    done = db.Column(db.Boolean)
+
+    def __init__(self, job_id=None, url=None, done=False):
+        self.job_id = job_id
+        self.url = url
+        self.done = done
+
+    @property
+    def serialize(self):
+            return {
+                'job_id': self.job_id,
+                'url': self.url,
+                'done': self.done
+                }
+
+    def as_dict(self):
+       return {c.name: str(getattr(self, c.name)) for c in self.__table__.columns}
+
+
+class RevokedTokens(Base):
+    """Session tokens logged out of, kept until no process
+    can still hold them in its token cache.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    token_hash = db.Column(db.String(64), index=True)
+    expires = db.Column(db.DateTime, index=True)
+
+    def __init__(self, token_hash=None, expires=None):
+        self.token_hash = token_hash
+        self.expires = expires
+
+    def as_dict(self):
+       return {c.name: str(getattr(self, c.name)) for c in self.__table__.columns}
@@ -2,6 +2,7 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-only
 
+import logging
 from os.path import join
 from inspect import getfullargspec
 from functools import wraps
@@ -10,10 +11,14 @@ from flask import Blueprint, request, render_template, make_response, session, f
 from flask_cors import cross_origin
 from app.forms import LoginForm, SearchForm
 from app import AUTH_TOKEN, OMD_PATH
+from app.gateway import gateway
+from app.auth.tokens import token_cache, validate_token, revoke_token
 
 # Define the blueprint:
 auth = Blueprint('auth', __name__, url_prefix='/auth')
 
+LOG = logging.getLogger(__name__)
+
 
 @auth.route('/login', methods=['GET', 'POST'])
 def login():
@@ -27,7 +32,7 @@ def login():
         # send authorization message to on my disk
         url = join(OMD_PATH, 'signin/')
         data = {'action': 'signin', 'username': username, 'password': password, 'remember': True}
-        user_info = requests.post(url, timeout=30, json=data)
+        user_info = gateway.post(url, timeout=30, json=data)
         if user_info is None:
             flash("Incorrect credentials")
             return render_template( 'auth/login.html', form=form), 401
@@ -45,6 +50,7 @@ def login():
         session['username'] = username
         session['token'] = session_token
         session['admin'] = is_admin
+        token_cache.set(session_token, username, is_admin)
         # Create a new response object
         searchform = SearchForm()
         resp_frontend = make_response(render_template( 'search/user.html', welcome="Welcome "+username, searchform=searchform))
@@ -63,13 +69,14 @@ def login():
 @auth.route('/logout', methods=['GET','POST'])
 def logout():
     access_token = request.cookies.get('OMD_SESSION_ID')
+    revoke_token(access_token)
     url = join(OMD_PATH, 'signout/')
     data = {'action': 'signout', 'session_id': access_token}
-    logout_confirmation = requests.post(url, json=data, headers={'accept':'application/json', 'Authorization': 'token:'+access_token})
+    logout_confirmation = gateway.post(url, json=data, token=access_token, headers={'accept':'application/json'})
     if logout_confirmation.status_code < 400:
-        print("Logging out")
+        LOG.debug("Logging out")
     else:
-        print("Logged out")
+        LOG.debug("Logged out")
     # Create a new response object
     #session['logged_in'] = False
     #session.pop('username', None)
@@ -85,8 +92,6 @@ def logout():
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        url = join(OMD_PATH, 'signin/')
-        
         access_token = request.headers.get('Token') #Get token from request header
         #print(">> login_required: access_token from header: OMD_SESSION_ID", access_token)
 
@@ -110,8 +115,7 @@ def login_required(f):
             #session['logged_in'] = False
             #session['token'] = ''
             session.clear()
-            print(">> AUTH: no token found. Clearing session and OMD_SESSION_ID cookie.")
-            print(f">> SESSION: {session}")
+            LOG.debug("AUTH: no token found. Clearing session and OMD_SESSION_ID cookie.")
             searchform = SearchForm()
             resp_frontend = make_response(render_template( 'search/anonymous.html', searchform=searchform), 401)
             resp_frontend.set_cookie('OMD_SESSION_ID', '', expires=0, samesite='Lax')
@@ -124,20 +128,17 @@ def login_required(f):
             if 'access_token' in getfullargspec(f).args:
                 kwargs['access_token'] = access_token
             return f(*args, **kwargs)
-        #Token is present but we need to check if OMD session is valid
-        data = {'action': 'getUserInfo', 'session_id': access_token}
-        #print(f">>AUTH DECORATOR: sending request for user info with access token: {access_token}")
-        resp = requests.post(url, json=data, timeout=30, headers={'accept':'application/json', 'Authorization': 'token:'+access_token})
-        if resp.status_code < 400 and resp.json()['valid']:
+        #Token is present but we need to check if OMD session is valid (cached)
+        username, _ = validate_token(access_token)
+        if username is not None:
             session['logged_in'] = True
-            session['username'] = resp.json()['user']
+            session['username'] = username
             session['token'] = access_token #save token	in session
             if 'access_token' in getfullargspec(f).args:
                 kwargs['access_token'] = access_token
             return f(*args, **kwargs)
         session.clear()
-        print(">> AUTH DECORATOR: OMD session is not valid. Clearing session and OMD_SESSION_ID cookie.")
-        print(f">> SESSION: {session}")
+        LOG.debug("AUTH DECORATOR: OMD session is not valid. Clearing session and OMD_SESSION_ID cookie.")
         searchform = SearchForm()
         resp_frontend = make_response(render_template( 'search/anonymous.html', searchform=searchform), 401)
         resp_frontend.set_cookie('OMD_SESSION_ID', '', expires=0, samesite='Lax')
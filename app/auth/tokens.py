@@ -0,0 +1,127 @@
+# SPDX-FileCopyrightText: 2025 PeARS Project, <pears@possible-worlds.eu>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import logging
+import threading
+from time import time
+from hashlib import sha256
+from datetime import datetime, timedelta
+from os.path import join
+from collections import OrderedDict
+import requests
+from app import db, OMD_PATH, TOKEN_CACHE_TTL
+from app.api.models import RevokedTokens
+from app.gateway import gateway
+from app.metrics import record_cache, CACHE_ENTRIES
+
+LOG = logging.getLogger(__name__)
+
+# Invalid tokens are remembered for a shorter time
+NEGATIVE_TTL = 30
+# Seconds the gateway gets to validate a token
+AUTH_TIMEOUT = 5
+
+
+class TokenCache:
+    """ Bounded, thread-safe cache of session tokens validated by
+    the gateway. Each token maps to (username, is_admin), or to
+    (None, False) for tokens the gateway rejected.
+    """
+
+    def __init__(self, max_tokens=1000, ttl=300, negative_ttl=NEGATIVE_TTL):
+        self.max_tokens = max_tokens
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.tokens = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, token):
+        """ Returns: the cached (username, is_admin), or None
+        if the token is unknown or its entry has expired.
+        """
+        with self.lock:
+            entry = self.tokens.get(token)
+            if entry is None:
+                return None
+            expiry, user_info = entry
+            if expiry < time():
+                del self.tokens[token]
+                return None
+            self.tokens.move_to_end(token)
+            return user_info
+
+    def set(self, token, username, is_admin=False):
+        ttl = self.ttl if username is not None else self.negative_ttl
+        with self.lock:
+            self.tokens[token] = (time() + ttl, (username, bool(is_admin)))
+            self.tokens.move_to_end(token)
+            while len(self.tokens) > self.max_tokens:
+                self.tokens.popitem(last=False)
+            CACHE_ENTRIES.labels('tokens').set(len(self.tokens))
+
+    def invalidate(self, token):
+        with self.lock:
+            self.tokens.pop(token, None)
+
+
+token_cache = TokenCache(ttl=TOKEN_CACHE_TTL)
+
+
+def hash_token(access_token):
+    return sha256(access_token.encode('utf-8')).hexdigest()
+
+
+def revoke_token(access_token):
+    """ Forget a token on logout. Other processes may hold it in
+    their own cache, so the revocation is also recorded in the
+    database for as long as their entries can live.
+    """
+    token_cache.invalidate(access_token)
+    if not access_token:
+        return
+    now = datetime.utcnow()
+    db.session.query(RevokedTokens).filter(RevokedTokens.expires < now).delete(synchronize_session=False)
+    db.session.add(RevokedTokens(token_hash=hash_token(access_token), expires=now + timedelta(seconds=token_cache.ttl)))
+    db.session.commit()
+
+
+def is_revoked(access_token):
+    return db.session.query(RevokedTokens.id).filter_by(token_hash=hash_token(access_token)) \
+            .filter(RevokedTokens.expires >= datetime.utcnow()).first() is not None
+
+
+def validate_token(access_token):
+    """ Ask the gateway who a session token belongs to,
+    unless the answer is already cached. Tokens the gateway
+    rejects are cached for a short time. Gateway failures are
+    not cached, so that the next request tries again.
+    Returns: (username, is_admin), with username None if the
+    token is not valid.
+    """
+    user_info = token_cache.get(access_token)
+    if user_info is not None and user_info[0] is not None and is_revoked(access_token):
+        # Logged out through another process
+        token_cache.set(access_token, None)
+        user_info = (None, False)
+    record_cache('tokens', user_info is not None)
+    if user_info is not None:
+        return user_info
+    url = join(OMD_PATH, 'signin/')
+    data = {'action': 'getUserInfo', 'session_id': access_token}
+    try:
+        resp = gateway.post(url, json=data, timeout=AUTH_TIMEOUT, token=access_token, headers={'accept':'application/json'})
+        if resp.status_code >= 500:
+            return None, False
+        if resp.status_code >= 400:
+            token_cache.set(access_token, None)
+            return None, False
+        info = resp.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        LOG.error("AUTH: could not validate token with gateway: %r", e)
+        return None, False
+    if not info.get('valid'):
+        token_cache.set(access_token, None)
+        return None, False
+    token_cache.set(access_token, info.get('user'), info.get('isAdmin'))
+    return info.get('user'), bool(info.get('isAdmin'))
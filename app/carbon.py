@@ -0,0 +1,148 @@
+# SPDX-FileCopyrightText: 2025 PeARS Project, <pears@possible-worlds.eu>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+""" Sampled energy and carbon tracking. Only one operation in
+CARBON_SAMPLE_RATE is measured with codecarbon, the others are just
+counted. Measurements are added up per type of operation, and a
+summary is appended to CARBON_DIR by a background thread every
+CARBON_REPORT_INTERVAL seconds, so that requests never wait on a file.
+"""
+
+import os
+import json
+import atexit
+import logging
+import threading
+from time import time, sleep
+from datetime import datetime
+from os.path import join
+from contextlib import contextmanager
+from app import CARBON_TRACKING, CARBON_DIR, CARBON_SAMPLE_RATE, CARBON_REPORT_INTERVAL
+
+LOG = logging.getLogger(__name__)
+
+# Fields of the codecarbon measurements that are added up
+MEASURED = ['duration', 'energy_consumed', 'emissions']
+
+
+class CarbonSampler:
+    """ Measures a sample of the operations run by this process,
+    and writes a summary of each type of operation per time window.
+    """
+
+    def __init__(self, output_dir, sample_rate=100, report_interval=300):
+        self.output_dir = output_dir
+        self.sample_rate = max(sample_rate, 1)
+        self.report_interval = report_interval
+        self.lock = threading.Lock()
+        # codecarbon measures one task at a time
+        self.measuring = threading.Lock()
+        self.stats = {}
+        self.window_start = time()
+        self.pid = None
+        self.tracker = None
+        atexit.register(self.flush)
+
+    def make_tracker(self):
+        from codecarbon import EmissionsTracker
+        return EmissionsTracker(output_dir=self.output_dir, save_to_file=False,
+                project_name="PeARS OMD emission tracking", log_level='error')
+
+    def get_tracker(self):
+        # The tracker and the writer thread do not survive a fork
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.tracker = self.make_tracker()
+                    self.stats = {}
+                    self.window_start = time()
+                    self.pid = os.getpid()
+                    threading.Thread(target=self.write_loop, daemon=True).start()
+        return self.tracker
+
+    def count(self, operation):
+        """ Count an operation.
+        Returns: whether it should be measured.
+        """
+        with self.lock:
+            s = self.stats.setdefault(operation, dict(calls=0, sampled=0, **{m: 0.0 for m in MEASURED}))
+            s['calls'] += 1
+            return (s['calls'] - 1) % self.sample_rate == 0
+
+    def record(self, operation, emissions_data):
+        with self.lock:
+            s = self.stats.setdefault(operation, dict(calls=1, sampled=0, **{m: 0.0 for m in MEASURED}))
+            s['sampled'] += 1
+            for m in MEASURED:
+                s[m] += getattr(emissions_data, m) or 0.0
+
+    @contextmanager
+    def task(self, operation):
+        tracker = self.get_tracker()
+        if not self.count(operation) or not self.measuring.acquire(blocking=False):
+            yield
+            return
+        try:
+            tracker.start_task(operation)
+            task_name = getattr(tracker, '_active_task', operation)
+            try:
+                yield
+            finally:
+                self.record(operation, tracker.stop_task())
+                # The tracker keeps every finished task otherwise
+                getattr(tracker, '_tasks', {}).pop(task_name, None)
+        finally:
+            self.measuring.release()
+
+    def summary(self):
+        """ Take the stats of the current window and start a new one.
+        Returns: one summary per type of operation, where the energy
+        and emissions of all calls are estimated from the sampled ones.
+        """
+        with self.lock:
+            stats, self.stats = self.stats, {}
+            start, self.window_start = self.window_start, time()
+        lines = []
+        for operation, s in stats.items():
+            line = {'operation': operation, 'pid': os.getpid(),
+                    'start': datetime.fromtimestamp(start).isoformat(timespec='seconds'),
+                    'end': datetime.now().isoformat(timespec='seconds')}
+            line.update(s)
+            if s['sampled'] > 0:
+                line['estimated_energy_kwh'] = s['energy_consumed'] / s['sampled'] * s['calls']
+                line['estimated_emissions_kg'] = s['emissions'] / s['sampled'] * s['calls']
+            lines.append(line)
+        return lines
+
+    def flush(self):
+        lines = self.summary()
+        if not lines:
+            return
+        filename = 'carbon.' + datetime.today().strftime('%Y-%m-%d') + '.jsonl'
+        try:
+            with open(join(self.output_dir, filename), 'a', encoding='utf-8') as f:
+                for line in lines:
+                    f.write(json.dumps(line) + '\n')
+        except OSError as e:
+            LOG.warning("Could not write carbon report: %s", e)
+
+    def write_loop(self):
+        while True:
+            sleep(self.report_interval)
+            self.flush()
+
+
+carbon = CarbonSampler(CARBON_DIR, CARBON_SAMPLE_RATE, CARBON_REPORT_INTERVAL) if CARBON_TRACKING else None
+
+
+@contextmanager
+def carbon_task(operation):
+    """ Track an operation, or a function when used as a
+    decorator, if carbon tracking is on.
+    """
+    if carbon is None:
+        yield
+        return
+    with carbon.task(operation):
+        yield
@@ -0,0 +1,227 @@
+# SPDX-FileCopyrightText: 2025 PeARS Project, <pears@possible-worlds.eu>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import os
+import sys
+import json
+import random
+import logging
+import resource
+import tempfile
+import subprocess
+from shutil import rmtree
+from time import perf_counter
+from datetime import datetime
+from os.path import join, dirname, realpath
+import numpy as np
+from flask import session
+from prometheus_client import REGISTRY
+from app import app, db, models, OMD_PATH
+from app.api.models import Groups, Pods
+from app.utils import hash_username, mk_group_name
+from app.utils_db import create_pod, delete_pod, update_pod_bytes
+from app.indexer.crawler import run_indexing
+from app.search.score_pages import run_search
+from app.tracing import trace
+
+LOG = logging.getLogger(__name__)
+
+dir_path = dirname(dirname(dirname(realpath(__file__))))
+
+# Synthetic docs belong to this user, and to a group with a friend
+BENCH_USER = 'pearsbench'
+BENCH_FRIEND = 'pearsbench-friend'
+PERMISSION_CLASSES = ['user', 'group', 'shared', 'sites']
+# Stages reported separately, as named in the search trace
+SEARCH_STAGES = ['get_language', 'compute_query_vectors', 'score_pods', 'compute_scores', 'posix', 'hydrate']
+
+
+def bench_words(lang, num_words=5000):
+    ''' Whole words from the vocabulary of a language, most
+    frequent first, to write synthetic docs and queries with.'''
+    words = []
+    for piece in models[lang]['vocab']:
+        word = piece.lstrip('▁')
+        if piece.startswith('▁') and len(word) > 3 and word.isalpha():
+            words.append(word)
+        if len(words) == num_words:
+            break
+    return words
+
+
+def synthetic_text(rng, words, weights, length):
+    return ' '.join(rng.choices(words, weights=weights, k=length))
+
+
+def doc_location(permission_class, pod, doc):
+    ''' Returns: the url and owner of a synthetic doc.'''
+    if permission_class == 'user':
+        return join(OMD_PATH, BENCH_USER, f'bench{pod}', f'doc{doc}.txt'), BENCH_USER
+    if permission_class == 'group':
+        return join(OMD_PATH, BENCH_USER, f'benchgroup{pod}', f'doc{doc}.txt'), mk_group_name(BENCH_USER, BENCH_FRIEND)
+    if permission_class == 'shared':
+        return join(OMD_PATH, 'shared', BENCH_USER, f'bench{pod}', f'doc{doc}.txt'), BENCH_USER
+    return join(OMD_PATH, 'sites', f'pearsbench{pod}', f'doc{doc}.html'), BENCH_USER
+
+
+def generate_pods(lang, mix=PERMISSION_CLASSES, num_pods=1, num_docs=50, doc_length=300, seed=0):
+    ''' Index synthetic docs with the real vectorizer and pod writers.
+    Each permission class in the mix gets num_pods pods of num_docs
+    docs, whose words follow a Zipf distribution over the vocabulary.
+    Returns: the paths of the pods.
+    '''
+    rng = random.Random(seed)
+    words = bench_words(lang)
+    weights = [1 / (rank + 1) for rank in range(len(words))]
+    group = mk_group_name(BENCH_USER, BENCH_FRIEND)
+    if 'group' in mix and not Groups.query.filter_by(name=group).first():
+        db.session.add(Groups(name=group, identifier=hash_username(group), subscribed=True))
+        db.session.commit()
+    pod_paths = []
+    for permission_class in mix:
+        for p in range(num_pods):
+            for d in range(num_docs):
+                url, owner = doc_location(permission_class, p, d)
+                device = url.split('/')[-2]
+                pod_path = create_pod(url, owner, lang, device)
+                body = synthetic_text(rng, words, weights, doc_length)
+                title = ' '.join(body.split()[:5])
+                snippet = ' '.join(body.split()[:50])
+                run_indexing(url, pod_path, title, snippet, '', lang, body)
+            if pod_path not in pod_paths:
+                pod_paths.append(pod_path)
+    for pod_path in pod_paths:
+        update_pod_bytes(pod_path)
+    db.session.commit()
+    return pod_paths
+
+
+def remove_pods():
+    ''' Remove every pod of the bench user and group, including
+    those of a run that failed before returning its pods.'''
+    group = mk_group_name(BENCH_USER, BENCH_FRIEND)
+    owners = [hash_username(BENCH_USER), hash_username(group)]
+    for (pod_path,) in db.session.query(Pods.url).filter(Pods.name.in_(owners)).all():
+        delete_pod(pod_path)
+    Groups.query.filter_by(name=group).delete()
+    db.session.commit()
+
+
+def make_queries(lang, num_queries=100, seed=0):
+    ''' One to three word queries, drawn from mid-frequency words
+    so that they match some but not all of the synthetic docs.'''
+    rng = random.Random(seed + 1)
+    words = bench_words(lang)[100:2000]
+    return [' '.join(rng.sample(words, rng.randint(1, 3))) for _ in range(num_queries)]
+
+
+def span_times(span, times):
+    ''' Sum the milliseconds spent in each named stage of a trace.'''
+    times[span.name] = times.get(span.name, 0.0) + span.seconds * 1000
+    for child in span.children:
+        span_times(child, times)
+    return times
+
+
+def pod_bytes_read():
+    return {stage: REGISTRY.get_sample_value('pears_pod_load_bytes_total', {'stage': stage}) or 0
+            for stage in ['score_pods', 'score_docs']}
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    return {'p50': float(np.percentile(values, 50)), 'p95': float(np.percentile(values, 95)),
+            'p99': float(np.percentile(values, 99)), 'mean': float(np.mean(values))}
+
+
+def bench_prefixes():
+    ''' Returns: the url prefixes of the synthetic docs, so that
+    searches never return docs of the real index.'''
+    return [join(OMD_PATH, BENCH_USER, ''), join(OMD_PATH, 'shared', BENCH_USER, ''), join(OMD_PATH, 'sites', 'pearsbench')]
+
+
+def replay_queries(queries, lang, username=BENCH_USER):
+    ''' Run each query as the given user and time it.
+    Returns: the latency of each query in milliseconds, and
+    the time spent in each search stage, per query.
+    '''
+    latencies = []
+    stages = {stage: [] for stage in SEARCH_STAGES}
+    with app.test_request_context():
+        session['username'] = username
+        for query in queries:
+            with trace('search') as root:
+                run_search(query+' -'+lang, url_filter=bench_prefixes())
+            latencies.append(root.seconds * 1000)
+            times = span_times(root, {})
+            for stage in SEARCH_STAGES:
+                stages[stage].append(times.get(stage, 0.0))
+    return latencies, stages
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=dir_path,
+                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_search(lang, mix=PERMISSION_CLASSES, num_pods=1, num_docs=50, doc_length=300,
+        num_queries=100, seed=0, keep=False):
+    ''' Build a synthetic index, replay a query set on it and
+    report latency percentiles, throughput, peak memory and the
+    bytes of pods read per stage.
+    Returns: the report, as a dictionary.
+    '''
+    queries = make_queries(lang, num_queries, seed)
+    try:
+        start = perf_counter()
+        generate_pods(lang, mix, num_pods, num_docs, doc_length, seed)
+        indexing_seconds = perf_counter() - start
+        bytes_before = pod_bytes_read()
+        start = perf_counter()
+        latencies, stages = replay_queries(queries, lang)
+        search_seconds = perf_counter() - start
+        bytes_after = pod_bytes_read()
+    finally:
+        if not keep:
+            remove_pods()
+    return {
+        'commit': git_commit(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'params': {'lang': lang, 'mix': list(mix), 'pods': num_pods, 'docs': num_docs,
+                   'doc_length': doc_length, 'queries': num_queries, 'seed': seed},
+        'indexing': {'docs': len(mix) * num_pods * num_docs, 'seconds': indexing_seconds},
+        'throughput_qps': len(queries) / search_seconds,
+        'latency_ms': percentiles(latencies),
+        'stages_ms': {stage: percentiles(times) for stage, times in stages.items()},
+        'pod_bytes_read': {stage: (bytes_after[stage] - bytes_before[stage]) / len(queries) for stage in bytes_after},
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run_in_scratch(args, keep=False):
+    ''' Run a flask command in a new process, on a scratch database
+    and pod directory, so that a benchmark never touches the real
+    index. The app reads its configuration on import, hence the new
+    process.
+    Returns: the exit code of the command.
+    '''
+    scratch = tempfile.mkdtemp(prefix='pears-bench-')
+    env = dict(os.environ, DATABASE_URL='sqlite:///' + join(scratch, 'bench.db'),
+               POD_DIR=join(scratch, 'pods'), PEARS_BENCH_SCRATCH=scratch)
+    try:
+        return subprocess.run([sys.executable, '-m', 'flask'] + args, env=env).returncode
+    finally:
+        if keep:
+            print(f"Scratch database and pods kept in {scratch}.")
+        else:
+            rmtree(scratch, ignore_errors=True)
+
+
+def write_report(report, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
@@ -1,10 +1,13 @@
-from os.path import join, dirname, realpath
+import logging
+from os.path import join
 import joblib
 from scipy.sparse import load_npz
+from app import POD_DIR
 from app.api.models import Urls
 
-dir_path = dirname(dirname(dirname(realpath(__file__))))
-pod_dir = join(dir_path,'app','pods')
+pod_dir = POD_DIR
+
+LOG = logging.getLogger(__name__)
 
 
 def check_db_vs_npz(pod, verbose=True):
@@ -16,13 +19,13 @@ def check_db_vs_npz(pod, verbose=True):
     Return: the length of the urls in the database and the number of 
     rows in the matrix.
     """
-    print(f"\t>>> CHECKING DB VS NPZ FOR POD: {pod.name}")
-    urls = Urls.query.filter_by(pod=pod.url).all()
+    LOG.info("Checking db vs npz for pod %s", pod.name)
+    urls = Urls.query.filter_by(pod_id=pod.id).all()
     urls = [url.url for url in urls]
     npz_path = join(pod_dir, pod.url+'.npz')
     vectors = load_npz(npz_path)
     if len(set(urls)) + 1 != vectors.shape[0] and verbose:
-        print("\t\t>>> WARNING: Length of URL set in DB != number of rows in npz matrix", len(urls), vectors.shape[0])
+        LOG.warning("Pod %s: length of URL set in DB != number of rows in npz matrix: %d %d", pod.name, len(urls), vectors.shape[0])
     return len(set(urls)), vectors.shape[0]
 
 def check_db_vs_pos(pod, verbose=True):
@@ -34,7 +37,7 @@ def check_db_vs_pos(pod, verbose=True):
     Return: the database document ids not found in the positional index.
     """
     #print(f"\t>>> CHECKING DB VS POS FOR POD: {pod.name}")
-    urls = Urls.query.filter_by(pod=pod.url).all()
+    urls = Urls.query.filter_by(pod_id=pod.id).all()
     urls = set([url.id for url in urls])
     posix_path = join(pod_dir, pod.url+'.pos')
     posindex = joblib.load(posix_path)
@@ -46,9 +49,9 @@ def check_db_vs_pos(pod, verbose=True):
     db_docs_not_in_pos = list(urls - unique_docs)
     pos_docs_not_in_db = list(unique_docs - urls)
     if len(db_docs_not_in_pos) != 0 and verbose:
-        print(f"\t\t>>> WARNING: Some URLs in DB are not in positional index.")
+        LOG.warning("Pod %s: some URLs in DB are not in positional index.", pod.name)
     if len(pos_docs_not_in_db) != 0 and verbose:
-        print(f"\t\t>>> WARNING: Some URLs in positional index are not in DB.")
+        LOG.warning("Pod %s: some URLs in positional index are not in DB.", pod.name)
     return db_docs_not_in_pos, pos_docs_not_in_db
 
 
@@ -2,6 +2,9 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-only
 
+import os
+import sys
+import logging
 from collections import Counter
 from shutil import copy2, copytree, rmtree
 from os.path import dirname, realpath, join, exists
@@ -11,14 +14,16 @@ import joblib
 from flask import Blueprint
 import click
 from scipy.sparse import load_npz, save_npz
-from app import db, Urls, Pods
+from app import db, Urls, Pods, POD_DIR
 from app.indexer.posix import load_posix
 from app.utils_db import rm_from_npz, rm_doc_from_pos
 
 pears = Blueprint('pears', __name__)
 
 dir_path = dirname(dirname(dirname(realpath(__file__))))
-pod_dir = join(dir_path,'app','pods')
+pod_dir = POD_DIR
+
+LOG = logging.getLogger(__name__)
 
 
 @pears.cli.command('backup')
@@ -55,11 +60,34 @@ def restore(snapshot):
 def deletedbonly():
     pods = Pods.query.all()
     for pod in pods:
-        urls = Urls.query.filter_by(pod=pod.name).all()
+        urls = Urls.query.filter_by(pod_id=pod.id).all()
         for u in urls:
             db.session.delete(u)
             db.session.commit()
 
+@pears.cli.command('resumecrawls')
+def resumecrawls():
+    '''Run interrupted crawl jobs to completion, in the foreground'''
+    from app.api.models import Jobs
+    from app.indexer.crawler import run_crawl_job
+    from app.indexer.jobqueue import requeue_stale_jobs
+    # Jobs left running by a dead process are only run once requeued
+    requeue_stale_jobs()
+    jobs = Jobs.query.filter_by(status='queued').order_by(Jobs.id).all()
+    if not jobs:
+        click.echo("No crawl job to resume.")
+    for job_id in [job.id for job in jobs]:
+        click.echo(f"Resuming crawl job {job_id}")
+        run_crawl_job(job_id)
+
+@pears.cli.command('worker')
+@click.option('--processes', default=1, help='Number of indexing worker processes.')
+def worker(processes):
+    '''Run indexing worker processes, consuming the crawl job queue'''
+    from app.indexer.jobqueue import start_worker_pool
+    for p in start_worker_pool(processes):
+        p.join()
+
 #####################
 # QUERIES
 #####################
@@ -86,46 +114,115 @@ def showallurls():
     pods = Pods.query.all()
     for pod in pods:
         print('\n\n',pod.as_dict())
-        urls = Urls.query.filter_by(pod=pod.url).all()
+        urls = Urls.query.filter_by(pod_id=pod.id).all()
         for u in urls:
             print(u.id, u.vector, u.url, u.pod)
 
+#####################
+# BENCHMARKS
+#####################
+
+@pears.cli.command('bench-search')
+@click.option('--lang', default=None, help='Language of the synthetic docs. Defaults to the first installed language.')
+@click.option('--mix', default='user,group,shared,sites', help='Permission classes to generate pods for.')
+@click.option('--pods', default=1, help='Pods per permission class.')
+@click.option('--docs', default=50, help='Docs per pod.')
+@click.option('--doc-length', default=300, help='Words per doc.')
+@click.option('--queries', default=100, help='Number of queries to replay.')
+@click.option('--seed', default=0, help='Seed of the synthetic docs and queries.')
+@click.option('--output', default=None, help='Path of the JSON report.')
+@click.option('--keep', is_flag=True, help='Keep the synthetic pods after the run.')
+def benchsearch(lang, mix, pods, docs, doc_length, queries, seed, output, keep):
+    '''Benchmark search on a synthetic index'''
+    from app import LANGS
+    from app.cli.bench import bench_search, write_report, run_in_scratch
+    if not os.getenv('PEARS_BENCH_SCRATCH'):
+        sys.exit(run_in_scratch(sys.argv[1:], keep))
+    lang = lang or LANGS[0]
+    mix = [c.strip() for c in mix.split(',')]
+    report = bench_search(lang, mix, pods, docs, doc_length, queries, seed, keep)
+    if output is None:
+        output = join(dir_path, f"bench-search-{report['commit'] or 'local'}.json")
+    write_report(report, output)
+    latency = report['latency_ms']
+    print(f"{queries} queries, {report['throughput_qps']:.1f} q/s, p50 {latency['p50']:.1f} ms, "
+          f"p95 {latency['p95']:.1f} ms, p99 {latency['p99']:.1f} ms. Report: {output}")
+
+@pears.cli.command('eval-search')
+@click.argument('golden')
+@click.option('--username', default=None, help='Search as this user. Defaults to anonymous search.')
+@click.option('--output', default=None, help='Path of the JSON report.')
+@click.option('--baseline', default=None, help='Report of a previous run to compare with.')
+@click.option('--tolerance', default=0.0, help='Allowed drop of each metric against the baseline.')
+def evalsearch(golden, username, output, baseline, tolerance):
+    '''Score rankings and latency on a golden query set'''
+    import json
+    from app.cli.evaluation import read_golden_queries, evaluate, compare_reports
+    from app.cli.bench import write_report
+    report = evaluate(read_golden_queries(golden), username)
+    if output is None:
+        output = join(dir_path, f"eval-search-{report['commit'] or 'local'}.json")
+    write_report(report, output)
+    metrics = ', '.join(f"{m} {v:.3f}" for m, v in report['metrics'].items())
+    latency = report['latency_ms']
+    print(f"{report['queries']} queries: {metrics}, p50 {latency.get('p50', 0):.1f} ms, "
+          f"p95 {latency.get('p95', 0):.1f} ms, p99 {latency.get('p99', 0):.1f} ms. Report: {output}")
+    if baseline is None:
+        return
+    with open(baseline, encoding='utf-8') as f:
+        regressions, changed = compare_reports(report, json.load(f), tolerance)
+    for m, (old, new) in regressions.items():
+        print(f"REGRESSION: {m} dropped from {old:.3f} to {new:.3f}")
+    print(f"{len(changed)} queries ranked differently from the baseline.")
+    if regressions:
+        raise SystemExit(1)
+
 #####################
 # CONSISTENCY CHECKS
 #####################
 
 @pears.cli.command('consistency')
 def checkconsistency():
-    print("\n>> CLI: UNITTEST: CONSISTENCY CHECKS")
     from app.cli.consistency import check_db_vs_npz, check_db_vs_pos
     pods = Pods.query.all()
     for pod in pods:
-        print(">> CLI: UNITTEST: CONSISTENCY: CHECKING POD:", pod.name)
-        check_db_vs_npz(pod)
-        check_db_vs_pos(pod)
+        click.echo(f"Checking pod {pod.url}")
+        num_urls, num_rows = check_db_vs_npz(pod, verbose=False)
+        if num_urls + 1 != num_rows:
+            click.echo(f"  {num_urls} urls in the database, but {num_rows} rows in the npz matrix")
+        db_docs_not_in_pos, pos_docs_not_in_db = check_db_vs_pos(pod, verbose=False)
+        if db_docs_not_in_pos:
+            click.echo(f"  {len(db_docs_not_in_pos)} urls in the database are not in the positional index")
+        if pos_docs_not_in_db:
+            click.echo(f"  {len(pos_docs_not_in_db)} docs in the positional index are not in the database")
 
 #####################
 # BASIC REPAIR
 #####################
 
+@pears.cli.command('refreshstats')
+def refreshstats():
+    '''Recompute the index statistics kept on pods'''
+    from app.utils_db import refresh_pod_stats
+    refresh_pod_stats()
+
 @pears.cli.command('repair')
 @click.argument('username')
 def repair(username):
-    print("\n>> CLI: REPAIR")
     pods = Pods.query.all()
     usernames = [p.name.split('/')[0] for p in pods]
     if username not in usernames:
-        print("\t> ERROR: no username",username)
+        click.echo(f"No pods for username {username}", err=True)
         return 0
 
 def del_npz_rows(pod, todelete):
-    print("\t>> DELETE NPZ ROWS", todelete)
+    LOG.info("Deleting npz rows %s", todelete)
     for i in todelete:
         rm_from_npz(i,pod)
 
 
 def del_pod_docs(pod, todelete):
-    print("\t>> DELETE POS DOCS", todelete)
+    LOG.info("Deleting pos docs %s", todelete)
     for i in todelete:
         rm_doc_from_pos(i,pod)
 
@@ -0,0 +1,93 @@
+# SPDX-FileCopyrightText: 2025 PeARS Project, <pears@possible-worlds.eu>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import json
+import math
+from time import perf_counter
+from datetime import datetime
+from flask import session
+from app import app
+from app.search.controllers import run_user_search, run_anonymous_search
+from app.cli.bench import percentiles, git_commit
+
+METRICS = ['mrr', 'ndcg@10', 'recall@20']
+
+
+def read_golden_queries(path):
+    ''' Read a golden query set: one JSON object per line, with a
+    'query' and the list of its 'relevant' urls.'''
+    queries = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                queries.append(json.loads(line))
+    return queries
+
+
+def reciprocal_rank(ranking, relevant):
+    for i, url in enumerate(ranking):
+        if url in relevant:
+            return 1 / (i + 1)
+    return 0.0
+
+
+def ndcg(ranking, relevant, k=10):
+    dcg = sum(1 / math.log2(i + 2) for i, url in enumerate(ranking[:k]) if url in relevant)
+    ideal = sum(1 / math.log2(i + 2) for i in range(min(len(relevant), k)))
+    return dcg / ideal if ideal > 0 else 0.0
+
+
+def recall(ranking, relevant, k=20):
+    if not relevant:
+        return 0.0
+    return len(set(ranking[:k]) & relevant) / len(relevant)
+
+
+def evaluate(golden, username=None):
+    ''' Run each golden query as the given user, or anonymously,
+    and score its ranking.
+    Returns: the report, with mean metrics, latency percentiles
+    and the ranking of each query.
+    '''
+    per_query = []
+    latencies = []
+    with app.test_request_context():
+        if username is not None:
+            session['username'] = username
+        for q in golden:
+            relevant = set(q['relevant'])
+            start = perf_counter()
+            if username is not None:
+                results = run_user_search(q['query'])
+            else:
+                results = run_anonymous_search(q['query'])
+            latencies.append((perf_counter() - start) * 1000)
+            ranking = list(results.keys())
+            per_query.append({'query': q['query'], 'ranking': ranking,
+                              'mrr': reciprocal_rank(ranking, relevant),
+                              'ndcg@10': ndcg(ranking, relevant),
+                              'recall@20': recall(ranking, relevant)})
+    n = max(len(per_query), 1)
+    return {
+        'commit': git_commit(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'username': username,
+        'queries': len(per_query),
+        'metrics': {m: sum(q[m] for q in per_query) / n for m in METRICS},
+        'latency_ms': percentiles(latencies),
+        'per_query': per_query,
+    }
+
+
+def compare_reports(report, baseline, tolerance=0.0):
+    ''' Check a report against a baseline run on the same queries.
+    Returns: the metrics that dropped by more than the tolerance,
+    and the queries whose ranking changed.
+    '''
+    regressions = {m: (baseline['metrics'][m], report['metrics'][m]) for m in METRICS
+                   if report['metrics'][m] < baseline['metrics'][m] - tolerance}
+    old_rankings = {q['query']: q['ranking'] for q in baseline['per_query']}
+    changed = [q['query'] for q in report['per_query']
+               if q['query'] in old_rankings and q['ranking'] != old_rankings[q['query']]]
+    return regressions, changed
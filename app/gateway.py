@@ -0,0 +1,104 @@
+# SPDX-FileCopyrightText: 2025 PeARS Project, <pears@possible-worlds.eu>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import os
+import threading
+from time import perf_counter
+from urllib.parse import urlparse
+from http.cookiejar import DefaultCookiePolicy
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from app import GATEWAY_POOL_SIZE, GATEWAY_RETRIES
+from app.metrics import record_gateway_request
+
+# Default timeout (seconds) for requests that do not set one
+DEFAULT_TIMEOUT = 30
+
+
+class GatewayClient:
+    """ HTTP client shared by all calls to the On My Disk gateway.
+    Connections are pooled and kept alive, so that a crawl does not
+    pay a TCP and TLS handshake per request. Idempotent requests are
+    retried with backoff on connection errors, timeouts and 5xx
+    responses. Call counts and latencies are recorded per host and
+    method.
+    """
+
+    def __init__(self, pool_size=20, retries=3, backoff_factor=0.5):
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.pid = None
+        self.session = None
+
+    def _make_session(self):
+        retry = Retry(total=self.retries, backoff_factor=self.backoff_factor,
+                status_forcelist=(500, 502, 503, 504), allowed_methods=frozenset(['GET', 'HEAD']),
+                raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        # The session is shared by all users: cookies set by the
+        # gateway for one of them must not be sent for another
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def get_session(self):
+        # Worker processes must not share the sockets of their parent
+        if self.session is None or self.pid != os.getpid():
+            with self.lock:
+                if self.session is None or self.pid != os.getpid():
+                    self.session = self._make_session()
+                    self.pid = os.getpid()
+        return self.session
+
+    def record(self, key, seconds, error):
+        with self.lock:
+            s = self.stats.setdefault(key, {'calls': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            s['calls'] += 1
+            s['errors'] += int(error)
+            s['seconds'] += seconds
+            s['max_seconds'] = max(s['max_seconds'], seconds)
+
+    def request(self, method, url, token=None, timeout=DEFAULT_TIMEOUT, **kwargs):
+        """ Send a request, adding the gateway authorization
+        header if a token is given.
+        """
+        headers = dict(kwargs.pop('headers', None) or {})
+        if token:
+            headers['Authorization'] = 'token:'+token
+        host = urlparse(url).netloc
+        key = f"{method} {host}"
+        start = perf_counter()
+        error = True
+        try:
+            resp = self.get_session().request(method, url, headers=headers, timeout=timeout, **kwargs)
+            error = resp.status_code >= 500
+            return resp
+        finally:
+            seconds = perf_counter() - start
+            self.record(key, seconds, error)
+            record_gateway_request(method, host, seconds, error)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def get_stats(self):
+        """ Returns: per host and method, the number of calls and
+        errors, and the mean and max latency in seconds.
+        """
+        with self.lock:
+            return {key: {'calls': s['calls'], 'errors': s['errors'],
+                          'mean_seconds': s['seconds'] / s['calls'], 'max_seconds': s['max_seconds']}
+                    for key, s in self.stats.items()}
+
+
+gateway = GatewayClient(pool_size=GATEWAY_POOL_SIZE, retries=GATEWAY_RETRIES)
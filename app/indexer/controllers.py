@@ -4,33 +4,33 @@
 
 # Import flask dependencies
 import logging
-from math import ceil
+from time import sleep
 from os.path import dirname, join, realpath
-from flask import Blueprint, request, session, render_template, Response, redirect, url_for, flash
-
-from app import app, db, tracker
-from app import OMD_PATH
-from app.api.models import Urls, Locations, Groups, Sites
-from app.indexer import mk_page_vector
-from app.indexer.spider import process_xml, process_html_links, get_doc_info
-from app.utils import carbon_print, get_device_from_url, get_username_from_url, init_crawl
-from app.utils_db import create_pod, create_url_in_db, delete_url, delete_old_urls, delete_unsubscribed, delete_old_pods, subscribe_location, check_consistency
-from app.indexer.posix import posix_doc
+from flask import Blueprint, request, session, render_template, Response, redirect, url_for, flash, jsonify
+
+from app import app, db
+from app import OMD_PATH, POD_DIR
+from app.api.models import Urls, Locations, Groups, Sites, Jobs
+from app.utils import get_device_from_url, get_username_from_url, init_crawl
+from app.utils_db import subscribe_location, reset_location_validators, get_index_stats
+from app.indexer.crawler import run_indexing, get_job_progress
+from app.indexer.jobqueue import submit_crawl_job, submit_delete_job, PRIORITY_INTERACTIVE, PRIORITY_SCHEDULED
 from app.auth.controllers import login_required
 from app.forms import IndexerForm, FoldersForm, GroupForm, ChoiceObj
 from app.settings.controllers import get_user_devices, get_locations_and_groups
-from app.indexer.htmlparser import extract_html
 
 app_dir_path = dirname(dirname(realpath(__file__)))
-pod_dir = join(app_dir_path,'pods')
+pod_dir = POD_DIR
 user_app_dir_path = join(app_dir_path,'userdata')
 
+LOG = logging.getLogger(__name__)
+
 # Define the blueprint:
 indexer = Blueprint('indexer', __name__, url_prefix='/indexer')
 
 
 def get_num_db_entries():
-    num_db_entries = len(Urls.query.all())
+    num_db_entries = get_index_stats()['num_urls']
     return num_db_entries
 
 # Set the route and accepted methods
@@ -47,7 +47,7 @@ def index():
     devices_in_db = db.session.query(Locations).filter_by(device=True).all()
     all_devices = [l.name for l in devices_in_db]
     devices_selected = [l.name for l in devices_in_db if l.subscribed]
-    print("DEVICES SELECTED", devices_selected)
+    LOG.info("Devices selected: %s", devices_selected)
     devices = ChoiceObj('folders', devices_selected)
     devices_form = FoldersForm(obj=devices)
     devices_form.folders.choices =  [(c, c) for c in all_devices]
@@ -79,7 +79,10 @@ def update_all():
     start_urls = [l.name for l in locations]
     start_urls.extend([s.url for s in sites])
     session['start_urls'] = start_urls
-    print("UPDATE", start_urls)
+    # Full re-crawl, ignoring the fingerprints of unchanged folders
+    session['force_crawl'] = bool(request.args.get('force'))
+    session['crawl_priority'] = PRIORITY_SCHEDULED
+    LOG.info("Update: %s", start_urls)
     return render_template('indexer/progress_crawl.html', username=username)
 
 
@@ -88,15 +91,32 @@ def update_all():
 def update_folder_subscriptions():
     if request.method == "POST":
         subscriptions = request.form.getlist('folders')
-        print("SUBSCRIBING:", subscriptions)
+        LOG.info("Subscribing: %s", subscriptions)
         locations = db.session.query(Locations).all()
+        unsubscribed = []
         for l in locations:
+            was_subscribed = l.subscribed
             l.subscribed = False
             for sub in subscriptions:
                 if l.name.startswith(sub):
                     l.subscribed = True
+            if l.subscribed and not was_subscribed:
+                l.fingerprint = None
+                l.etag = None
+                l.last_modified = None
+            if was_subscribed and not l.subscribed:
+                unsubscribed.append(l.name)
             db.session.add(l)
             db.session.commit()
+        # Folders with no subscribed subfolder are removed by a delete job.
+        # The docs of other unsubscribed folders go at the end of the next crawl.
+        subscribed = [l.name for l in locations if l.subscribed]
+        prefixes = [name for name in unsubscribed if not any(s.startswith(name) for s in subscribed)]
+        prefixes = [name for name in prefixes if not any(name != p and name.startswith(p) for p in prefixes)]
+        if prefixes:
+            job_id = submit_delete_job(session.get('username'), prefixes)
+            if request.values.get('async'):
+                return deletion_job_response(job_id)
     #return redirect(url_for('indexer.index'))
     return redirect(url_for('indexer.update_all'))
 
@@ -106,15 +126,18 @@ def update_folder_subscriptions():
 def update_group_subscriptions():
     if request.method == "POST":
         subscriptions = request.form.getlist('groups')
-        print("SUBSCRIBING:", subscriptions)
+        LOG.info("Subscribing: %s", subscriptions)
         groups = db.session.query(Groups).all()
+        changed = False
         for g in groups:
-            if g.name in subscriptions:
-                g.subscribed = True
-            else:
-                g.subscribed = False
+            subscribed = g.name in subscriptions
+            changed = changed or subscribed != g.subscribed
+            g.subscribed = subscribed
             db.session.add(g)
             db.session.commit()
+        # Group docs are spread over all listings
+        if changed:
+            reset_location_validators()
     #return redirect(url_for('indexer.index'))
     return redirect(url_for('indexer.update_all'))
 
@@ -129,8 +152,9 @@ def from_crawl():
     """
 
     def process_start_url(url, username):
-        logging.debug(f">> INDEXER: CONTROLLER: from_crawl: Now crawling {u}")
+        LOG.debug("from_crawl: now crawling %s", u)
         session["toindex"] = [username, url]
+        session["force_crawl"] = True
         subscribe_location(url)
    
     if request.method == "POST":
@@ -156,101 +180,75 @@ def from_crawl():
 
 
 
-def run_indexing(url, pod_path, title, snippet, description, lang, doc):
-    print(f"\t>>> INDEXER: CONTROLLER: RUN_INDEXING: INDEXING {url}")
-    url_in_db = Urls.query.filter_by(url=url).first()
-    if url_in_db:
-        print(f"\t>>> INDEXER: CONTROLLER: RUN_INDEXING: URL PREVIOUSLY KNOWN: {url}")
-        delete_url(url)
-    
-    success, msg = check_consistency(pod_path)
-    if not success:
-        print(f"\t>>> INDEXER:CONTROLLER: RUN_INDEXING: INDEXING CANCELLED: {msg}")
-        return success, msg
-    
-    idv, tokenized_text = mk_page_vector.compute_vectors_local_docs(url, pod_path, title, description, doc, lang)
-    idx = create_url_in_db(url, title, snippet, description, idv, pod_path)
-    posix_doc(tokenized_text, idx, pod_path)
-    return success, msg
-
-
 @indexer.route("/progress_crawl")
 @login_required
 def progress_crawl(username=None, start_urls=None):
 
     """ Crawl function, called by from_crawl.
-    Reads the start URL given by the user and
-    recursively crawls down directories from there.
+    Reads the start URL given by the user and creates a
+    crawl job, which recursively crawls down directories
+    from there in the background. The response streams the
+    progress of the job, which keeps running if the client
+    disconnects.
     """
 
     username, links = init_crawl(username, start_urls)
+    force = session.pop('force_crawl', False)
+    priority = session.pop('crawl_priority', PRIORITY_INTERACTIVE)
     #print("USERNAME", username, "LINKS",links)
-    init_links = links.copy()
-    for link in links:
-        subscribe_location(link)
-
-    def generate(links):
+    if links:
+        for link in links:
+            subscribe_location(link)
+        job_id = submit_crawl_job(username, links, force=force, priority=priority)
+        session['crawl_job'] = job_id
+    else:
+        # Reconnection from the client: report on the last job
+        job_id = session.get('crawl_job')
+
+    def generate(job_id):
         with app.app_context():
-            logging.debug("\n\n>>> INDEXER: CONTROLLER: READING DOCS")
-            m = 0
-            c = 0
-            recorded_urls = []
-            if not links:
+            if job_id is None:
                 yield "data:100|Finished!\n\n"
-            while links and len(links) > 0:
-                start_link = links[0]
-                print(f"\n\nProcessing {start_link}.")
-                device = get_device_from_url(start_link)
-                docs, urldir = process_xml(start_link)
-                urls = [join(urldir,doc['@url'].split('?')[0]) for doc in docs]
-                urls = [join(OMD_PATH, url[1:]) if url.startswith('/shared') or url.startswith('/sites') else url for url in urls]
-                recorded_urls.extend(urls)
-                #print(">>>>>>>>>>>>>>>>>>>>>>\n",urls)
-                c = 0
-                m += len(docs)
-                if tracker is not None:
-                    task_name = "run indexing for "+str(len(docs))+" files"
-                    tracker.start_task(task_name)
-                for doc in docs:
-                    doc_info = get_doc_info(doc, urldir)
-                    if doc_info is None:
-                        continue
-                    url, owner, islink, title, description, snippet, body_str, language = doc_info
-                    #print(f"\n{url}, owner: {owner}, islink: {islink}, title: {title}, description: {description[:20]}, body_str: {body_str[:20]}, language: {language}\n")
-                    pod_path = create_pod(url, owner, language, device)
-                    success, msg = run_indexing(url, pod_path, title, snippet, description, language, body_str)
-                    if not success:
-                        continue
-                    if islink:
-                        print("Appending link to list:",url)
-                        links.append(url)
-                        subscribe_location(url)
-                    html_links = process_html_links(url+'?direct')
-                    #print(url,html_links)
-                    for link in html_links:
-                        title, body_str, snippet, _ = extract_html(link)
-                        description = ""
-                        success, msg = run_indexing(link, pod_path, title, snippet, description, language, body_str)
-
-                    c += 1
-                    p = ceil(c / m * 100)
-                    if p == 0:
-                       p += 1
-                    if p == 100:
-                       p -= 1
-
-                    yield "data:" + str(p) + "|" + start_link + "\n\n"
-                del(links[0])
-            if len(links) == 0:
-                yield "data:90|Cleaning up...\n\n"
-                #print("START URLS", init_links)
-                #delete_old_urls(init_links, recorded_urls)
-                delete_old_pods()
-                delete_unsubscribed()
-                yield "data:100|Finished!\n\n"
-                
-            if tracker is not None:
-                search_emissions = tracker.stop_task()
-                carbon_print(search_emissions, task_name)
+                return
+            finished = False
+            while not finished:
+                p, message, finished = get_job_progress(job_id)
+                db.session.rollback()
+                yield "data:" + str(p) + "|" + message + "\n\n"
+                if not finished:
+                    sleep(1)
+
+    return Response(generate(job_id), mimetype='text/event-stream')
+
+
+@indexer.route("/jobs/")
+@login_required
+def jobs():
+    """ JSON status of the user's latest crawl jobs.
+    """
+    username = session.get('username')
+    jobs = db.session.query(Jobs).filter_by(username=username).order_by(Jobs.id.desc()).limit(20).all()
+    return jsonify([job.serialize for job in jobs])
+
+
+def deletion_job_response(job_id, error=None):
+    """ Reply to an async unsubscribe request with the id
+    and status url of its deletion job.
+    """
+    response = {'job': job_id, 'status': url_for('indexer.job_status', job_id=job_id)}
+    if error is not None:
+        response['error'] = error
+    return jsonify(response), 202
+
 
-    return Response(generate(links), mimetype='text/event-stream')
+@indexer.route("/jobs/<int:job_id>")
+@login_required
+def job_status(job_id):
+    """ JSON status of one of the user's crawl jobs.
+    """
+    job = db.session.query(Jobs).filter_by(id=job_id, username=session.get('username')).first()
+    if job is None:
+        return jsonify({'error': 'No such job.'}), 404
+    status = job.serialize
+    status['progress'], _, _ = get_job_progress(job_id)
+    return jsonify(status)
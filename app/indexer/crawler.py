@@ -0,0 +1,292 @@
+# SPDX-FileCopyrightText: 2025 PeARS Project, <pears@possible-worlds.eu>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import os
+import logging
+import threading
+from math import ceil
+from socket import gethostname
+from datetime import datetime
+from sqlalchemy import or_, and_
+
+from app import app, db, INDEXING_WORKERS
+from app.api.models import Urls, Jobs, FrontierLinks
+from app.indexer import mk_page_vector
+from app.indexer.spider import process_xml, process_html_links, get_doc_info, get_subfolder, may_link_to_pages
+from app.indexer.posix import posix_doc
+from app.indexer.htmlparser import extract_html, PageCache
+from app.utils import get_device_from_url
+from app.carbon import carbon_task
+from app.memory import memory_account
+from app.metrics import INDEXING_STAGE_SECONDS, CRAWL_FOLDER_SECONDS, DOCS_INDEXED
+from app.utils_db import create_pod, create_url_in_db, delete_url, delete_unsubscribed, delete_old_pods, \
+        delete_urls_recursively, update_pod_bytes, subscribe_location, check_consistency, get_location_validators, record_location_validators, \
+        get_location_subfolders
+
+LOG = logging.getLogger(__name__)
+
+# Crawl jobs write to pod files: only run one at a time per process
+crawl_lock = threading.Lock()
+
+# Seconds between heartbeats of a running job
+HEARTBEAT_INTERVAL = 30
+
+
+def worker_name():
+    """ Identify the process running a job.
+    """
+    return f"{gethostname()}:{os.getpid()}"
+
+
+def heartbeat(job_id, stop):
+    """ Record that a job is still running until stopped, so that
+    it is not mistaken for a job left by a dead worker.
+    """
+    while not stop.wait(HEARTBEAT_INTERVAL):
+        try:
+            with app.app_context():
+                db.session.query(Jobs).filter_by(id=job_id, status='running') \
+                        .update({'heartbeat': datetime.utcnow()}, synchronize_session=False)
+                db.session.commit()
+        except Exception as e:
+            LOG.warning("Could not record heartbeat of job %s: %s", job_id, e)
+
+
+def run_indexing(url, pod_path, title, snippet, description, lang, doc, truncated=False):
+    LOG.debug("run_indexing: indexing %s", url)
+    url_in_db = Urls.query.filter_by(url=url).first()
+    if url_in_db:
+        LOG.debug("run_indexing: url previously known: %s", url)
+        delete_url(url)
+
+    success, msg = check_consistency(pod_path)
+    if not success:
+        LOG.error("run_indexing: indexing cancelled: %s", msg)
+        return success, msg
+
+    with INDEXING_STAGE_SECONDS.labels('vectorize').time():
+        idv, tokenized_text = mk_page_vector.compute_vectors_local_docs(url, pod_path, title, description, doc, lang)
+    with INDEXING_STAGE_SECONDS.labels('database').time():
+        idx = create_url_in_db(url, title, snippet, description, idv, pod_path, truncated)
+    with INDEXING_STAGE_SECONDS.labels('posix').time():
+        posix_doc(tokenized_text, idx, pod_path)
+    DOCS_INDEXED.inc()
+    return success, msg
+
+
+@CRAWL_FOLDER_SECONDS.time()
+@carbon_task('crawl_folder')
+@memory_account('crawl_folder')
+def crawl_folder(job, start_link, cache, indexed):
+    """ Index the docs listed in a folder. The page cache and
+    the set of indexed urls are shared by all folders of a job,
+    so that each page is downloaded and indexed once per job.
+    Returns: the subfolders to add to the frontier, and whether
+    all docs in the folder were processed successfully.
+    """
+    LOG.info("Processing %s.", start_link)
+    sublinks = []
+    complete = True
+    device = get_device_from_url(start_link)
+    fingerprint, etag, last_modified = (None, None, None) if job.force else get_location_validators(start_link)
+    # Docs are streamed: indexing starts before the listing is fully downloaded
+    docs, urldir = process_xml(start_link, etag=etag, last_modified=last_modified)
+    if docs.failed:
+        LOG.warning("%s could not be retrieved. Skipping.", start_link)
+        return sublinks, False
+    # A listing only changes with its direct entries: files deeper
+    # in the tree may have changed, so subfolders are still crawled
+    if docs.not_modified:
+        LOG.info("%s has not been modified since last crawl. Skipping its docs.", start_link)
+        return get_location_subfolders(start_link), complete
+    # Without HTTP validators, only the content of the listing tells
+    # whether it changed, so it is downloaded before indexing starts
+    if fingerprint is not None and docs.etag is None and docs.last_modified is None:
+        docs.buffer()
+        if docs.fingerprint == fingerprint:
+            LOG.info("%s listing is unchanged. Skipping its docs.", start_link)
+            return get_location_subfolders(start_link), complete
+    # Pods written to, whose size is recorded with the checkpoint of the folder
+    pods = set()
+    for doc in docs:
+        job.num_docs += 1
+        subfolder = get_subfolder(doc, urldir)
+        if subfolder is not None and subfolder not in sublinks:
+            sublinks.append(subfolder)
+        doc_info = get_doc_info(doc, urldir, cache)
+        if doc_info is None:
+            continue
+        url, owner, islink, title, description, snippet, body_str, language, content_type, truncated = doc_info
+        #print(f"\n{url}, owner: {owner}, islink: {islink}, title: {title}, description: {description[:20]}, body_str: {body_str[:20]}, language: {language}\n")
+        pod_path = create_pod(url, owner, language, device)
+        success, msg = run_indexing(url, pod_path, title, snippet, description, language, body_str, truncated)
+        pods.add(pod_path)
+        if not success:
+            complete = False
+            continue
+        job.num_indexed += 1
+        indexed.add(url)
+        if not may_link_to_pages(url, content_type):
+            continue
+        html_links = process_html_links(url+'?direct', cache)
+        #print(url,html_links)
+        for link in html_links:
+            if link in indexed:
+                continue
+            indexed.add(link)
+            title, body_str, snippet, _, truncated = extract_html(link, cache)
+            description = ""
+            success, msg = run_indexing(link, pod_path, title, snippet, description, language, body_str, truncated)
+    for pod_path in pods:
+        update_pod_bytes(pod_path)
+
+    if complete:
+        record_location_validators(start_link, docs.fingerprint, docs.etag, docs.last_modified, sublinks)
+    return sublinks, complete
+
+
+##############
+# CRAWL JOBS
+##############
+
+def create_crawl_job(username, start_urls, force=False, priority=0, kind='crawl'):
+    """ Persist a new crawl job, with the start urls as
+    initial frontier. Delete jobs use the same frontier
+    for the url prefixes to remove.
+    Returns: the id of the job.
+    """
+    job = Jobs(username=username, kind=kind, priority=priority, force=force)
+    db.session.add(job)
+    db.session.flush()
+    for url in start_urls:
+        db.session.add(FrontierLinks(job_id=job.id, url=url))
+    db.session.commit()
+    return job.id
+
+
+def checkpoint(job, link, sublinks):
+    """ Mark a frontier link as done and add its subfolders
+    to the frontier, in a single transaction.
+    """
+    known = set(url for (url,) in db.session.query(FrontierLinks.url).filter_by(job_id=job.id))
+    for url in sublinks:
+        if url in known:
+            continue
+        LOG.debug("Appending link to frontier: %s", url)
+        subscribe_location(url)
+        db.session.add(FrontierLinks(job_id=job.id, url=url))
+        known.add(url)
+    link.done = True
+    job.num_folders += 1
+    db.session.add(link)
+    db.session.add(job)
+    db.session.commit()
+
+
+def run_crawl_job(job_id):
+    """ Crawl the frontier of a job until it is empty, then clean
+    up the index. The frontier is checkpointed after each folder, so
+    an interrupted job resumes from the folder it was processing.
+    Delete jobs remove each prefix of their frontier instead.
+    With worker processes, the clean up is left to a cleanup job,
+    which does not run alongside other jobs.
+    """
+    worker = worker_name()
+    with crawl_lock, app.app_context():
+        # Only run jobs that are queued or already claimed by this process
+        claimed = db.session.query(Jobs).filter(Jobs.id == job_id) \
+                .filter(or_(Jobs.status == 'queued', and_(Jobs.status == 'running', Jobs.worker == worker))) \
+                .update({'status': 'running', 'worker': worker, 'heartbeat': datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+        if not claimed:
+            return
+        job = db.session.get(Jobs, job_id, populate_existing=True)
+        stop = threading.Event()
+        threading.Thread(target=heartbeat, args=(job_id, stop), daemon=True).start()
+        # Pages are downloaded once for link extraction and indexing
+        cache = PageCache()
+        indexed = set()
+        try:
+            while True:
+                link = db.session.query(FrontierLinks).filter_by(job_id=job.id, done=False).order_by(FrontierLinks.id).first()
+                if link is None:
+                    break
+                job.current = link.url
+                db.session.commit()
+                if job.kind == 'delete':
+                    job.num_docs += delete_urls_recursively(link.url)
+                    checkpoint(job, link, [])
+                    continue
+                sublinks, _ = crawl_folder(job, link.url, cache, indexed)
+                checkpoint(job, link, sublinks)
+            crawled = job.kind not in ('delete', 'cleanup')
+            # Without worker processes, jobs already run one at a time
+            if job.kind == 'cleanup' or (crawled and INDEXING_WORKERS == 0):
+                job.current = "Cleaning up..."
+                db.session.commit()
+                delete_old_pods()
+                delete_unsubscribed()
+            job.status = 'done'
+            job.current = ""
+        except Exception as e:
+            LOG.exception("Job %s failed.", job_id)
+            db.session.rollback()
+            job = db.session.get(Jobs, job_id)
+            job.status = 'failed'
+            job.message = str(e)[:1000]
+        finally:
+            stop.set()
+            cache.clear()
+        db.session.commit()
+        if job.status == 'done' and job.kind not in ('delete', 'cleanup') and INDEXING_WORKERS > 0:
+            from app.indexer.jobqueue import submit_cleanup_job
+            submit_cleanup_job()
+
+
+def start_crawl_job(job_id):
+    """ Run a crawl job in a background thread, independently
+    of the HTTP request that created it.
+    """
+    thread = threading.Thread(target=run_crawl_job, args=(job_id,), daemon=True)
+    thread.start()
+    return thread
+
+
+def resume_crawl_jobs():
+    """ Start threads for the queued jobs, e.g. those interrupted
+    by a shutdown of the app and requeued since.
+    Returns: the ids of the resumed jobs.
+    """
+    with app.app_context():
+        jobs = db.session.query(Jobs).filter_by(status='queued').order_by(Jobs.id).all()
+        job_ids = [job.id for job in jobs]
+    for job_id in job_ids:
+        LOG.info("Resuming crawl job %s", job_id)
+        start_crawl_job(job_id)
+    return job_ids
+
+
+def get_job_progress(job_id):
+    """ Read the progress of a job from the database.
+    Returns: a percentage, a message to display, and whether
+    the job is finished.
+    """
+    job = db.session.get(Jobs, job_id, populate_existing=True)
+    if job is None:
+        return 100, "Finished!", True
+    if job.status == 'done':
+        return 100, "Finished!", True
+    if job.status == 'failed':
+        return 100, "Indexing failed: "+job.message, True
+    if job.status == 'queued':
+        return 1, "Waiting for other crawls to finish...", False
+    if job.current == "Cleaning up...":
+        return 90, job.current, False
+    # The total number of docs is not known in advance,
+    # so progress is measured over the folders seen so far.
+    pending = db.session.query(FrontierLinks).filter_by(job_id=job.id, done=False).count()
+    done = job.num_folders
+    p = ceil(done / max(done + pending, 1) * 100)
+    p = min(max(p, 1), 99)
+    return p, job.current, False
@@ -4,14 +4,27 @@
 
 import re
 import logging
+from collections import OrderedDict
 from os.path import join
 import requests
 import justext
 from bs4 import BeautifulSoup
 from langdetect import detect
-from app import LANGS, AUTH_TOKEN, OMD_PATH
+from app import LANGS, AUTH_TOKEN, OMD_PATH, FILE_SIZE_LIMIT
+from app.gateway import gateway
 from app.indexer import detect_open
 from app.api.models import installed_languages
+from app.metrics import record_cache, CACHE_ENTRIES, CACHE_BYTES
+
+LOG = logging.getLogger(__name__)
+
+# Downloads are cut after FILE_SIZE_LIMIT kilobytes
+MAX_DOWNLOAD_BYTES = FILE_SIZE_LIMIT * 1024
+CHUNK_SIZE = 64 * 1024
+# Bytes of pages kept by the page cache of a crawl job
+PAGE_CACHE_BYTES = 64 * 1024 * 1024
+# A parsed page takes 10 to 40 times the size of its html
+SOUP_BYTES_PER_CHAR = 20
 
 
 def remove_boilerplates(response, lang):
@@ -30,43 +43,181 @@ def remove_boilerplates(response, lang):
     return text
 
 
-def BS_parse(url):
-    req = None
-    try:
-        if url.endswith('?direct'):
-            req = requests.get(url, timeout=10, headers={'Authorization': 'token:'+AUTH_TOKEN})
+class Page:
+    '''A downloaded page. The BeautifulSoup tree is only built
+    when first needed, and then kept.'''
+
+    def __init__(self, url, status_code, content_type, text, truncated=False):
+        self.url = url
+        self.status_code = status_code
+        self.content_type = content_type
+        self.text = text
+        self.truncated = truncated
+        self._soup = None
+        # Called with the page and the bytes added when the tree is built
+        self.on_resize = None
+
+    @property
+    def soup(self):
+        if self._soup is None:
+            self._soup = BeautifulSoup(self.text, "lxml")
+            if self.on_resize is not None:
+                self.on_resize(self, SOUP_BYTES_PER_CHAR * len(self.text))
+        return self._soup
+
+    @property
+    def size(self):
+        '''Estimated bytes held by the page, with its tree if built.'''
+        size = len(self.text)
+        if self._soup is not None:
+            size += SOUP_BYTES_PER_CHAR * len(self.text)
+        return size
+
+
+class PageCache:
+    '''Cache of the pages fetched during a crawl, so that each url is
+    downloaded and parsed once, for both link extraction and indexing.
+    Least recently used pages are dropped beyond max_bytes.'''
+
+    def __init__(self, max_bytes=PAGE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.pages = OrderedDict()
+        self.sizes = {}
+        self.hits = 0
+        self.misses = 0
+        self.num_entries = 0
+        self.num_bytes = 0
+
+    def get(self, url):
+        record_cache('pages', url in self.pages)
+        if url in self.pages:
+            self.hits += 1
+            self.pages.move_to_end(url)
+            page = self.pages[url]
         else:
-            req = requests.get(url, timeout=10)
-        req.encoding = 'utf-8'
+            self.misses += 1
+            page = fetch_page(url)
+            self.put(url, page)
+        self.shrink()
+        return page
+
+    def put(self, url, page):
+        size = 0
+        if url in self.pages:
+            self.detach(url)
+            size -= self.sizes[url]
+        self.pages[url] = page
+        self.sizes[url] = page.size if page is not None else 0
+        if page is not None:
+            page.on_resize = self.resize
+        self.account(self.num_bytes + size + self.sizes[url])
+
+    def resize(self, page, nbytes):
+        # Trees are built after their page is cached
+        if self.pages.get(page.url) is page:
+            self.sizes[page.url] += nbytes
+            self.account(self.num_bytes + nbytes)
+
+    def detach(self, url):
+        page = self.pages[url]
+        if page is not None:
+            page.on_resize = None
+
+    def shrink(self):
+        size = self.num_bytes
+        # The page just asked for is kept, whatever its size
+        while size > self.max_bytes and len(self.pages) > 1:
+            url = next(iter(self.pages))
+            self.detach(url)
+            del self.pages[url]
+            size -= self.sizes.pop(url)
+        self.account(size)
+
+    def account(self, size):
+        # Occupancy of all page caches of the process, as reported in /metrics
+        CACHE_ENTRIES.labels('pages').inc(len(self.pages) - self.num_entries)
+        CACHE_BYTES.labels('pages').inc(size - self.num_bytes)
+        self.num_entries = len(self.pages)
+        self.num_bytes = size
+
+    def clear(self):
+        for url in self.pages:
+            self.detach(url)
+        self.pages.clear()
+        self.sizes.clear()
+        self.account(0)
+
+
+def fetch_capped(url, timeout, token=None, limit=MAX_DOWNLOAD_BYTES):
+    '''Stream a download, and stop reading once limit bytes have been
+    received, so that large files are never held in memory in full.
+    A truncated text is cut at its last whitespace, so that no partial
+    word reaches the tokenizer.
+    Returns the response, the text and whether it was truncated.'''
+    req = gateway.get(url, timeout=timeout, token=token, stream=True)
+    chunks = []
+    size = 0
+    truncated = False
+    try:
+        for chunk in req.iter_content(CHUNK_SIZE):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > limit:
+                truncated = True
+                break
+    finally:
+        req.close()
+    text = b''.join(chunks)[:limit].decode('utf-8', errors='replace')
+    if truncated:
+        LOG.info("%s is larger than %s bytes, truncating.", url, limit)
+        # Drop the partial last word, scanning back from the end only
+        if text and not text[-1].isspace():
+            text = text[:len(text) - len(text.rsplit(None, 1)[-1])]
+    return req, text, truncated
+
+
+def fetch_page(url):
+    '''Download a page. Returns None if the request failed.'''
+    token = AUTH_TOKEN if url.endswith('?direct') else None
+    try:
+        req, text, truncated = fetch_capped(url, timeout=10, token=token)
     except Exception:
-        print("Request failed when trying to index", url, "...")
-        return False, req
-    if req.status_code != 200:
-        print("Failure on status code",req.status_code)
-        logging.exception("Warning: " + str(req.url) + ' has a status code of: ' + str(req.status_code) + ' omitted from database.\n')
-        return False, req
-    bs_obj = BeautifulSoup(req.text, "lxml")
+        LOG.warning("Request failed when trying to index %s", url)
+        return None
+    return Page(url, req.status_code, req.headers.get('content-type', ''), text, truncated)
+
+
+def get_page(url, cache=None):
+    if cache is not None:
+        return cache.get(url)
+    return fetch_page(url)
+
+
+def BS_parse(url, cache=None):
+    page = get_page(url, cache)
+    if page is None:
+        return False, page
+    if page.status_code != 200:
+        LOG.warning("%s has a status code of %s, omitted from database.", page.url, page.status_code)
+        return False, page
+    bs_obj = page.soup
     #print(bs_obj.prettify())
-    return bs_obj, req
+    return bs_obj, page
 
 
-def extract_links(url):
+def extract_links(url, cache=None):
     links = []
-    print("Extracting links from",url)
+    LOG.debug("Extracting links from %s", url)
     # Ensure we only process OMD links (we should anyway, but you never know...)
     if not url.startswith(OMD_PATH):
         return links
-    try:
-        if url.endswith('?direct'):
-            req = requests.get(url, timeout=10, headers={'Authorization': 'token:'+AUTH_TOKEN})
-        else:
-            req = requests.get(url, timeout=10)
-        if "text/html" not in req.headers["content-type"]:
-            print(url, "not a HTML document...")
-            return links
-    except Exception:
+    page = get_page(url, cache)
+    if page is None or page.status_code != 200:
+        return links
+    if "text/html" not in page.content_type:
+        LOG.debug("%s is not a HTML document.", url)
         return links
-    bs_obj = BeautifulSoup(req.text, "lxml")
+    bs_obj = page.soup
     if not bs_obj:
         return links
     hrefs = bs_obj.findAll('a', href=True)
@@ -79,19 +230,19 @@ def extract_links(url):
     return links
 
 
-def extract_html(url):
+def extract_html(url, cache=None):
     '''From history info, extract url, title and body of page,
-    cleaned with BeautifulSoup'''
+    cleaned with BeautifulSoup, and whether the download was truncated'''
     title = None
     body_str = ""
     snippet = ""
     language = LANGS[0] #Hack
     error = None
-    bs_obj, req = BS_parse(url)
+    bs_obj, page = BS_parse(url, cache)
     if not bs_obj:
-        logging.error(f"\t>> ERROR: extract_html: Failed to get BeautifulSoup object.")
+        LOG.error("extract_html: failed to get BeautifulSoup object for %s.", url)
         title = ""
-        return title, body_str, snippet, language
+        return title, body_str, snippet, language, False
     if url.startswith('http'):
         og_title = bs_obj.find("meta", property="og:title")
         og_description = bs_obj.find("meta", property="og:description")
@@ -118,10 +269,10 @@ def extract_html(url):
         #print("BODY",body_str)
         try:
             language = detect(title + " " + body_str)
-            logging.debug(f"\t>> INFO: Language for {url}: {language}")
+            LOG.debug("Language for %s: %s", url, language)
         except Exception:
             # Note, language will be assumed to be LANGS[0]
-            logging.error(f"\t>> ERROR: extract_html: Couldn't detect page language.")
+            LOG.error("extract_html: couldn't detect page language for %s.", url)
 
 
         # Process snippet
@@ -132,28 +283,26 @@ def extract_html(url):
     #print(title, body_str[:100])
     if not title:
         title = ' '.join(body_str.split()[:7])
-    return title, body_str, snippet, language
+    return title, body_str, snippet, language, page.truncated
 
 
 def extract_txt(url):
-    logging.info(f">> INDEXER: HTMLPARSER: extract_txt: url: {url}")
+    LOG.info("extract_txt: url: %s", url)
     title = url.split('/')[-1].split("?")[0] # read after the last slash, title is everything until any parameters (e.g. "?totext")
     body_str = ""
     snippet = ""
     language = LANGS[0]
-    logging.debug(f">> INDEXER: HTMLPARSER: extract_txt: title: {title}")
+    LOG.debug("extract_txt: title: %s", title)
     try:
-        req = requests.get(url, timeout=120, headers={'Authorization': 'token:'+AUTH_TOKEN})
-        req.encoding = 'utf-8'
+        _, body_str, truncated = fetch_capped(url, timeout=120, token=AUTH_TOKEN)
     except Exception:
-        return title, body_str, snippet, language
-    body_str = req.text
-    logging.debug(f">> INDEXER: HTMLPARSER: extract_txt: body: {body_str[:100]}")
+        return title, body_str, snippet, language, False
+    LOG.debug("extract_txt: body: %.100s", body_str)
     try:
         language = detect(body_str)
-        logging.debug(f">> INDEXER: HTMLPARSER: extract_txt: language: {language}")
+        LOG.debug("extract_txt: language: %s", language)
     except Exception:
-        logging.error(f">> ERROR: INDEXER: HTMLPARSER: extract_txt: couldn't detect page language for {url}.")
+        LOG.error("extract_txt: couldn't detect page language for %s.", url)
 
     snippet = ' '.join(body_str.split()[:50]).replace(',', '-')
-    return title, body_str, snippet, language
+    return title, body_str, snippet, language, truncated
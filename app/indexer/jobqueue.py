@@ -0,0 +1,178 @@
+# SPDX-FileCopyrightText: 2025 PeARS Project, <pears@possible-worlds.eu>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import os
+import logging
+from time import sleep
+from socket import gethostname
+from datetime import datetime, timedelta
+from multiprocessing import Process
+from sqlalchemy import func, or_, and_, exists, text
+from sqlalchemy.orm import aliased
+
+from app import app, db, INDEXING_WORKERS
+from app.api.models import Jobs
+from app.indexer.crawler import create_crawl_job, start_crawl_job, run_crawl_job, resume_crawl_jobs, worker_name, HEARTBEAT_INTERVAL
+
+LOG = logging.getLogger(__name__)
+
+# Interactive crawls go before scheduled refreshes
+PRIORITY_INTERACTIVE = 0
+PRIORITY_SCHEDULED = 10
+
+# A running job without heartbeat for this long belongs to a dead worker
+HEARTBEAT_TIMEOUT = 10 * HEARTBEAT_INTERVAL
+
+
+def submit_crawl_job(username, start_urls, force=False, priority=PRIORITY_INTERACTIVE):
+    """ Put a crawl job in the queue. Without worker
+    processes, the job is run in a thread of the current process.
+    Returns: the id of the job.
+    """
+    job_id = create_crawl_job(username, start_urls, force=force, priority=priority)
+    if INDEXING_WORKERS == 0:
+        start_crawl_job(job_id)
+    return job_id
+
+
+def submit_delete_job(username, prefixes):
+    """ Queue the removal of all urls under the given
+    prefixes from the index, e.g. when unsubscribing from
+    a site. Runs like a crawl job.
+    Returns: the id of the job.
+    """
+    job_id = create_crawl_job(username, prefixes, priority=PRIORITY_INTERACTIVE, kind='delete')
+    if INDEXING_WORKERS == 0:
+        start_crawl_job(job_id)
+    return job_id
+
+
+def submit_cleanup_job():
+    """ Queue the removal of empty pods and unsubscribed urls,
+    unless such a job is already waiting. It touches the pods of
+    all users, so it only runs when no other job does.
+    Returns: the id of the job.
+    """
+    job = db.session.query(Jobs).filter_by(kind='cleanup', status='queued').first()
+    if job is not None:
+        return job.id
+    return create_crawl_job(None, [], priority=PRIORITY_SCHEDULED, kind='cleanup')
+
+
+def claim_next_job(worker_id):
+    """ Atomically mark the next queued job as running for the given
+    worker. Jobs of a user who already has a running job are left in
+    the queue, so that two workers never write to the same pods.
+    Cleanup jobs run alone: they wait for running jobs to finish,
+    and no job starts while they run.
+    Returns: the id of the claimed job, or None.
+    """
+    other = aliased(Jobs)
+    any_running = exists().where(other.status == 'running')
+    cleanup_running = exists().where(other.status == 'running', other.kind == 'cleanup')
+    user_busy = exists().where(other.status == 'running', other.username == Jobs.username)
+    claimable = or_(and_(Jobs.kind == 'cleanup', ~any_running),
+            and_(Jobs.kind.is_distinct_from('cleanup'), ~cleanup_running, ~user_busy))
+    candidates = db.session.query(Jobs.id).filter(Jobs.status == 'queued', claimable) \
+            .order_by(func.coalesce(Jobs.priority, 0), Jobs.id).limit(5).all()
+    # Another job may have started since the query above,
+    # so the update itself checks again
+    for (job_id,) in candidates:
+        if db.engine.dialect.name == 'postgresql':
+            # Without this, two concurrent claims do not see each other
+            db.session.execute(text("SELECT pg_advisory_xact_lock(hashtext('pears_job_claim'))"))
+        claimed = db.session.query(Jobs).filter(Jobs.id == job_id, Jobs.status == 'queued', claimable) \
+                .update({'status': 'running', 'worker': worker_id, 'heartbeat': datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return job_id
+    return None
+
+
+def worker_alive(worker):
+    """ Check whether the process of a worker still exists.
+    Workers of other hosts cannot be checked, and are assumed
+    alive: their heartbeat tells when they are not.
+    """
+    host, _, pid = (worker or '').rpartition(':')
+    if host != gethostname():
+        return worker is not None
+    try:
+        os.kill(int(pid), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def requeue_stale_jobs():
+    """ Put jobs left running by dead workers back in the queue: their
+    process is gone from this host, or they have not sent a heartbeat
+    for HEARTBEAT_TIMEOUT seconds. Jobs of live workers are left alone.
+    Returns: the number of requeued jobs.
+    """
+    deadline = datetime.utcnow() - timedelta(seconds=HEARTBEAT_TIMEOUT)
+    n = 0
+    for job in db.session.query(Jobs).filter_by(status='running').all():
+        if job.heartbeat is not None and job.heartbeat >= deadline and worker_alive(job.worker):
+            continue
+        LOG.warning("Requeuing job %s of dead worker %s.", job.id, job.worker)
+        # Unless the worker has shown a sign of life meanwhile
+        n += db.session.query(Jobs).filter(Jobs.id == job.id, Jobs.status == 'running') \
+                .filter(Jobs.heartbeat.is_not_distinct_from(job.heartbeat)) \
+                .update({'status': 'queued', 'worker': None}, synchronize_session=False)
+    db.session.commit()
+    return n
+
+
+def worker_loop(poll_interval=2):
+    """ Main loop of an indexing worker process.
+    """
+    worker_id = worker_name()
+    # Indexing should not compete with searches for CPU
+    os.nice(10)
+    with app.app_context():
+        # Do not reuse the connections inherited from the parent process
+        db.engine.dispose(close=False)
+    LOG.info("Worker %s started", worker_id)
+    while True:
+        with app.app_context():
+            job_id = claim_next_job(worker_id)
+            if job_id is None:
+                requeue_stale_jobs()
+        if job_id is None:
+            sleep(poll_interval)
+            continue
+        LOG.info("Worker %s running job %s", worker_id, job_id)
+        try:
+            run_crawl_job(job_id)
+        except Exception:
+            LOG.exception("Worker %s crashed on job %s.", worker_id, job_id)
+
+
+def start_worker_pool(num_workers):
+    """ Start the indexing worker processes.
+    Returns: the list of processes.
+    """
+    with app.app_context():
+        requeue_stale_jobs()
+    processes = []
+    for _ in range(num_workers):
+        p = Process(target=worker_loop, daemon=True)
+        p.start()
+        processes.append(p)
+    return processes
+
+
+def start_job_runners():
+    """ Start whatever runs the jobs for this install: the
+    worker pool if configured, otherwise threads for the jobs
+    interrupted by a previous shutdown.
+    """
+    if INDEXING_WORKERS > 0:
+        return start_worker_pool(INDEXING_WORKERS)
+    with app.app_context():
+        requeue_stale_jobs()
+    return resume_crawl_jobs()
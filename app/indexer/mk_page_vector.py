@@ -4,15 +4,15 @@
 
 from os.path import dirname, join, realpath
 from scipy.sparse import csr_matrix, vstack, save_npz, load_npz
-from app import db, VEC_SIZE
-from app.api.models import sp
+from app import db, models, VEC_SIZE, POD_DIR
 from app.indexer.vectorizer import vectorize_scale
+from app.memory import held, matrix_bytes
 
 dir_path = dirname(dirname(realpath(__file__)))
-pod_dir = join(dir_path,'pods')
+pod_dir = POD_DIR
 
 def tokenize_text(lang, text):
-    sp.load(join(dir_path, f'api/models/{lang}/{lang}wiki.model'))
+    sp = models[lang]['tokenizer']
     text = ' '.join([wp for wp in sp.encode_as_pieces(text.lower())])
     #print("TOKENIZED",text)
     return text
@@ -37,7 +37,8 @@ def compute_vectors_local_docs(target_url, pod_path, title, description, doc, la
     pod_m = compute_vec(lang, text, pod_m)
     idv = pod_m.shape[0]-1
     #print("New pod shape",pod_m.shape,idv)
-    save_npz(join(pod_dir,pod_path+'.npz'),pod_m)
+    with held(matrix_bytes(pod_m), 'matrix'):
+        save_npz(join(pod_dir,pod_path+'.npz'),pod_m)
     return idv, text
 
 
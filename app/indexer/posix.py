@@ -1,17 +1,29 @@
 import joblib
-from os.path import join, dirname, realpath
-from app import models
+from os.path import join, getsize
+from app import db, models, POD_DIR
+from app.api.models import Pods
+from app.memory import held, postings_bytes
 
 def load_posix(pod_path):
-    dir_path = dirname(dirname(realpath(__file__)))
-    posix_path = join(dir_path,'pods')
-    posix = joblib.load(join(posix_path,pod_path+'.pos'))
+    posix = joblib.load(join(POD_DIR,pod_path+'.pos'))
     return posix
 
 def dump_posix(posindex, pod_path):
-    dir_path = dirname(dirname(realpath(__file__)))
-    posix_path = join(dir_path,'pods')
-    joblib.dump(posindex, join(posix_path,pod_path+'.pos'))
+    joblib.dump(posindex, join(POD_DIR,pod_path+'.pos'))
+
+
+def measure_posix(pod_path):
+    """ Size in memory of the postings of a pod, once unpickled.
+    """
+    return postings_bytes(load_posix(pod_path))
+
+
+def get_posix_bytes(pod_path):
+    """ Size in memory of the postings of a pod, as measured on its last
+    update. Pods never measured are counted at their size on disk.
+    """
+    nbytes = db.session.query(Pods.num_postings_bytes).filter_by(url=pod_path).scalar()
+    return nbytes or getsize(join(POD_DIR, pod_path+'.pos'))
 
 
 def posix_doc(text, doc_id, pod_path):
@@ -26,4 +38,5 @@ def posix_doc(text, doc_id, pod_path):
             posindex[token_id][doc_id] += f"|{pos}"
         else:
             posindex[token_id][doc_id] = f"{pos}"
-    dump_posix(posindex, pod_path)
+    with held(get_posix_bytes(pod_path), 'postings'):
+        dump_posix(posindex, pod_path)
@@ -3,10 +3,14 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 
 import logging
+from collections import deque
+from hashlib import sha1
+from tempfile import SpooledTemporaryFile
 from os.path import join, dirname, realpath
 from flask import url_for
 import xmltodict
 import requests
+from lxml import etree
 from datetime import datetime
 from pytz import timezone
 from langdetect import detect
@@ -14,23 +18,34 @@ from app.indexer.htmlparser import extract_txt, extract_html, extract_links
 from app import LANGS, OMD_PATH, AUTH_TOKEN, FILE_SIZE_LIMIT, IGNORED_EXTENSIONS, GATEWAY_TIMEZONE
 from app.utils_db import uptodate, check_group_is_subscribed, create_pod
 from app.utils import clean_comma_separated_name, mk_group_name, get_device_from_url
+from app.gateway import gateway
 
 app_dir_path = dirname(dirname(realpath(__file__)))
 user_app_dir_path = join(app_dir_path,'userdata')
 
-def get_xml(xml_url, token=AUTH_TOKEN):
+LOG = logging.getLogger(__name__)
+
+# Bytes of a buffered listing kept in memory, the rest goes to disk
+LISTING_SPOOL_BYTES = 4 * 1024 * 1024
+
+def get_xml(xml_url, token=AUTH_TOKEN, etag=None, last_modified=None):
     ''' Get a pseudo-xml file from OnMyDisk, which will contain the content of a particular
-    user directory.
+    user directory. If validators from a previous crawl are given, the request is made
+    conditional, and the gateway may answer with 304 Not Modified.
     '''
     xml = None
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
     try:
         #xml = requests.get(xml_url, timeout=120, \
         #        headers={'Authorization': 'token:'+token}, stream =True).raw
         #print(xml.read())
-        xml = requests.get(xml_url, timeout=120, headers={'Authorization': 'token:'+token}, stream =True).raw
-    except RuntimeError as e:
-        logging.error(">> ERROR: SPIDER: GET XML: Request failed. Moving on.")
-        logging.error(">> MSG: %e", e)
+        xml = gateway.get(xml_url, timeout=120, token=token, headers=headers, stream=True).raw
+    except (RuntimeError, requests.exceptions.RequestException) as e:
+        LOG.error("get_xml: request for %s failed. Moving on. %s", xml_url, e)
     return xml
 
 def read_xml(xml):
@@ -44,8 +59,7 @@ def read_xml(xml):
         xml_content = xml_content.replace(b'&',b' and ')
         parse = xmltodict.parse(xml_content)
     except RuntimeError as e:
-        logging.error(">> ERROR: SPIDER: PARSE XML: File may have some bad XML. Could not parse.")
-        logging.error(">> MSG: %e", e)
+        LOG.error("read_xml: file may have some bad XML. Could not parse. %s", e)
     return parse
 
 def get_docs_from_xml_parse(parse):
@@ -56,34 +70,119 @@ def get_docs_from_xml_parse(parse):
     try:
         docs = parse['omd_index']['doc']
     except RuntimeError as e:
-        logging.error(">> ERROR: SPIDER: get docs from xml parse: No documents found in the XML.")
-        logging.error(">> MSG: %e", e)
+        LOG.error("get_docs_from_xml_parse: no documents found in the XML. %s", e)
     return docs
 
 
-def process_xml(xml_url):
-    ''' Call xml processing functions to get metadata about documents in a given directory.
-    Return: a list of documents for that directory as well as the directory of xml_url.
+def doc_element_to_dict(elem):
+    ''' Turn a <doc> element into the dictionary format returned by
+    xmltodict, i.e. attributes prefixed with '@' and child elements
+    mapped to their (stripped) text, or None if empty.
     '''
-    logging.info("\n>> INDEXER: SPIDER: xml_parse: Running OMD parse on "+xml_url)
-    urldir = '/'.join(xml_url.split('/')[:-1])
-    docs = []
-
-    xml = get_xml(xml_url)
-    if xml is None:
-        return docs, urldir
-    
-    parse = read_xml(xml)
-    if parse is None:
-        return docs, urldir
+    doc = {'@'+k: v for k, v in elem.attrib.items()}
+    for child in elem:
+        if not isinstance(child.tag, str):
+            continue
+        text = child.text.strip() if child.text else None
+        doc[child.tag] = text or None
+    return doc
+
+
+def iter_docs_from_xml(xml, chunk_size=65536, digest=None):
+    ''' Incrementally parse the xml for a particular user directory.
+    The xml is read in chunks from the (streamed) response, so documents
+    are yielded as soon as they have been downloaded and only one <doc>
+    element is held in memory at a time. If a hashlib object is passed
+    as digest, it is updated with the raw content of the listing.
+    Return: a generator over dictionaries, one dictionary per document.
+    '''
+    parser = etree.XMLPullParser(events=('end',), tag='doc', recover=True)
+
+    def pop_docs():
+        for _, elem in parser.read_events():
+            # Truncated docs recovered from bad xml have no url
+            if 'url' in elem.attrib:
+                yield doc_element_to_dict(elem)
+            # Free the element and the already processed siblings
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
 
-    docs = get_docs_from_xml_parse(parse)
-    if docs is None:
-        return docs, urldir
+    try:
+        while True:
+            chunk = xml.read(chunk_size)
+            if not chunk:
+                break
+            if digest is not None:
+                digest.update(chunk)
+            parser.feed(chunk.replace(b'&',b' and '))
+            yield from pop_docs()
+        parser.close()
+        yield from pop_docs()
+    except Exception as e:
+        LOG.error("iter_docs_from_xml: could not read or parse the XML stream. %s", e)
+
+
+class XmlListing:
+    ''' Iterable over the docs of a streamed directory listing.
+    Besides the docs, it records the HTTP validators returned by the
+    gateway and, once iterated over (or buffered), a fingerprint of the
+    listing content.
+    '''
 
-    if not isinstance(docs, list):
-        docs = [docs]
-    return docs, urldir
+    def __init__(self, xml=None):
+        self.xml = xml
+        self.failed = xml is None
+        self.not_modified = False
+        self.etag = None
+        self.last_modified = None
+        self.digest = sha1()
+        self.buffered = False
+        if xml is not None:
+            status = getattr(xml, 'status', None) or 200
+            self.failed = status >= 400
+            self.not_modified = status == 304
+            headers = getattr(xml, 'headers', None) or {}
+            self.etag = headers.get('ETag')
+            self.last_modified = headers.get('Last-Modified')
+
+    def __iter__(self):
+        if self.failed or self.not_modified:
+            return iter(())
+        return iter_docs_from_xml(self.xml, digest=None if self.buffered else self.digest)
+
+    def buffer(self, chunk_size=65536):
+        ''' Download the whole listing before any doc is read, so that
+        its fingerprint is known first. The listing is kept in a
+        temporary file, which only stays in memory while small.
+        '''
+        if self.failed or self.not_modified or self.buffered:
+            return
+        spool = SpooledTemporaryFile(max_size=LISTING_SPOOL_BYTES)
+        while True:
+            chunk = self.xml.read(chunk_size)
+            if not chunk:
+                break
+            self.digest.update(chunk)
+            spool.write(chunk)
+        spool.seek(0)
+        self.xml = spool
+        self.buffered = True
+
+    @property
+    def fingerprint(self):
+        return self.digest.hexdigest()
+
+
+def process_xml(xml_url, etag=None, last_modified=None):
+    ''' Call xml processing functions to get metadata about documents in a given directory.
+    Return: an XmlListing over the documents for that directory as well as the directory of xml_url.
+    Documents are yielded as the listing is being downloaded.
+    '''
+    LOG.info("process_xml: running OMD parse on %s", xml_url)
+    urldir = '/'.join(xml_url.split('/')[:-1])
+    xml = get_xml(xml_url, etag=etag, last_modified=last_modified)
+    return XmlListing(xml), urldir
 
 
 def get_doc_url(doc, urldir):
@@ -109,7 +208,7 @@ def get_doc_url(doc, urldir):
         url = join(OMD_PATH, url)
     else:
         url = join(urldir, url)
-    logging.info(">> INDEXER: SPIDER: get url from doc: doc url: "+url)
+    LOG.info("get_doc_url: doc url: %s", url)
    
    # Is this item a folder description?
     is_folder_description = url.endswith("?description")
@@ -127,14 +226,13 @@ def get_doc_url(doc, urldir):
 def assess_convertibility(doc):
     convertible = False
     try:
-        logging.info(f">> SPIDER: ASSESS CONVERTIBILITY: {doc.get('@convertible')}")
+        LOG.info("assess_convertibility: %s", doc.get('@convertible'))
         convertible_str = doc.get("@convertible")
         assert convertible_str in ["True", "False", None]
         convertible = True if convertible_str == "True" else False 
   
     except RuntimeError as error:
-        logging.info(">> SPIDER: ASSESS CONVERTIBILITY: No convertibility found.")
-        logging.info(error)
+        LOG.info("assess_convertibility: no convertibility found. %s", error)
     return convertible
 
 
@@ -142,25 +240,23 @@ def get_doc_content_type(doc, url):
     content_type = None
     islink = False
     try:
-        logging.info(f">> SPIDER: GET DOC CONTENTTYPE: {doc['@contentType']}")
+        LOG.info("get_doc_content_type: %s", doc['@contentType'])
         content_type = doc['@contentType']
         if content_type in ['folder','desktop']:
             if join(OMD_PATH,'shared') not in url:
                 islink = True
     except RuntimeError as error:
-        logging.info(">> SPIDER: OMD_PARSE: DOC CONTENTTYPE: No contentType")
-        logging.info(error)
+        LOG.info("get_doc_content_type: no contentType. %s", error)
     return content_type, islink
 
 
 def get_doc_title(doc, url):
     title = None
     try:
-        logging.info(f">> SPIDER: GET DOC TITLE: {doc['title']}")
+        LOG.info("get_doc_title: %s", doc['title'])
         title = doc['title']
     except RuntimeError as error:
-        logging.info(">> SPIDER: GET DOC TITLE: No title")
-        logging.info(error)
+        LOG.info("get_doc_title: no title. %s", error)
     if title is None:
         is_folder_description = url.endswith("?description")
         if is_folder_description:
@@ -171,49 +267,50 @@ def get_doc_title(doc, url):
 def get_doc_description(doc, title):
     description = ""
     try:
-        logging.info(f">> SPIDER: GET DOC DESCRIPTION: {doc['description'][:100]}")
+        LOG.info("get_doc_description: %.100s", doc['description'])
         if title != doc['description']:
             description = title + ' ' + doc['description']
         else:
             description = doc['description']
-        logging.info("\t"+description+"\n")
+        LOG.debug("get_doc_description: %s", description)
     except:
-        logging.info(">> SPIDER: GET DOC DESCRIPTION: No description")
+        LOG.info("get_doc_description: no description")
     return description
 
 
-def get_doc_content(url, convertible, content_type):
+def get_doc_content(url, convertible, content_type, cache=None):
     title = ""
     body_str = ""
     language = LANGS[0]
+    truncated = False
     is_folder_description = url.endswith("?description")
     
     if convertible:
-        title, body_str, _, language = extract_txt(url + "?totext")
+        title, body_str, _, language, truncated = extract_txt(url + "?totext")
     elif is_folder_description:
-        _, body_str, _, language = extract_txt(url + "?description")
+        _, body_str, _, language, truncated = extract_txt(url + "?description")
     elif content_type in ['text/plain', 'text/x-tex']:
         if url.startswith(join(OMD_PATH,'shared')) or url.startswith(join(OMD_PATH,'sites')):
-            title, body_str, _, language = extract_txt(url + "?direct")
+            title, body_str, _, language, truncated = extract_txt(url + "?direct")
         else:
-            title, body_str, _, language = extract_txt(url)
+            title, body_str, _, language, truncated = extract_txt(url)
     elif content_type in ['text/html']:
         #print(">> Calling extract_html")
-        title, body_str, _, language = extract_html(url)
+        title, body_str, _, language, truncated = extract_html(url, cache)
 
     # Hack. Revert to main language if language is not installed
     if language not in LANGS:
-        logging.info(">> SPIDER: LANGUAGE: language is not in LANGS, reverting to default.")
+        LOG.info("get_doc_content: language %s is not in LANGS, reverting to default.", language)
         language = LANGS[0]
 
-    return title, body_str, language
+    return title, body_str, language, truncated
 
 def get_doc_owner(doc):
     owner = ""
     try:
         owner = doc['@owner']
     except:
-        logging.info(">> SPIDER: GET DOC OWNER: No owner found.")
+        LOG.info("get_doc_owner: no owner found.")
     return owner
 
 def get_doc_shared_with(doc):
@@ -222,7 +319,7 @@ def get_doc_shared_with(doc):
         group = doc['@shared_with']
         group = clean_comma_separated_name(group)
     except:
-        logging.info(">> SPIDER: GET DOC SHARED_WITH: No group found.")
+        LOG.info("get_doc_shared_with: no group found.")
     return group
 
 def get_last_modified(doc):
@@ -230,7 +327,7 @@ def get_last_modified(doc):
     try:
         last_modified = doc['@last_modified']
     except:
-        logging.info(">> SPIDER: GET LAST MODIFIED: No date found.")
+        LOG.info("get_last_modified: no date found.")
         return None
     gt_tz = timezone(GATEWAY_TIMEZONE)
     last_modified = datetime.strptime(last_modified, '%Y-%m-%d %H:%M:%S')
@@ -252,7 +349,23 @@ def clean_url_and_snippets(url, body_str, description, title):
         snippet = ' '.join(body_str.split()[:50])
     return url, title, description, snippet, body_str
 
-def get_doc_info(doc, urldir):
+def in_unsubscribed_group(url, owner, group):
+    return owner != group and not check_group_is_subscribed(group) and not url.startswith(join(OMD_PATH,"sites"))
+
+def get_subfolder(doc, urldir):
+    ''' Return: the url of a doc if it is a subfolder to crawl,
+    whether or not its own entry is up to date, otherwise None.
+    '''
+    url, process = get_doc_url(doc, urldir)
+    _, islink = get_doc_content_type(doc, url)
+    if not process or not islink:
+        return None
+    owner = get_doc_owner(doc)
+    if in_unsubscribed_group(url, owner, mk_group_name(owner, get_doc_shared_with(doc))):
+        return None
+    return url[:-7] if url.endswith('?direct') else url
+
+def get_doc_info(doc, urldir, cache=None):
     url, process = get_doc_url(doc, urldir)
     if not process:
         return None
@@ -263,8 +376,8 @@ def get_doc_info(doc, urldir):
     #print(f"\n>> {url} {group} {owner} {shared_with}")
 
     #If document belong to a group that is currently unsubscribed, ignore
-    if owner != group and  not check_group_is_subscribed(group) and not url.startswith(join(OMD_PATH,"sites")):
-        print(f">> {url} is in an unsubscribed group. Returning none.")
+    if in_unsubscribed_group(url, owner, group):
+        LOG.debug("%s is in an unsubscribed group. Returning none.", url)
         return None
     if last_modified is not None and uptodate(url, last_modified, group):
         #print(f">> {url} is up to date. Returning none.")
@@ -274,7 +387,7 @@ def get_doc_info(doc, urldir):
     content_type, islink = get_doc_content_type(doc, url)
     title = get_doc_title(doc, url)
     description = get_doc_description(doc, title)
-    body_title, body_str, language = get_doc_content(url, convertible, content_type)
+    body_title, body_str, language, truncated = get_doc_content(url, convertible, content_type, cache)
 
     #Body title for a site is the open graph title, which we assume is the best title option
     if url.startswith(join(OMD_PATH,'sites')) and body_title:
@@ -282,17 +395,30 @@ def get_doc_info(doc, urldir):
     if not title:
         title = ' '.join(body_str.split()[:7])
     url, title, description, snippet, body_str = clean_url_and_snippets(url, body_str, description, title)
-    return url, group, islink, title, description, snippet, body_str, language
-
-def process_html_links(url):
-    links = extract_links(url)
-    processed_links = [url[:-7]] #url ends in ?direct
-    for link in links:
-        if link not in processed_links:
-            processed_links.append(link)
-            links.extend(extract_links(link))
-            links = list(set(links))
-        if set(links) == set(processed_links):
-            break
+    return url, group, islink, title, description, snippet, body_str, language, content_type, truncated
+
+def may_link_to_pages(url, content_type):
+    ''' Whether a doc may link to other pages. Only html docs and
+    site folders, which are served as their index page, do.
+    '''
+    if content_type in ['text/html', None]:
+        return True
+    return content_type in ['folder', 'desktop'] and url.startswith(join(OMD_PATH,'sites'))
+
+def process_html_links(url, cache=None):
+    ''' Recursively collect the OMD pages reachable from an html doc.
+    Args: the doc url, ending in ?direct, and an optional page cache.
+    Return: the list of linked pages, excluding the doc itself.
+    '''
+    visited = {url[:-7]} #url ends in ?direct
+    queue = deque(extract_links(url, cache))
+    links = []
+    while queue:
+        link = queue.popleft()
+        if link in visited:
+            continue
+        visited.add(link)
+        links.append(link)
+        queue.extend(extract_links(link, cache))
     return links
 
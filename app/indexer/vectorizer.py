@@ -4,8 +4,6 @@
 
 import numpy as np
 from scipy.sparse import csr_matrix, vstack
-from sklearn.feature_extraction.text import CountVectorizer
-from sklearn import preprocessing
 from app import models
 
 
@@ -56,6 +54,7 @@ def vectorize(lang, text, logprob_power, top_words):
     return np.asarray(dataset)
 
 def scale(dataset):
+    from sklearn import preprocessing
     #scaler = preprocessing.MinMaxScaler().fit(dataset)
     scaler = preprocessing.Normalizer(norm='l2').fit(dataset)
     return scaler.transform(dataset)
@@ -0,0 +1,137 @@
+# SPDX-FileCopyrightText: 2025 PeARS Project, <pears@possible-worlds.eu>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+""" Memory accounting for searches and crawls. The pod matrices and
+postings loaded by a request are charged to its account while they are
+held, so that the most pod data held at once is known per request.
+With a budget, a search admits pods until their decoded size adds up to
+the budget, and leaves out the others instead of growing until the
+process is killed. Accounts only count pod data, not every allocation
+of the process.
+"""
+
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+import numpy as np
+from sys import getsizeof
+from scipy.sparse import issparse
+from app.metrics import POD_DECODED_BYTES, PEAK_POD_BYTES, PODS_SKIPPED
+from app.tracing import current_span
+
+LOG = logging.getLogger(__name__)
+
+# Account of the request being run, if any
+current_account = ContextVar('current_account', default=None)
+
+
+class MemoryAccount:
+    """ Bytes of pod data held by a request, and the most it held
+    at once. The budget caps the total decoded size of the pods a
+    request admits, whichever stage loads them. A budget of 0 means
+    no limit.
+    """
+
+    def __init__(self, name, budget=0):
+        self.name = name
+        self.budget = budget
+        self.held = 0
+        self.peak = 0
+        self.skipped = 0
+        self.admitted = {}
+
+    def admit(self, pod_name, nbytes):
+        """ Returns: whether the pod fits in the budget, along
+        with the pods already admitted. A pod is only charged once.
+        """
+        if pod_name in self.admitted:
+            return True
+        if self.budget > 0 and sum(self.admitted.values()) + nbytes > self.budget:
+            return False
+        self.admitted[pod_name] = nbytes
+        return True
+
+    def charge(self, nbytes):
+        self.held += nbytes
+        self.peak = max(self.peak, self.held)
+
+    def release(self, nbytes):
+        self.held -= nbytes
+
+
+def matrix_bytes(m):
+    if issparse(m):
+        return sum(getattr(m, a).nbytes for a in ['data', 'indices', 'indptr', 'row', 'col'] if hasattr(m, a))
+    return np.asarray(m).nbytes
+
+
+def postings_bytes(posindex):
+    """ Size in memory of a positional index: its token dicts,
+    doc ids and position strings.
+    """
+    total = getsizeof(posindex)
+    for postings in posindex:
+        total += getsizeof(postings) + getsizeof(0) * len(postings) + sum(map(getsizeof, postings.values()))
+    return total
+
+
+def npz_decoded_bytes(npz_path):
+    """ Estimate the size in memory of a pod matrix from the index
+    arrays of its npz file, without decompressing its data.
+    """
+    with np.load(npz_path) as f:
+        if 'indptr' in f.files:
+            indptr = f['indptr']
+            return int(indptr[-1]) * 12 + indptr.nbytes
+        return f['row'].shape[0] * 16
+
+
+@contextmanager
+def memory_account(name, budget=0):
+    """ Charge the pod data loaded in this block, or in a function
+    when used as a decorator, to a new account. Its peak is recorded
+    in Prometheus, and in the current trace if there is one.
+    """
+    account = MemoryAccount(name, budget)
+    token = current_account.set(account)
+    try:
+        yield account
+    finally:
+        current_account.reset(token)
+        PEAK_POD_BYTES.labels(name).observe(account.peak)
+        parent = current_span.get()
+        if parent is not None:
+            parent.attrs.update(peak_pod_bytes=account.peak, pods_skipped=account.skipped)
+        if account.skipped:
+            LOG.warning("%s: %s pods left out to stay within a memory budget of %s bytes.",
+                    name, account.skipped, budget)
+
+
+def admit_pod(pod_name, nbytes):
+    account = current_account.get()
+    return account is None or account.admit(pod_name, nbytes)
+
+
+def skip_pod(pod_name, stage):
+    account = current_account.get()
+    if account is not None:
+        account.skipped += 1
+    PODS_SKIPPED.labels(stage).inc()
+    LOG.info("%s: leaving out pod %s, over the memory budget.", stage, pod_name)
+
+
+@contextmanager
+def held(nbytes, kind):
+    """ Charge nbytes of pod data of the given kind ('matrix' or
+    'postings') to the current account while this block runs.
+    """
+    POD_DECODED_BYTES.labels(kind).observe(nbytes)
+    account = current_account.get()
+    if account is not None:
+        account.charge(nbytes)
+    try:
+        yield
+    finally:
+        if account is not None:
+            account.release(nbytes)
@@ -0,0 +1,73 @@
+# SPDX-FileCopyrightText: 2025 PeARS Project, <pears@possible-worlds.eu>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+""" Prometheus metrics for search, indexing, gateway calls and pod
+storage. When PROMETHEUS_MULTIPROC_DIR is set, each worker process
+writes its samples to that directory and /metrics aggregates them,
+so that the numbers are right under several web or indexing workers.
+"""
+
+import os
+from pathlib import Path
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess, REGISTRY
+
+# Samples of worker processes are written to this directory
+if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+    Path(os.getenv('PROMETHEUS_MULTIPROC_DIR')).mkdir(parents=True, exist_ok=True)
+
+# Buckets in seconds, from cache hits to slow crawls
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Buckets in bytes, from 64KB to 4GB
+MEMORY_BUCKETS = tuple(2 ** i for i in range(16, 34, 2))
+
+SEARCH_SECONDS = Histogram('pears_search_seconds', 'Time to answer a search query',
+        buckets=LATENCY_BUCKETS)
+SEARCH_STAGE_SECONDS = Histogram('pears_search_stage_seconds', 'Time spent in each stage of a search',
+        ['stage'], buckets=LATENCY_BUCKETS)
+INDEXING_STAGE_SECONDS = Histogram('pears_indexing_stage_seconds', 'Time spent in each stage of indexing a doc',
+        ['stage'], buckets=LATENCY_BUCKETS)
+CRAWL_FOLDER_SECONDS = Histogram('pears_crawl_folder_seconds', 'Time to crawl one folder',
+        buckets=LATENCY_BUCKETS)
+DOCS_INDEXED = Counter('pears_docs_indexed', 'Docs written to the index')
+GATEWAY_REQUEST_SECONDS = Histogram('pears_gateway_request_seconds', 'Latency of requests to the gateway',
+        ['method', 'host'], buckets=LATENCY_BUCKETS)
+GATEWAY_ERRORS = Counter('pears_gateway_errors', 'Gateway requests that failed or returned a 5xx',
+        ['method', 'host'])
+POD_LOAD_BYTES = Counter('pears_pod_load_bytes', 'Bytes of pod matrices loaded from disk',
+        ['stage'])
+CACHE_REQUESTS = Counter('pears_cache_requests', 'Cache lookups, by cache and result',
+        ['cache', 'result'])
+POD_DECODED_BYTES = Histogram('pears_pod_decoded_bytes', 'Size in memory of each pod matrix or postings list loaded',
+        ['kind'], buckets=MEMORY_BUCKETS)
+PEAK_POD_BYTES = Histogram('pears_peak_pod_bytes', 'Most pod data held at once by a search or a crawled folder',
+        ['operation'], buckets=MEMORY_BUCKETS)
+PODS_SKIPPED = Counter('pears_pods_skipped', 'Pods left out of a search to stay within its memory budget',
+        ['stage'])
+CACHE_ENTRIES = Gauge('pears_cache_entries', 'Entries held in each cache',
+        ['cache'], multiprocess_mode='livesum')
+CACHE_BYTES = Gauge('pears_cache_bytes', 'Bytes held in each cache',
+        ['cache'], multiprocess_mode='livesum')
+
+
+def record_cache(cache, hit):
+    CACHE_REQUESTS.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+def record_gateway_request(method, host, seconds, error):
+    GATEWAY_REQUEST_SECONDS.labels(method, host).observe(seconds)
+    if error:
+        GATEWAY_ERRORS.labels(method, host).inc()
+
+
+def metrics_response():
+    """ Returns: the body and content type of a /metrics scrape,
+    aggregated over all processes in multiprocess mode.
+    """
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -1,3 +1,12 @@
+import os
+import hashlib
+import logging
+import zipfile
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+
 def read_vocab(vocab_file):
     c = 0
     vocab = {}
@@ -17,6 +26,37 @@ def read_vocab(vocab_file):
             c+=1
     return vocab, reverse_vocab, logprobs
 
+def load_vocab(vocab_file):
+    ''' Read a vocab through a binary cache, written next to the
+    text file on first use. The cache holds a checksum of the text
+    file and is rebuilt when the file changes.
+    Returns: the same as read_vocab.
+    '''
+    with open(vocab_file, 'rb') as f:
+        checksum = hashlib.sha256(f.read()).hexdigest()
+    cache_file = vocab_file + '.npz'
+    try:
+        with np.load(cache_file, allow_pickle=False) as cache:
+            if str(cache['checksum']) == checksum:
+                pieces = cache['pieces'].tolist()
+                vocab = {wp: i for i, wp in enumerate(pieces)}
+                return vocab, dict(enumerate(pieces)), cache['logprobs'].tolist()
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        pass
+    vocab, reverse_vocab, logprobs = read_vocab(vocab_file)
+    # Written aside and renamed, so that workers starting together
+    # never read a half-written cache
+    tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, checksum=np.array(checksum), logprobs=np.array(logprobs),
+                    pieces=np.array([reverse_vocab[i] for i in range(len(reverse_vocab))]))
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        LOG.warning("Could not write vocab cache %s: %s", cache_file, e)
+    return vocab, reverse_vocab, logprobs
+
+
 def read_pearsignore():
     ignored_extensions = []
     with open('conf/.pearsignore') as f:
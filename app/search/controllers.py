@@ -15,7 +15,8 @@ from app.forms import SearchForm
 from app.utils import get_language, beautify_snippet, beautify_title
 from app.search.score_pages import run_search
 from app.auth.controllers import login_required
-from app import SERVER_HOST, OMD_PATH, LANGS
+from app import SERVER_HOST, OMD_PATH, LANGS, LOCAL_MODE, POD_DIR
+from app.tracing import trace, span
 
 LOG = logging.getLogger(__name__)
 
@@ -23,7 +24,7 @@ LOG = logging.getLogger(__name__)
 search = Blueprint('search', __name__, url_prefix='')
 
 dir_path = dirname(dirname(dirname(realpath(__file__))))
-pod_dir = join(dir_path,'app','pods')
+pod_dir = POD_DIR
 
 
 @search.route('/', methods=['GET','POST'])
@@ -55,12 +56,18 @@ def user():
         placeholder = app.config['SEARCH_PLACEHOLDER']
         searchform.query(render_kw={"placeholder": placeholder})
         return render_template("search/user.html", searchform=searchform, placeholder=placeholder), 200
-    results = run_user_search(query)
-    if len(results) == 0:
-        results = None
+    with trace('user search', enabled=trace_requested(), profile=bool(request.args.get('profile'))) as root:
+        results = run_user_search(query)
+        if len(results) == 0:
+            results = None
+        if gui:
+            displayresults = prepare_gui_results(query, results)
+            with span('render_template'):
+                page = render_template('search/results.html', query=query, results=displayresults, searchform=searchform)
+    if root is not None:
+        return jsonify(root.as_dict())
     if gui:
-        displayresults = prepare_gui_results(query, results)
-        return render_template('search/results.html', query=query, results=displayresults, searchform=searchform)
+        return page
     r = app.make_response(jsonify(results))
     r.mimetype = "application/json"
     return r
@@ -82,17 +89,32 @@ def anonymous():
         placeholder = app.config['SEARCH_PLACEHOLDER']
         searchform.query(render_kw={"placeholder": placeholder})
         return render_template("search/anonymous.html", searchform=searchform, placeholder=placeholder), 200
-    results = run_anonymous_search(query)
-    if len(results) == 0:
-        results = None
+    with trace('anonymous search', enabled=trace_requested(), profile=bool(request.args.get('profile'))) as root:
+        results = run_anonymous_search(query)
+        if len(results) == 0:
+            results = None
+        if gui:
+            displayresults = prepare_gui_results(query, results)
+            with span('render_template'):
+                page = render_template('search/results.html', query=query, results=displayresults, searchform=searchform)
+    if root is not None:
+        return jsonify(root.as_dict())
     if gui:
-        displayresults = prepare_gui_results(query, results)
-        return render_template('search/results.html', query=query, results=displayresults, searchform=searchform)
+        return page
     r = app.make_response(jsonify(results))
     r.mimetype = "application/json"
     return r
 
 
+def trace_requested():
+    ''' Admins, or anyone in local mode, can get the timing tree of
+    a search instead of its results, with ?trace=1 or an X-PeARS-Trace
+    header. Adding ?profile=1 includes a cProfile of the request.'''
+    if not (request.args.get('trace') or request.headers.get('X-PeARS-Trace')):
+        return False
+    return LOCAL_MODE or bool(session.get('admin'))
+
+
 def run_user_search(query):
     url = OMD_PATH
     results = {}
@@ -104,7 +126,8 @@ def run_user_search(query):
     else:
         languages = [lang]
     for lang in languages:
-        r, s = run_search(query+' -'+lang, url_filter=[join(url,username), join(url, 'sites')])
+        with span('run_search', lang=lang):
+            r, s = run_search(query+' -'+lang, url_filter=[join(url,username), join(url, 'sites')])
         for k,v in r.items():
             if v is not None:
                 i = list(r.keys()).index(k)
@@ -128,7 +151,8 @@ def run_anonymous_search(query):
     else:
         languages = [lang]
     for lang in languages:
-        r, s = run_search(query+' -'+lang, url_filter=[url_shared, url_sites])
+        with span('run_search', lang=lang):
+            r, s = run_search(query+' -'+lang, url_filter=[url_shared, url_sites])
         results.update(r)
         scores.extend(s)
     results = order_results(results, scores)
@@ -143,7 +167,7 @@ def order_results(results, scores):
             url = list(results.keys())[i]
             sorted_results[url] = results[url]
         except:
-            logging.error(f">> ERROR: SEARCH: CONTROLLERS: sorted scores and results list do not have the same length.")
+            LOG.error("Sorted scores and results list do not have the same length.")
     return sorted_results
 
 
@@ -4,11 +4,16 @@
 
 import re
 import string
+import logging
 import numpy as np
+from scipy.sparse import issparse
 from scipy.spatial.distance import cdist
 from app import VEC_SIZE, models
 from app.indexer.posix import load_posix
 
+LOG = logging.getLogger(__name__)
+
+
 def jaccard(a, b):
     c = a.intersection(b)
     return float(len(c)) / (len(a) + len(b) - len(c))
@@ -52,7 +57,9 @@ def completeness(v, m):
     v_nz = v_nz.reshape(1,numcols)
     v_nz = np.where(v_nz > 0, 1, 0)
 
-    m_r = np.array(m[:,idx])
+    # Only the query columns are made dense
+    m_r = m[:,idx[0]]
+    m_r = m_r.toarray() if issparse(m_r) else np.array(m_r)
     m_r = m_r.reshape(m.shape[0],numcols)
     m_r = np.where(m_r > 0, 1, 0)
 
@@ -131,8 +138,7 @@ def posix(q, pod_name):
     # correspond to the query and return null doc_scores, which
     # halts further computation of scores in score_pages.py
     if any([i is None for i in query_vocab_ids]):
-        print("WARNING: there were unknown tokens in the query")
-        print(q.split(), query_vocab_ids)
+        LOG.debug("Unknown tokens in the query: %s %s", q.split(), query_vocab_ids)
         query_vocab_ids = [i for i in query_vocab_ids if i is not None]
         return doc_scores
 
@@ -2,7 +2,8 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-only
 
-from os.path import dirname, join, realpath
+import logging
+from os.path import dirname, join, realpath, getsize
 import multiprocessing
 import math
 import hashlib
@@ -11,19 +12,38 @@ from flask import session
 import joblib
 from joblib import Parallel, delayed
 import numpy as np
-from scipy.sparse import csr_matrix, load_npz
-from scipy.spatial import distance
+from scipy.sparse import csr_matrix, vstack, load_npz
 from app.api.models import Urls, Pods, Groups, Sites
-from app import app, db, tracker
-from app.utils import get_language, carbon_print, hash_username
+from app import app, db, SEARCH_MEMORY_BUDGET, POD_DIR
+from app.utils import get_language, hash_username
 from app.indexer.mk_page_vector import compute_query_vectors
 from app.search.overlap_calculation import generic_overlap, completeness, posix
+from app.carbon import carbon_task
+from app.metrics import SEARCH_SECONDS, SEARCH_STAGE_SECONDS, POD_LOAD_BYTES
+from app.tracing import span
+from app.indexer.posix import get_posix_bytes
+from app.memory import memory_account, held, admit_pod, skip_pod, matrix_bytes, npz_decoded_bytes
+
+LOG = logging.getLogger(__name__)
 
 dir_path = dirname(dirname(realpath(__file__)))
-pod_dir = join(dir_path,'pods')
+pod_dir = POD_DIR
+
+def cosines(query_vector, m):
+    """ Cosine of the query to each row of a sparse matrix, as
+    1 - cdist(query_vector, m.todense(), 'cosine') but without
+    making the matrix dense. Empty rows get nan, as with cdist.
+    """
+    q = np.asarray(query_vector).reshape(-1)
+    norms = np.sqrt(np.asarray(m.multiply(m).sum(axis=1)).reshape(-1)) * np.linalg.norm(q)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (m.dot(q) / norms).reshape(1, -1)
+
 
 def compute_scores(query, query_vector, tokenized, pod_name):
     """ Compute different scores for a query.
+    Pods that were not admitted within the memory budget
+    of the search are left out.
     """
     vec_scores = {}
     completeness_scores = {}
@@ -31,33 +51,46 @@ def compute_scores(query, query_vector, tokenized, pod_name):
 
     # Compute cosines and completeness using npz file
     try:
-        pod_m = load_npz(join(pod_dir,pod_name+'.npz'))
+        npz = join(pod_dir,pod_name+'.npz')
+        pos_bytes = get_posix_bytes(pod_name)
+        if not admit_pod(pod_name, npz_decoded_bytes(npz) + pos_bytes):
+            skip_pod(pod_name, 'score_docs')
+            return vec_scores, completeness_scores, posix_scores
+        pod_m = load_npz(npz)
+        POD_LOAD_BYTES.labels('score_docs').inc(getsize(npz))
     except:
-        print(">> SEARCH: SCORE_PAGES: compute_scores: pod does not exist.")
+        LOG.error("compute_scores: pod %s does not exist.", pod_name)
         return vec_scores, completeness_scores, posix_scores
-    m_cosines = 1 - distance.cdist(query_vector, pod_m.todense(), 'cosine')
-    m_completeness = completeness(query_vector, pod_m.todense())
+    with held(matrix_bytes(pod_m), 'matrix'):
+        m_cosines = cosines(query_vector, pod_m)
+        m_completeness = completeness(query_vector, pod_m)
 
-    # Compute posix scores
-    try:
-        posix_scores = posix(tokenized, pod_name)
-    except:
-        print(">> SEARCH: SCORE_PAGES: compute_scores: issue in posix computation.")
+        # Compute posix scores
+        try:
+            with span('posix'), held(pos_bytes, 'postings'):
+                posix_scores = posix(tokenized, pod_name)
+        except:
+            LOG.exception("compute_scores: issue in posix computation for pod %s.", pod_name)
+    num_rows = pod_m.shape[0]
+    del pod_m
 
     #If no document were found through posix, just exit
     if len(posix_scores) == 0:
-        print(">> SEARCH: SCORE_PAGES: compute_scores: no documents found via posix.")
+        LOG.debug("compute_scores: no documents found via posix in pod %s.", pod_name)
         return vec_scores, completeness_scores, posix_scores
 
+    #Map the rows of the matrix to their URLs, in one query
+    pod_urls = dict(db.session.query(Urls.vector, Urls.url).join(Pods, Urls.pod_id == Pods.id).filter(Pods.url == pod_name).all())
+
     #try:
-    for i in range(pod_m.shape[0]):
+    for i in range(num_rows):
         cos =  m_cosines[0][i]
         if  cos == 0 or math.isnan(cos):
             continue
         #Get doc idx for row i of the matrix
         #Retrieve corresponding URL
         #print(f"Looking for vector {i} on {pod_name}")
-        url = Urls.query.filter_by(pod=pod_name).filter_by(vector=i).first().url
+        url = pod_urls[i]
         #print(url)
         vec_scores[url] = cos
         completeness_scores[url] = m_completeness[0][i]
@@ -72,7 +105,7 @@ def get_user_pods(username, lang):
     npzs = []
     pods = []
     owner_hash = hash_username(username)
-    private_folders = Pods.query.filter(Pods.url.startswith(f"{owner_hash}/")).filter(Pods.url.endswith(f"/{lang}/user")).all()
+    private_folders = Pods.query.filter_by(name=owner_hash, language=lang, permission_class='user').all()
     for pf in private_folders:
         npzs.append(join(pod_dir, pf.url+'.npz'))
         pods.append(pf)
@@ -89,9 +122,9 @@ def get_group_pods(username, lang):
     for g in user_groups:
         members = [m.strip() for m in g.name.split(',')]
         if username in members:
-            group = Pods.query.filter(Pods.url.startswith(f"{g.identifier}/")).filter(Pods.url.endswith(f"/{lang}/group")).all()
+            group = Pods.query.filter_by(name=g.identifier, language=lang, permission_class='group').all()
             group_folders.extend(group)
-    print("GROUP FOLDERS", [group.url for group in group_folders])
+    LOG.debug("Group folders: %s", [group.url for group in group_folders])
     for gf in group_folders:
         npzs.append(join(pod_dir, gf.url+'.npz'))
         pods.append(gf)
@@ -131,7 +164,6 @@ def score_pods(query, query_vector, lang, username = None):
     Returns: a list of the best <max_pods: int> pods, or if all scores
     are under a certain threshold, the list of all pods.
     """
-    print(">> SEARCH: SCORE PAGES: SCORE PODS")
 
     max_pods = 3 # How many pods to return
     pod_scores = {}
@@ -155,33 +187,42 @@ def score_pods(query, query_vector, lang, username = None):
     #Get public files
     npzs.extend(glob(join(pod_dir, f"*/*/{lang}/others.npz")))
     npzs.extend(glob(join(pod_dir, f"*/*/{lang}/sites.npz")))
-    pods.extend(db.session.query(Pods).filter_by(language=lang).filter(Pods.url.endswith('/others')).all())
-    pods.extend(db.session.query(Pods).filter_by(language=lang).filter(Pods.url.endswith('/sites')).all())
+    pods.extend(db.session.query(Pods).filter_by(language=lang, permission_class='others').all())
+    pods.extend(db.session.query(Pods).filter_by(language=lang, permission_class='sites').all())
+    # Pods are admitted with their postings, which score_docs loads
+    # later. The user's own pods come first, and are the last to be
+    # left out when the memory budget is reached
     for npz in npzs:
         podname = npz.replace(pod_dir + "/", "").replace(".npz", "")
-        s = np.sum(load_npz(npz).toarray(), axis=0)
-        if np.sum(s) > 0:
+        if not admit_pod(podname, npz_decoded_bytes(npz) + get_posix_bytes(podname)):
+            skip_pod(podname, 'score_pods')
+            continue
+        pod_m = load_npz(npz)
+        with held(matrix_bytes(pod_m), 'matrix'):
+            s = csr_matrix(pod_m.sum(axis=0))
+        del pod_m
+        POD_LOAD_BYTES.labels('score_pods').inc(getsize(npz))
+        if s.sum() > 0:
             podsum.append(s)
             podnames.append(podname)
-    podsum = csr_matrix(podsum)
-    if np.sum(podsum) == 0:
+    if len(podsum) == 0:
         return best_pods
+    podsum = vstack(podsum).tocsr()
 
-    m_cosines = 1 - distance.cdist(query_vector, podsum.todense(), 'cosine')
+    m_cosines = cosines(query_vector, podsum)
 
     # For each pod, retrieve cosine to query
     for p in pods:
         if p.url in podnames:
             cosine_score = m_cosines[0][podnames.index(p.url)]
-            print(">> Exact matches:", p.url, cosine_score)
+            LOG.debug("Pod score: %s %s", p.url, cosine_score)
             if math.isnan(cosine_score):
                 cosine_score = 0
             pod_scores[p.url] = cosine_score
-    print("POD SCORES:",pod_scores)
     for k in sorted(pod_scores, key=pod_scores.get, reverse=True):
         if len(best_pods) < max_pods + 1:
             if pod_scores[k] > 0:
-                print("Appending pod",k)
+                LOG.debug("Appending pod %s", k)
                 best_pods.append(k)
         else:
             break
@@ -191,12 +232,13 @@ def score_pods(query, query_vector, lang, username = None):
 def score_docs(query, query_vector, tokenized, pod_name):
     '''Score documents for a query'''
     with app.app_context():
-        print("\nSEARCH: SCORE_PAGES: score_docs: scoring on", pod_name)
+        LOG.debug("score_docs: scoring on %s", pod_name)
         document_scores = {}  # Document scores
-        vec_scores, completeness_scores, posix_scores = \
-                compute_scores(query, query_vector, tokenized, pod_name)
+        with span('compute_scores', pod=pod_name):
+            vec_scores, completeness_scores, posix_scores = \
+                    compute_scores(query, query_vector, tokenized, pod_name)
         if len(vec_scores) == 0:
-            print(">> SEARCH: SCORE_PAGES: score_docs: vec_scores is empty.")
+            LOG.debug("score_docs: vec_scores is empty for pod %s.", pod_name)
             return document_scores
         for url in list(vec_scores.keys()):
             #print(">>>",url)
@@ -207,8 +249,7 @@ def score_docs(query, query_vector, tokenized, pod_name):
                 if u:
                     idx = u.id
                 else:
-                    print("ERROR: SEARCH: SCORE_PAGES: score_docs: could not find url in database")
-                    print(url)
+                    LOG.error("score_docs: could not find url %s in database", url)
                 document_scores[url] = 0.0
                 if idx in posix_scores:
                     document_scores[url]+=posix_scores[idx]
@@ -217,10 +258,7 @@ def score_docs(query, query_vector, tokenized, pod_name):
                     document_scores[url] = 0
                 snippet_score = generic_overlap(query, u.snippet)
                 document_scores[url]+=snippet_score
-                if idx in posix_scores:
-                    print(url, vec_scores[url], posix_scores[idx], document_scores[url], completeness_scores[url], snippet_score)
-                else:
-                    print(url, vec_scores[url], 0.0, document_scores[url], completeness_scores[url], snippet_score)
+                LOG.debug("%s %s %s %s %s %s", url, vec_scores[url], posix_scores.get(idx, 0.0), document_scores[url], completeness_scores[url], snippet_score)
             except:
                 continue
         return document_scores
@@ -228,7 +266,6 @@ def score_docs(query, query_vector, tokenized, pod_name):
 
 
 def return_best_urls(doc_scores, url_filter):
-    print(doc_scores)
     best_urls = []
     scores = []
     c = 0
@@ -256,38 +293,42 @@ def output(best_urls):
             url = db.session.query(Urls).filter_by(url=u).first().as_dict()
         except:
             url = None
-            print("ERROR: SEARCH: SCORE_PAGES: output: could not find url in database")
+            LOG.error("output: could not find url %s in database", u)
         results[u] = url
     return results
 
 
+@SEARCH_SECONDS.time()
+@carbon_task('search')
+@memory_account('search', SEARCH_MEMORY_BUDGET)
 def run_search(query, url_filter=None):
-    if tracker is not None:
-        task_name = "run search"
-        tracker.start_task(task_name)
     if 'username' in session:
         username = session['username']
     else:
         username = None
     document_scores = {}
-    query, lang = get_language(query)
-    print("Query/language:",query,lang)
-    q_vector, tokenized = compute_query_vectors(query, lang)
-    best_pods = score_pods(query, q_vector, lang, username)
-    print("\tQ:",query,"BEST PODS:",best_pods)
+    with SEARCH_STAGE_SECONDS.labels('tokenize').time():
+        with span('get_language'):
+            query, lang = get_language(query)
+        LOG.info("Query/language: %s %s", query, lang)
+        with span('compute_query_vectors'):
+            q_vector, tokenized = compute_query_vectors(query, lang)
+    with SEARCH_STAGE_SECONDS.labels('score_pods').time(), span('score_pods'):
+        best_pods = score_pods(query, q_vector, lang, username)
+    LOG.info("Query: %s, best pods: %s", query, best_pods)
 
     #max_thread = int(multiprocessing.cpu_count() * 0.5)
     max_thread = 1
-    with Parallel(n_jobs=max_thread, prefer="threads") as parallel:
-        delayed_funcs = [delayed(score_docs)(query, q_vector, tokenized, pod) for pod in best_pods]
-        scores = parallel(delayed_funcs)
-    for dic in scores:
-        document_scores.update(dic)
-    best_urls, scores = return_best_urls(document_scores, url_filter)
-    #print("UNIT TEST: LEN BEST URLS", len(best_urls), "LEN SCORES", len(scores))
-    results = output(best_urls)
+    with SEARCH_STAGE_SECONDS.labels('score_docs').time():
+        with Parallel(n_jobs=max_thread, prefer="threads") as parallel:
+            delayed_funcs = [delayed(score_docs)(query, q_vector, tokenized, pod) for pod in best_pods]
+            scores = parallel(delayed_funcs)
+        for dic in scores:
+            document_scores.update(dic)
+    with SEARCH_STAGE_SECONDS.labels('output').time():
+        best_urls, scores = return_best_urls(document_scores, url_filter)
+        #print("UNIT TEST: LEN BEST URLS", len(best_urls), "LEN SCORES", len(scores))
+        with span('hydrate', urls=len(best_urls)):
+            results = output(best_urls)
     #print("UNIT TEST: LEN BEST URLS", len(best_urls), "LEN SCORES", len(scores), "LEN RESULTS", len(results))
-    if tracker is not None:
-        search_emissions = tracker.stop_task()
-        carbon_print(search_emissions, task_name)
     return results, scores
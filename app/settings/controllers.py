@@ -6,31 +6,34 @@
 # Import flask dependencies
 import logging
 import requests
-import xmltodict
 from glob import glob
 from os import rename, getenv
 from os.path import dirname, realpath, join, isdir, exists
 from flask import Blueprint, request, render_template, redirect, session
 from app import db, OMD_PATH, AUTH_TOKEN
+from app.gateway import gateway
 from app.auth.controllers import login_required
-from app.api.models import Urls, Locations, Sites
+from app.api.models import Locations, Sites
 from app.utils import clean_comma_separated_name, init_crawl, mk_group_name
-from app.utils_db import update_locations_in_db, update_groups_in_db
-from app.indexer.spider import process_xml, get_doc_info, get_doc_owner, get_doc_shared_with, get_doc_url, get_doc_content_type
+from app.utils_db import update_locations_in_db, update_groups_in_db, get_index_stats
+from app.indexer.spider import process_xml, iter_docs_from_xml, get_doc_info, get_doc_owner, get_doc_shared_with, get_doc_url, get_doc_content_type
 
 # Define the blueprint:
 settings = Blueprint('settings', __name__, url_prefix='/settings')
 
 dir_path = dirname(dirname(realpath(__file__)))
 
+LOG = logging.getLogger(__name__)
+
 # Set the route and accepted methods
 @settings.route("/")
 @login_required
 def index():
     username = session.get('username')
-    num_user_files = len(Urls.query.filter(Urls.url.contains(f'/{username}/')).all())
-    num_shared_files = len(Urls.query.filter(Urls.url.contains(f'/shared/')).all())
-    num_subscribed_sites = len(Sites.query.filter(Sites.subscribed==True).all())
+    stats = get_index_stats(username)
+    num_user_files = stats['user']['num_urls']
+    num_shared_files = stats['classes'].get('others', {}).get('num_urls', 0)
+    num_subscribed_sites = stats['num_subscribed_sites']
     tree = return_location_graph()
     return render_template("settings/index.html", username=username, num_user_files=num_user_files, num_shared_files=num_shared_files, \
             num_subscribed_sites=num_subscribed_sites, tree=tree)
@@ -38,7 +41,7 @@ def index():
 @settings.route("/toggle-theme")
 def toggle_theme():
     current_theme = session.get("theme")
-    print(current_theme, request.args.get('current_page'))
+    LOG.debug("toggle_theme: %s %s", current_theme, request.args.get('current_page'))
     if current_theme == "dark":
         session["theme"] = "light"
     else:
@@ -48,20 +51,17 @@ def toggle_theme():
 
 def get_user_devices(username):
     xml_url = join(OMD_PATH, username)
-    xml = requests.get(xml_url, timeout=30, headers={'Authorization': 'token:'+AUTH_TOKEN}, stream=True).raw
-    xml_content = xml.read()
-    parse = xmltodict.parse(xml_content)
+    xml = gateway.get(xml_url, timeout=30, token=AUTH_TOKEN, stream=True).raw
     folders = []
-    try:
-        docs = parse['omd_index']['doc']
-    except:
-        logging.error(">> ERROR: SETTINGS: get docs from xml parse: No documents found in the XML.")
-    for d in docs:
+    for d in iter_docs_from_xml(xml):
         if '@url' in d:
             url = d['@url']
             if url != '?description' and not url.startswith('/shared/'):
                 url = join(xml_url, url)
                 folders.append(url)
+    if len(folders) == 0:
+        LOG.error("get_user_devices: no documents found in the XML.")
+        return folders
     update_locations_in_db(folders, device=True)
     return folders
 
@@ -90,19 +90,10 @@ def get_locations_and_groups(username=None, start_urls=None):
 
 def get_user_links(username):
     xml_url = join(OMD_PATH, username, 'links')
-    xml = requests.get(xml_url, timeout=30, headers={'Authorization': 'token:'+AUTH_TOKEN}, stream=True).raw
-    xml_content = xml.read()
-    docs = []
+    xml = gateway.get(xml_url, timeout=30, token=AUTH_TOKEN, stream=True).raw
     links = []
-    try:
-        parse = xmltodict.parse(xml_content)
-        print("LINKS")
-        print(parse)
-        docs = parse['omd_index']['doc']
-    except:
-        logging.error(">> ERROR: SETTINGS: get docs from xml parse: No documents found in the XML.")
-    for d in docs:
-        print(d)
+    for d in iter_docs_from_xml(xml):
+        LOG.debug("get_user_links: %s", d)
     return links
 
 
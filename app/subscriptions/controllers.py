@@ -4,15 +4,21 @@
 
 
 import logging
+import hashlib
+import threading
+from time import time
 import requests
 from os.path import dirname, realpath, join, isdir, exists
-from flask import Blueprint, request, render_template, redirect, session, url_for, flash
-from app import db, OMD_PATH, AUTH_TOKEN
+from flask import Blueprint, request, render_template, redirect, session, url_for, flash, jsonify
+from app import app, db, OMD_PATH, AUTH_TOKEN, SITES_CACHE_TTL
+from app.gateway import gateway
+from app.metrics import record_cache
 from app.api.models import Sites
 from app.auth.controllers import login_required
 from app.utils_db import update_sites_in_db, delete_urls_recursively
 from app.forms import ChoiceObj, SiteForm
-from app.indexer.controllers import run_indexing
+from app.indexer.controllers import run_indexing, deletion_job_response
+from app.indexer.jobqueue import submit_delete_job
 from app.indexer.spider import process_html_links
 from app.indexer.htmlparser import extract_html
 
@@ -21,6 +27,16 @@ subscriptions = Blueprint('subscriptions', __name__, url_prefix='/subscriptions'
 
 dir_path = dirname(dirname(realpath(__file__)))
 
+LOG = logging.getLogger(__name__)
+
+# The site catalog from the gateway is cached in the Sites table.
+# The gateway lists sites with the token of the user asking, so the
+# cache is only served to users whose own listing is the one synced.
+# It is considered fresh for SITES_CACHE_TTL seconds, after which it is
+# refreshed in the background while the cached version is served.
+site_catalog = {'digest': None, 'users': {}, 'refreshing': set()}
+site_catalog_lock = threading.Lock()
+
 @subscriptions.route("/")
 @login_required
 def index():
@@ -42,9 +58,17 @@ def index():
 @subscriptions.route("/allsites", methods=["GET","POST"])
 @login_required
 def show_all_sites():
-    success, msg = pull_sites_from_gateway()
-    if not success:
-        flash(msg)
+    access_token = request.cookies.get('OMD_SESSION_ID')
+    username = session.get('username')
+    seen = site_catalog['users'].get(username)
+    cached = seen is not None and seen['digest'] == site_catalog['digest'] and not request.args.get('refresh')
+    record_cache('sites', cached)
+    if not cached:
+        success, msg = pull_sites_from_gateway(access_token, username)
+        if not success:
+            flash(msg)
+    elif time() - seen['fetched'] > SITES_CACHE_TTL:
+        refresh_sites_in_background(access_token, username)
     sites_in_db = db.session.query(Sites).all()
     all_sites = []
     for site in sites_in_db:
@@ -53,18 +77,23 @@ def show_all_sites():
     return render_template("subscriptions/allsites.html", sites=all_sites)
 
 
-def pull_sites_from_gateway():
+def pull_sites_from_gateway(access_token, username=None):
     all_sites = []
     url = join(OMD_PATH,'sites')
-    access_token = request.cookies.get('OMD_SESSION_ID')
     data = {'action': 'list'}
     try:
-        resp = requests.post(url, json=data, headers={'accept':'application/json', 'Authorization': 'token:'+access_token})
+        resp = gateway.post(url, json=data, token=access_token, headers={'accept':'application/json'})
     except requests.exceptions.RequestException as e:
         return False, f"A request exception occurred: {repr(e)}"
     if resp.status_code >= 400:
         return False, f"Response status code {resp.status_code}."
-    
+
+    # An identical listing needs no resync of the Sites table
+    digest = hashlib.sha1(resp.content).hexdigest()
+    if digest == site_catalog['digest']:
+        site_catalog['users'][username] = {'digest': digest, 'fetched': time()}
+        return True, "Sites unchanged on gateway."
+
     json = resp.json()['list']
     for site in json:
         owner = site['owner']
@@ -74,9 +103,56 @@ def pull_sites_from_gateway():
         description = site['customAttributes']['description']
         all_sites.append({'url': link, 'name': name, 'title': title, 'owner': owner, 'description': description})
     update_sites_in_db(all_sites)
+    site_catalog['digest'] = digest
+    site_catalog['users'][username] = {'digest': digest, 'fetched': time()}
     return True, "Sites pulled from gateway."
 
 
+def refresh_sites_in_background(access_token, username):
+    """ Refresh a stale site catalog without making the request
+    wait for the gateway. Only one refresh runs at a time per user.
+    """
+    with site_catalog_lock:
+        if username in site_catalog['refreshing']:
+            return
+        site_catalog['refreshing'].add(username)
+
+    def refresh():
+        try:
+            with app.app_context():
+                success, msg = pull_sites_from_gateway(access_token, username)
+                if not success:
+                    LOG.error("SUBSCRIPTIONS: site catalog refresh failed: %s", msg)
+        finally:
+            site_catalog['refreshing'].discard(username)
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def delete_sites_from_index(site_urls):
+    """ Remove unsubscribed sites from the index. With the
+    async option set on the request, the deletion is queued
+    as a job and its id is returned.
+    """
+    if not site_urls:
+        return None
+    if request.values.get('async'):
+        return submit_delete_job(session.get('username'), site_urls)
+    for url in site_urls:
+        delete_urls_recursively(url)
+    return None
+
+
+def finish_unsubscribe(site_urls, endpoint, error=None):
+    """ Remove unsubscribed sites from the index, then reply with
+    the deletion job if one was queued, or redirect to endpoint.
+    """
+    job_id = delete_sites_from_index(site_urls)
+    if job_id is not None:
+        return deletion_job_response(job_id, error)
+    return redirect(url_for(endpoint))
+
+
 @subscriptions.route("/subscribe_to_site", methods=['GET','POST'])
 @login_required
 def subscribe_to_site():
@@ -87,7 +163,7 @@ def subscribe_to_site():
         access_token = request.cookies.get('OMD_SESSION_ID')
         data = {'action': 'subscribe', 'site': site_name}
         try:
-            resp = requests.post(OMD_PATH, json=data, headers={'accept':'application/json', 'Authorization': 'token:'+access_token})
+            resp = gateway.post(OMD_PATH, json=data, token=access_token, headers={'accept':'application/json'})
         except requests.exceptions.RequestException as e:
             flash(f"A request exception occurred: {e}")
             return redirect(url_for('subscriptions.show_all_sites'))
@@ -112,7 +188,7 @@ def subscribe_to_site():
 def unsubscribe_from_site():
     """ This caters for unsubscribing from the website list page.
     """
-    print("\n\n>>>Calling unsubscribe_from_site")
+    LOG.debug("Calling unsubscribe_from_site")
     site_name=request.args.get('sitename')
     s = db.session.query(Sites).filter_by(name=site_name).first()
             
@@ -122,7 +198,7 @@ def unsubscribe_from_site():
         url = OMD_PATH
         data = {'action': 'unsubscribe', 'site': site_name}
         try:
-            resp = requests.post(url, json=data, headers={'accept':'application/json', 'Authorization': 'token:'+access_token})
+            resp = gateway.post(url, json=data, token=access_token, headers={'accept':'application/json'})
         except requests.exceptions.RequestException as e:
             flash(f"A request exception occurred: {e}")
             return redirect(url_for('subscriptions.show_all_sites'))
@@ -131,11 +207,13 @@ def unsubscribe_from_site():
             return redirect(url_for('subscriptions.show_all_sites'))
 
         # mark as unsubscribed internally and delete from index
-        print(">> UNSUBSCRIBE from SITE: site info:", s.name, s.subscribed, s.url)
+        LOG.debug("UNSUBSCRIBE from SITE: site info: %s %s %s", s.name, s.subscribed, s.url)
         s.subscribed = False
-        delete_urls_recursively(s.url)
         db.session.add(s)
         db.session.commit()
+        job_id = delete_sites_from_index([s.url])
+        if job_id is not None:
+            return deletion_job_response(job_id)
         flash(f"Unsubscribed from site {site_name}")
     
     # site exists but we weren't subscribed -> do nothing
@@ -144,7 +222,7 @@ def unsubscribe_from_site():
     else:
         flash(f'Error: site {site_name} does not exist')
 
-    print(">> NOW REDIRECTING TO SHOWING ALL SITES")
+    LOG.debug("Redirecting to showing all sites")
     return redirect(url_for('subscriptions.show_all_sites'))
 
 @subscriptions.route("/update_site_subscriptions/", methods=["POST"])
@@ -154,8 +232,9 @@ def update_site_subscriptions():
     """
     if request.method == "POST":
         subscriptions = request.form.getlist('sites')
-        print(">> UPDATE SITE SUBSCRIPTIONS", subscriptions)
+        LOG.debug("UPDATE SITE SUBSCRIPTIONS: %s", subscriptions)
         sites = db.session.query(Sites).all()
+        unsubscribed = []
         for s in sites:
             if s.name in subscriptions:
                 s.subscribed = True
@@ -164,16 +243,17 @@ def update_site_subscriptions():
                 access_token = request.cookies.get('OMD_SESSION_ID')
                 data = {'action': 'unsubscribe', 'site': s.name}
                 try:
-                    resp = requests.post(url, json=data, headers={'accept':'application/json', 'Authorization': 'token:'+access_token})
+                    resp = gateway.post(url, json=data, token=access_token, headers={'accept':'application/json'})
                 except requests.exceptions.RequestException as e:
                     flash(f"A request exception occurred: {e}")
-                    return redirect(url_for('subscriptions.index'))
+                    return finish_unsubscribe(unsubscribed, 'subscriptions.index', f"A request exception occurred: {e}")
                 if resp.status_code >= 400:
                     flash(f"Error: Connection to gateway failed.")
-                    return redirect(url_for('subscriptions.index'))
+                    return finish_unsubscribe(unsubscribed, 'subscriptions.index', "Connection to gateway failed.")
 
                 s.subscribed = False
-                delete_urls_recursively(s.url)
                 db.session.add(s)
                 db.session.commit()
+                unsubscribed.append(s.url)
+        return finish_unsubscribe(unsubscribed, 'subscriptions.index')
     return redirect(url_for('subscriptions.index'))
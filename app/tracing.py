@@ -0,0 +1,83 @@
+# SPDX-FileCopyrightText: 2025 PeARS Project, <pears@possible-worlds.eu>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import io
+import pstats
+import cProfile
+from time import perf_counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Number of functions listed in a request profile
+PROFILE_LINES = 40
+
+# Innermost open span of the request being traced, if any
+current_span = ContextVar('current_span', default=None)
+
+
+class Span:
+    """ A timed stage of a request, with the stages it contains.
+    """
+
+    def __init__(self, name, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.seconds = 0.0
+        self.children = []
+        self.profile = None
+
+    def as_dict(self):
+        d = {'name': self.name, 'ms': round(self.seconds * 1000, 3)}
+        d.update(self.attrs)
+        if self.children:
+            d['children'] = [c.as_dict() for c in self.children]
+        if self.profile is not None:
+            d['profile'] = self.profile
+        return d
+
+
+@contextmanager
+def span(name, **attrs):
+    """ Time a stage of the current trace. Outside of a
+    trace, this does nothing and yields None.
+    """
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    s = Span(name, **attrs)
+    parent.children.append(s)
+    token = current_span.set(s)
+    start = perf_counter()
+    try:
+        yield s
+    finally:
+        s.seconds = perf_counter() - start
+        current_span.reset(token)
+
+
+@contextmanager
+def trace(name, enabled=True, profile=False):
+    """ Record the spans opened inside this block, and optionally
+    a cProfile of it. Yields the root span, or None if disabled.
+    """
+    if not enabled:
+        yield None
+        return
+    root = Span(name)
+    token = current_span.set(root)
+    profiler = cProfile.Profile() if profile else None
+    start = perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield root
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(PROFILE_LINES)
+            root.profile = out.getvalue()
+        root.seconds = perf_counter() - start
+        current_span.reset(token)
@@ -6,24 +6,19 @@ import logging
 import hashlib
 from os.path import join, realpath, dirname
 import re
-from datetime import datetime
 from math import sqrt
 import requests
 import numpy as np
 from scipy.spatial import distance
-from app import LANGS, CARBON_DIR
+from app import LANGS, OMD_PATH
 from markupsafe import Markup, escape
 from flask import session
 
 app_dir_path = dirname(realpath(__file__))
 user_app_dir_path = join(app_dir_path,'userdata')
 
+LOG = logging.getLogger(__name__)
 
-def carbon_print(tracker_results, task_name):
-    date = datetime.today().strftime('%Y-%m-%d')
-    filename = 'carbon.'+date+'.txt'
-    with open(join(CARBON_DIR,filename),'a', encoding="utf-8") as f:
-        f.write(task_name+': '+str(tracker_results)+'\n')
 
 def clean_comma_separated_name(name):
     name = ','.join([ind for ind in name.split(',') if not ind.isspace()])
@@ -50,14 +45,14 @@ def read_urls(url_file):
 
 def get_device_from_url(omd_url):
     device = ''
-    m = re.search(u'onmydisk.net/([^/]*)/([^/]*)/', omd_url)
+    m = re.search(re.escape(OMD_PATH.rstrip('/'))+'/([^/]*)/([^/]*)/', omd_url)
     if m:
         device = m.group(2)
     return device
 
 def get_username_from_url(url):
     username = None
-    m = re.search(u'onmydisk.net/([^/]*)/', url)
+    m = re.search(re.escape(OMD_PATH.rstrip('/'))+'/([^/]*)/', url)
     if m:
         username = m.group(1)
     return username
@@ -66,17 +61,17 @@ def init_crawl(username=None, start_urls=None):
     if not username and 'username' in session:
         username = session['username']
     if 'start_urls' in session:
-        print("Start urls in session.")
+        LOG.debug("Start urls in session.")
         start_urls = session['start_urls']
         session.pop('start_urls')
     elif not start_urls and 'toindex' in session:
-        print("Reading start urls from toindex field in session.")
+        LOG.debug("Reading start urls from toindex field in session.")
         start_url = session['toindex'][1] 
         if start_url[-1] != '/':
             start_url+='/'
         start_urls = [start_url]
         session.pop('toindex')
-    print("INIT CRAWL START URLS", start_urls)
+    LOG.debug("INIT CRAWL START URLS: %s", start_urls)
     return username, start_urls
 
 def read_docs(doc_file):
@@ -116,7 +111,7 @@ def read_docs(doc_file):
             elif "</doc" not in l:
                 if "{{DESCRIPTION}}" in l:
                     description = l.replace("{{DESCRIPTION}} ","")
-                    logging.debug(f"DOC WITH DESCRIPTION: {description}")
+                    LOG.debug("DOC WITH DESCRIPTION: %s", description)
                 elif "{{BODY}}" in l:
                     l = l.replace("{{BODY}} ","")
                     doc+=l+' '
@@ -154,14 +149,14 @@ def hamming_similarity(v1, v2):
 
 
 def get_pod_info(url):
-    print("Fetching pod", join(url, "api/self/"))
+    LOG.debug("Fetching pod %s", join(url, "api/self/"))
     pod = None
     try:
         r = requests.get(join(url, "api/self/"))
         if r.status_code == 200:
             pod = r.json()
     except Exception:
-        print("Problem fetching pod...")
+        LOG.warning("Problem fetching pod %s", url)
     return pod
 
 
@@ -169,7 +164,6 @@ def get_language(query):
     lang = None
     m = re.search('(.*) -(..\s*)$',query)
     if m:
-        print(m.group(1), m.group(2))
         query = m.group(1)
         lang = m.group(2)
         if lang not in LANGS:
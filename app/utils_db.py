@@ -2,25 +2,31 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-only
 
-from os.path import dirname, realpath, join, isfile
+import json
+import logging
+from os.path import dirname, realpath, join, isfile, getsize
 from os import remove
 from pathlib import Path
+from bisect import bisect_left
+from collections import defaultdict
 from pytz import timezone
 import joblib
 import numpy as np
 from scipy.sparse import csr_matrix, vstack, save_npz, load_npz
-from sqlalchemy import update
+from sqlalchemy import insert, update, delete, func, or_
 
 from app import db, models
-from app import OMD_PATH, VEC_SIZE, GATEWAY_TIMEZONE
+from app import OMD_PATH, VEC_SIZE, GATEWAY_TIMEZONE, POD_DIR
 from app.utils import hash_username
 from app.api.models import Urls, Pods, Locations, Groups, Sites
-from app.indexer.posix import load_posix, dump_posix
+from app.indexer.posix import load_posix, dump_posix, measure_posix
 from app.cli.consistency import check_db_vs_npz, check_db_vs_pos
 
 
 dir_path = dirname(realpath(__file__))
-pod_dir = join(dir_path,'pods')
+pod_dir = POD_DIR
+
+LOG = logging.getLogger(__name__)
 
 def get_permission_class(url, owner):
     """ Use document url and owner to determine
@@ -91,7 +97,7 @@ def create_pod(url, owner, lang, device):
     Add .npz and .pos files
     """
 
-    def commit(path, owner_hash):
+    def commit(path, owner_hash, permission_class):
         if not db.session.query(Pods).filter_by(url=path).all():
             #print("Pod does not exist:",path,owner_hash)
             create_pod_npz_pos(path)
@@ -100,107 +106,253 @@ def create_pod(url, owner, lang, device):
             p.description = path
             p.language = lang
             p.owner = owner
+            p.device = device
+            p.permission_class = permission_class
+            p.num_bytes = get_pod_bytes(path)
+            p.num_postings_bytes = measure_posix(path)
             db.session.add(p)
             db.session.commit()
     
     permission_class = get_permission_class(url, owner)
     owner_hash = hash_username(owner)
     path = f"{owner_hash}/{device}/{lang}/{permission_class}"
-    commit(path, owner_hash)
+    commit(path, owner_hash, permission_class)
     return path
 
 
-def create_url_in_db(target_url, title, snippet, description, idv, pod_path):
+def get_pod_id(pod_path):
+    """ Return the database id of the pod with the given path.
+    """
+    return db.session.query(Pods.id).filter_by(url=pod_path).scalar()
+
+
+def create_url_in_db(target_url, title, snippet, description, idv, pod_path, truncated=False):
     u = Urls(url=target_url)
-    u.title = title
-    u.snippet = snippet
+    # Column lengths are enforced by PostgreSQL, not by SQLite
+    u.title = title[:1000]
+    u.snippet = snippet[:1000]
     u.description = description[:100]
     u.vector = idv
     u.pod = pod_path
+    u.pod_id = get_pod_id(pod_path)
+    u.truncated = truncated
     db.session.add(u)
+    db.session.execute(update(Pods).where(Pods.id == u.pod_id).values(num_urls=func.coalesce(Pods.num_urls, 0) + 1))
     db.session.commit()
     #print(f"Adding URL {target_url}, {idv}, {pod_path}")
     return u.id
 
 
+##############
+# STATISTICS
+##############
+
+def get_pod_bytes(pod_path):
+    """ Size on disk of the npz and pos files of a pod.
+    """
+    paths = [join(pod_dir, pod_path+ext) for ext in ['.npz', '.pos']]
+    return sum(getsize(p) for p in paths if isfile(p))
+
+
+def update_pod_bytes(pod_path):
+    """ Record the size of a pod after its files have been written,
+    on disk and for its postings in memory, which are measured here
+    rather than on every search. The update is committed with the
+    caller's transaction.
+    """
+    db.session.execute(update(Pods).where(Pods.url == pod_path) \
+            .values(num_bytes=get_pod_bytes(pod_path), num_postings_bytes=measure_posix(pod_path)))
+
+
+def refresh_pod_stats():
+    """ Recompute the statistics of all pods from the urls table
+    and the pod files, e.g. after manual edits of the database.
+    """
+    counts = dict(db.session.query(Urls.pod_id, func.count(Urls.id)).group_by(Urls.pod_id).all())
+    for pod in db.session.query(Pods).all():
+        pod.num_urls = counts.get(pod.id, 0)
+        pod.num_bytes = get_pod_bytes(pod.url)
+        pod.num_postings_bytes = measure_posix(pod.url) if isfile(join(pod_dir, pod.url+'.pos')) else 0
+    db.session.commit()
+
+
+def get_index_stats(username=None):
+    """ Read index statistics from the counters kept on pods,
+    without scanning the urls table.
+    Returns: a dictionary with document counts and bytes on disk,
+    in total and per permission class, plus the counts for the
+    pods of the given user and of their groups.
+    """
+    stats = {'num_urls': 0, 'num_bytes': 0, 'classes': {}}
+    rows = db.session.query(Pods.permission_class, func.sum(Pods.num_urls), func.sum(Pods.num_bytes)) \
+            .group_by(Pods.permission_class).all()
+    for permission_class, num_urls, num_bytes in rows:
+        stats['classes'][permission_class] = {'num_urls': num_urls or 0, 'num_bytes': num_bytes or 0}
+        stats['num_urls'] += num_urls or 0
+        stats['num_bytes'] += num_bytes or 0
+    stats['num_subscribed_sites'] = db.session.query(func.count(Sites.id)).filter(Sites.subscribed == True).scalar()
+    if username is not None:
+        user_pods = db.session.query(Pods).filter_by(name=hash_username(username), permission_class='user').all()
+        group_pods = db.session.query(Pods).filter_by(permission_class='group').all()
+        user_pods.extend([p for p in group_pods if username in [m.strip() for m in p.owner.split(',')]])
+        stats['user'] = {
+            'num_urls': sum(p.num_urls or 0 for p in user_pods),
+            'num_bytes': sum(p.num_bytes or 0 for p in user_pods),
+            'pods': [{'url': p.url, 'num_urls': p.num_urls, 'num_bytes': p.num_bytes} for p in user_pods]
+            }
+    return stats
+
+
 def subscribe_location(location):
     l = db.session.query(Locations).filter_by(name=location).first()
     if l:
+        if not l.subscribed:
+            l.fingerprint = None
+            l.etag = None
+            l.last_modified = None
         l.subscribed = True
         db.session.add(l)
         db.session.commit()
-        print(f"Subscribing Location {location}")
+        LOG.info("Subscribing location %s", location)
+
+
+def get_location_validators(location):
+    """ Return the fingerprint and HTTP validators (ETag,
+    Last-Modified) recorded for a location on its last crawl.
+    Locations crawled before subfolders were recorded have none,
+    since skipping them would lose their subtrees.
+    """
+    l = db.session.query(Locations).filter_by(name=location).first()
+    if l is None or l.subfolders is None:
+        return None, None, None
+    return l.fingerprint, l.etag, l.last_modified
+
+
+def get_location_subfolders(location):
+    """ Return the subfolders recorded for a location on its
+    last crawl.
+    """
+    l = db.session.query(Locations).filter_by(name=location).first()
+    if l is None or not l.subfolders:
+        return []
+    return json.loads(l.subfolders)
+
+
+def record_location_validators(location, fingerprint, etag=None, last_modified=None, subfolders=None):
+    """ Store the fingerprint, HTTP validators and subfolders of a
+    crawled listing. Only existing locations are updated: sites, for
+    instance, are not tracked as locations.
+    """
+    l = db.session.query(Locations).filter_by(name=location).first()
+    if l is None:
+        return
+    l.fingerprint = fingerprint
+    l.etag = etag
+    l.last_modified = last_modified
+    l.subfolders = json.dumps(subfolders or [])
+    db.session.add(l)
+    db.session.commit()
+
+
+def reset_location_validators(locations=None):
+    """ Forget the fingerprints of the given locations (or of all
+    locations), so that they are fully crawled again. This is needed
+    whenever the set of indexable docs changes without the listings
+    changing, e.g. on (un)subscription.
+    """
+    q = db.session.query(Locations)
+    if locations is not None:
+        q = q.filter(Locations.name.in_(locations))
+    q.update({'fingerprint': None, 'etag': None, 'last_modified': None}, synchronize_session=False)
+    db.session.commit()
+
+
+def chunks(items, size=500):
+    """ Split a list into chunks, to keep under SQLite's limit
+    on the number of query parameters.
+    """
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+
+def delete_by_keys(model, column, keys):
+    """ Delete the rows whose column is in the given keys.
+    """
+    for chunk in chunks(list(keys)):
+        db.session.execute(delete(model).where(column.in_(chunk)))
 
 
 def update_locations_in_db(locations, device=False):
-    #Add locations not in the database
-    for location in locations:
-        l = db.session.query(Locations).filter_by(name=location).first()
-        if l:
-            continue
-        l = Locations(name=location)
-        l.device = device
-        l.subscribed = False
-        db.session.add(l)
-        db.session.commit()
-        print(f"Adding Location {location}")
+    """ Sync the locations of one kind (devices or not) with
+    the gateway, in a single transaction.
+    """
+    locations = list(dict.fromkeys(locations))
+    existing = dict(db.session.query(Locations.name, Locations.device).all())
 
-    #Delete locations that do not exist anymore
-    locations_in_db = db.session.query(Locations).all()
-    for l in locations_in_db:
-        if l.name not in locations:
-            #Device case vs non-device case
-            if (device and l.device) or (not device and not l.device):
-                print(f">> {l.name} does not exist anymore.")
-                db.session.delete(l)
-                db.session.commit()
+    #Add locations not in the database
+    new = [{'name': name, 'device': device, 'subscribed': False} for name in locations if name not in existing]
+    if new:
+        db.session.execute(insert(Locations), new)
+        LOG.info("Adding %d locations", len(new))
+
+    #Delete locations that do not exist anymore (device case vs non-device case)
+    keep = set(locations)
+    stale = [name for name, is_device in existing.items() if name not in keep and bool(is_device) == bool(device)]
+    for name in stale:
+        LOG.info("%s does not exist anymore.", name)
+    delete_by_keys(Locations, Locations.name, stale)
+    db.session.commit()
 
 
 def update_groups_in_db(groups):
+    """ Sync the user's groups with the gateway, in a single
+    transaction. New groups are subscribed by default.
+    """
+    groups = list(dict.fromkeys(groups))
+    existing = set(name for (name,) in db.session.query(Groups.name))
+
     #Add groups not in the database
-    for group in groups:
-        g = db.session.query(Groups).filter_by(name=group).first()
-        if g:
-            continue
-        g = Groups(name=group)
-        g.subscribed = True
-        g.identifier = hash_username(group)
-        db.session.add(g)
-        db.session.commit()
-        #print(f"Adding Group {group}")
+    new = [{'name': group, 'identifier': hash_username(group), 'subscribed': True} for group in groups if group not in existing]
+    if new:
+        db.session.execute(insert(Groups), new)
 
     #Delete groups that do not exist anymore
-    groups_in_db = db.session.query(Groups).all()
-    for g in groups_in_db:
-        if g.name not in groups:
-            print(f">> {g.name} does not exist anymore.")
-            db.session.delete(g)
-            db.session.commit()
+    stale = existing - set(groups)
+    for name in stale:
+        LOG.info("%s does not exist anymore.", name)
+    delete_by_keys(Groups, Groups.name, stale)
+    db.session.commit()
 
 
 def update_sites_in_db(sites):
-    #Add sites not in the database
-    site_urls = [s['url'] for s in sites]
-    for site in sites:
-        s = db.session.query(Sites).filter_by(url=site['url']).first()
-        if not s:
-            s = Sites(url=site['url'])
-            s.subscribed = False
-        s.name = site['name']
-        s.title = site['title']
-        s.owner = site['owner']
-        s.description = site['description']
-        db.session.add(s)
-        db.session.commit()
-        #print(f"Adding Site {site}")
+    """ Sync the site catalog with the gateway, in a single
+    transaction. Subscriptions of known sites are preserved.
+    """
+    fields = ['name', 'title', 'owner', 'description']
+    sites = {site['url']: site for site in sites}
+    existing = {row.url: row for row in db.session.query(Sites.id, Sites.url, *[getattr(Sites, f) for f in fields])}
+
+    #Add new sites, update the metadata of known ones
+    new = []
+    changed = []
+    for url, site in sites.items():
+        values = {f: site[f] for f in fields}
+        row = existing.get(url)
+        if row is None:
+            new.append(dict(values, url=url, subscribed=False))
+        elif any(getattr(row, f) != values[f] for f in fields):
+            changed.append(dict(values, id=row.id))
+    if new:
+        db.session.execute(insert(Sites), new)
+    if changed:
+        db.session.execute(update(Sites), changed)
 
     #Delete sites that do not exist anymore
-    sites_in_db = db.session.query(Sites).all()
-    for s in sites_in_db:
-        if s.url not in site_urls:
-            print(f">> {s.url} does not exist anymore.")
-            db.session.delete(s)
-            db.session.commit()
+    stale = set(existing) - set(sites)
+    for url in stale:
+        LOG.info("%s does not exist anymore.", url)
+    delete_by_keys(Sites, Sites.url, stale)
+    db.session.commit()
 
 
 ##############
@@ -297,60 +449,127 @@ def rm_doc_from_pos(vid, pod):
 
 
 def update_db_idvs_after_npz_delete(idv, pod):
-    condition = (Urls.pod == pod) & (Urls.vector > idv)
+    condition = (Urls.pod_id == get_pod_id(pod)) & (Urls.vector > idv)
     update_stmt = update(Urls).where(condition).values(vector=Urls.vector-1)
     db.session.execute(update_stmt)
 
 
-def delete_urls_recursively(url):
-    """Delete url and all chidren
+##################
+# BULK DELETIONS
+##################
+
+def rm_rows_from_npz(vids, pod_path):
+    """ Remove several vectors from an npz file,
+    reading and writing the matrix only once.
+    Arguments:
+    vids: the row numbers of the vectors
+    pod_path: the path to the pod containing the vectors
+
+    Returns: the number of remaining rows
     """
-    print("\n\n>>>Calling delete_urls_recursively")
-    urls_in_db = db.session.query(Urls).filter(Urls.url.startswith(url)).all()
-    print("URLS STARTING WITH",url)
-    for u in urls_in_db:
-        print(u.url)
-        delete_url(u.url)
+    pod_path = join(pod_dir, pod_path+'.npz')
+    pod_m = load_npz(pod_path).tocsr()
+    keep = np.ones(pod_m.shape[0], dtype=bool)
+    vids = [vid for vid in vids if 0 < vid < pod_m.shape[0]]
+    keep[vids] = False
+    pod_m = pod_m[keep]
+    save_npz(pod_path, pod_m)
+    return pod_m.shape[0]
 
 
-def delete_url(url):
-    """ Delete url with some url on some pod.
+def rm_docs_from_pos(doc_ids, pod):
+    """ Remove several documents from a pos file,
+    reading and writing the positional index only once.
     """
-    print("\n\n>>>Calling delete_url")
-    u = db.session.query(Urls).filter_by(url=url).first()
-    pod = u.pod
-    username = pod.split('/')[0]  # pod = "user/device/lang/pod_name"
-    #print("POD",pod,"USER",username)
+    doc_ids = set(doc_ids)
+    posindex = load_posix(pod)
+    posindex = [{doc_id: posidx for doc_id, posidx in token_posindex.items() if doc_id not in doc_ids} \
+            for token_posindex in posindex]
+    dump_posix(posindex, pod)
 
-    #Remove document row from .npz matrix
-    idv = rm_from_npz(u.vector, pod)
 
-    #Remove doc from positional index
-    rm_doc_from_pos(u.id, pod)
+def update_db_idvs_after_bulk_delete(vids, pod):
+    """ Renumber the vectors of a pod after its npz rows
+    have been removed, in a single bulk update.
+    """
+    vids = sorted(vids)
+    remaining = db.session.query(Urls.id, Urls.vector).filter(Urls.pod_id == get_pod_id(pod)).filter(Urls.vector > vids[0]).all()
+    mappings = [{'id': idx, 'vector': vector - bisect_left(vids, vector)} for idx, vector in remaining]
+    if mappings:
+        db.session.execute(update(Urls), mappings)
 
-    #Update database idvs
-    update_db_idvs_after_npz_delete(idv, pod)
 
-    #Delete from database
-    db.session.delete(u)
-    db.session.commit()
-    u = db.session.query(Urls).filter_by(url=url).first()
-    
-    #If pod empty, delete
-    if len(db.session.query(Urls).filter_by(pod=pod).all()) == 0:
+def delete_from_pod(pod, rows):
+    """ Delete a set of urls from a single pod. The npz and pos
+    files are rewritten once, and the database rows are deleted
+    in one statement. An emptied pod is removed altogether.
+    Arguments:
+    pod: the path of the pod
+    rows: (id, vector) tuples for the urls to delete
+    """
+    doc_ids = [idx for idx, _ in rows]
+    if db.session.query(Urls.id).filter(Urls.pod_id == get_pod_id(pod)).filter(Urls.id.not_in(doc_ids)).first() is None:
         delete_pod(pod)
-    
+        return
+    vids = [vector for _, vector in rows]
+    rm_rows_from_npz(vids, pod)
+    rm_docs_from_pos(doc_ids, pod)
+    num_deleted = db.session.execute(delete(Urls).where(Urls.id.in_(doc_ids))).rowcount
+    update_db_idvs_after_bulk_delete(vids, pod)
+    db.session.execute(update(Pods).where(Pods.url == pod) \
+            .values(num_urls=func.coalesce(Pods.num_urls, 0) - num_deleted))
+    update_pod_bytes(pod)
+    db.session.commit()
+
+
+def bulk_delete_urls(rows):
+    """ Delete a set of urls, grouped by pod so that each
+    affected pod is rewritten exactly once.
+    Arguments:
+    rows: (id, pod, vector) tuples, as returned by a query
+    on Urls.id, Urls.pod and Urls.vector.
+
+    Returns: the number of deleted urls.
+    """
+    by_pod = defaultdict(dict)
+    for idx, pod, vector in rows:
+        by_pod[pod][idx] = vector
+    for pod, docs in by_pod.items():
+        LOG.info("Deleting %d urls from pod %s", len(docs), pod)
+        delete_from_pod(pod, list(docs.items()))
+    return sum(len(docs) for docs in by_pod.values())
+
+
+def delete_urls(urls):
+    """ Delete the given urls from the index.
+    """
+    rows = []
+    for chunk in chunks(list(urls)):
+        rows.extend(db.session.query(Urls.id, Urls.pod, Urls.vector).filter(Urls.url.in_(chunk)).all())
+    return bulk_delete_urls(rows)
+
+
+def delete_urls_recursively(url):
+    """Delete url and all chidren, in one pass
+    per affected pod.
+    Returns: the number of deleted urls.
+    """
+    rows = db.session.query(Urls.id, Urls.pod, Urls.vector).filter(Urls.url.startswith(url, autoescape=True)).all()
+    LOG.info("delete_urls_recursively: %d urls starting with %s", len(rows), url)
+    return bulk_delete_urls(rows)
+
+
+def delete_url(url):
+    """ Delete url with some url on some pod.
+    """
+    LOG.debug("delete_url: %s", url)
+    delete_urls([url])
     return "Deleted document with url "+url
 
 def delete_pod(pod_path):
     pod = db.session.query(Pods).filter_by(url=pod_path).first()
     if pod is not None:
-        urls = db.session.query(Urls).filter_by(pod=pod_path).all()
-        if urls is not None:
-            for u in urls:
-                #This is going to be slow for many urls...
-                db.session.delete(u)
-                db.session.commit()
+        db.session.execute(delete(Urls).where(Urls.pod_id == pod.id))
         npz_path = join(pod_dir, pod_path+'.npz')
         if isfile(npz_path):
             remove(npz_path)
@@ -362,12 +581,11 @@ def delete_pod(pod_path):
     return "Deleted pod with path "+pod_path
 
 def delete_old_pods():
-    pods = db.session.query(Pods).all()
-    for pod in pods:
-        urls_in_db = db.session.query(Urls).filter_by(pod=pod.url).all()
-        if len(urls_in_db) == 0:
-            print(f"Removing empty pod {pod.url}")
-            delete_pod(pod.url)
+    has_urls = db.session.query(Urls.id).filter(Urls.pod_id == Pods.id).exists()
+    pods = db.session.query(Pods.url).filter(~has_urls).all()
+    for (pod_url,) in pods:
+        LOG.info("Removing empty pod %s", pod_url)
+        delete_pod(pod_url)
     
 
 def delete_old_urls(start_urls, urls):
@@ -375,38 +593,34 @@ def delete_old_urls(start_urls, urls):
     current state of database and delete urls
     that do not exist anymore.
     """
-    print(">> DELETING OLD URLS")
-    print("START_URLS",start_urls)
-    print("URLS",urls)
-    urls_in_db = db.session.query(Urls).all()
-    for u in urls_in_db:
-        if any(u.url.startswith(s) for s in start_urls) and u.url not in urls:
-            print(f">> {u.url} does not exist anymore.")
-            delete_url(u.url)
+    LOG.info("Deleting old urls under %s", start_urls)
+    if not start_urls:
+        return 0
+    urls = set(urls)
+    in_start_urls = or_(*[Urls.url.startswith(s, autoescape=True) for s in start_urls])
+    rows = db.session.query(Urls.id, Urls.pod, Urls.vector, Urls.url).filter(in_start_urls).all()
+    rows = [(idx, pod, vector) for idx, pod, vector, url in rows if url not in urls]
+    return bulk_delete_urls(rows)
 
 def delete_unsubscribed():
     """Delete urls which now belong to an
     unsubscribed location.
     """
-    print(">> DELETING UNSUBSCRIBED URLS")
-    urls = db.session.query(Urls).all()
-    if urls is not None:
-        for u in urls:
-            #This is going to be slow for many urls...
-            group_id = u.pod.split('/')[0]
-            group = db.session.query(Groups).filter_by(identifier=group_id).first()
-            if group and not group.subscribed:
-                print(f">> {u.url} has been unsubscribed.")
-                delete_url(u.url)
-            url = u.url
-            if url[-1] == '/':
-                loc = url
-            else:
-                loc = '/'.join(url.split('/')[:-1])+'/'
-            l = db.session.query(Locations).filter_by(name=loc).first()
-            if l and not l.subscribed:
-                print(f">> {u.url} has been unsubscribed.")
-                delete_url(u.url)
+    LOG.info("Deleting unsubscribed urls")
+    # Urls in the pods of unsubscribed groups (the pod name is the group hash)
+    in_unsubscribed_group = db.session.query(Urls.id, Urls.pod, Urls.vector) \
+            .join(Pods, Urls.pod_id == Pods.id) \
+            .join(Groups, Pods.name == Groups.identifier) \
+            .filter(Groups.subscribed == False)
+    # Urls directly in an unsubscribed location: folders are their own location,
+    # other docs belong to their parent folder
+    rest = func.substr(Urls.url, func.length(Locations.name) + 1)
+    in_unsubscribed_location = db.session.query(Urls.id, Urls.pod, Urls.vector) \
+            .join(Locations, func.substr(Urls.url, 1, func.length(Locations.name)) == Locations.name) \
+            .filter(Locations.subscribed == False) \
+            .filter(or_(rest == '', ~rest.contains('/')))
+    rows = in_unsubscribed_group.union(in_unsubscribed_location).all()
+    return bulk_delete_urls(rows)
 
 ####################
 # CONSISTENCY CHECKS
@@ -17,7 +17,6 @@ Path(join(BASE_DIR,'app/db')).mkdir(parents=True, exist_ok=True)
 SQLALCHEMY_DATABASE_URI = 'sqlite:///' + join(BASE_DIR, 'app/db/app.db')
 DATABASE_CONNECT_OPTIONS = {}
 
-THREADS_PER_PAGE = 2
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
 # To ensure utf-8 is handled properly by jsonify
@@ -0,0 +1,383 @@
+# SPDX-FileCopyrightText: 2025 PeARS Project, <pears@possible-worlds.eu>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+""" Local stand-in for the On My Disk gateway, for indexing load tests.
+
+Serve a generated user tree and a few sites:
+    python gatewaysim.py serve --port 9191 --depth 2 --fanout 3 --files 20
+
+Crawl it with PeARS, then re-crawl it unchanged and after churn, and
+write a JSON report:
+    python gatewaysim.py bench --depth 2 --fanout 3 --files 20 --churn 0.1
+
+The bench indexes into a temporary database, and removes the pods
+it created when it is done.
+"""
+
+import os
+import sys
+import json
+import random
+import hashlib
+import argparse
+import threading
+import tempfile
+from shutil import rmtree
+from time import sleep, perf_counter
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from xml.sax.saxutils import escape, quoteattr
+from pytz import timezone
+
+SIM_USER = 'simuser'
+SIM_DEVICE = 'simdevice'
+SIM_SESSION = 'simsession'
+# Date of the docs that have not churned
+BASE_DATE = datetime(2024, 1, 1, 12, 0, 0)
+
+WORDS = ('pear apple orchard tree branch leaf root seed harvest autumn spring summer winter garden '
+         'soil water rain river mountain valley forest field meadow flower blossom fruit juice cider '
+         'market village city road bridge house window door table chair book letter story music '
+         'song dance paint colour light shadow morning evening night star moon sun cloud wind storm '
+         'search index network disk file folder document share friend group site page link').split()
+
+
+class GatewaySimulator:
+    """ A generated On My Disk account, served over HTTP.
+    The user has one device, holding a tree of folders of the given
+    depth and fan-out, with some text files and some convertible
+    files per folder. Sites are html pages linking to each other.
+    Requests can be slowed down and made to fail at random, and churn()
+    changes the modification date of a fraction of the files.
+    """
+
+    def __init__(self, depth=2, fanout=3, files=10, file_size=2000, sites=1, pages=5,
+            latency=0.0, jitter=0.0, error_rate=0.0, seed=0):
+        self.depth = depth
+        self.fanout = fanout
+        self.files = files
+        self.file_size = file_size
+        self.sites = sites
+        self.pages = pages
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.tz = timezone(os.getenv('GATEWAY_TIMEZONE', 'Europe/Berlin').strip("'\""))
+        self.modified = {}
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.server = None
+
+    ########
+    # TREE
+    ########
+
+    def is_folder(self, path):
+        ''' Folders are paths of sub<i>/ parts, below the device.'''
+        parts = [p for p in path.split('/') if p]
+        return len(parts) <= self.depth and all(p.startswith('sub') for p in parts)
+
+    def folder_docs(self, path):
+        ''' Returns: (name, contentType, convertible) for the entries of a folder.'''
+        docs = []
+        if len([p for p in path.split('/') if p]) < self.depth:
+            docs.extend((f'sub{i}/', 'folder', False) for i in range(self.fanout))
+        for i in range(self.files):
+            if i % 5 == 4:
+                docs.append((f'doc{i}.pdf', 'application/pdf', True))
+            else:
+                docs.append((f'doc{i}.txt', 'text/plain', False))
+        return docs
+
+    def last_modified(self, key):
+        return self.modified.get(key, BASE_DATE).strftime('%Y-%m-%d %H:%M:%S')
+
+    def churn(self, fraction):
+        ''' Give a fraction of the files a new modification date.
+        Returns: the number of changed files.
+        '''
+        now = datetime.now(self.tz).replace(tzinfo=None) + timedelta(minutes=1)
+        files = []
+        folders = ['']
+        while folders:
+            folder = folders.pop()
+            for name, content_type, _ in self.folder_docs(folder):
+                if content_type == 'folder':
+                    folders.append(folder + name)
+                else:
+                    files.append(folder + name)
+        changed = self.rng.sample(files, round(fraction * len(files)))
+        for key in changed:
+            self.modified[key] = now
+        return len(changed)
+
+    def text(self, key, size=None):
+        rng = random.Random(f'{self.seed}:{key}:{self.modified.get(key)}')
+        words = []
+        # No space before the first word
+        length = -1
+        while length < (size or self.file_size):
+            word = rng.choice(WORDS)
+            words.append(word)
+            length += len(word) + 1
+        return ' '.join(words)
+
+    ############
+    # LISTINGS
+    ############
+
+    def doc_xml(self, url, content_type, convertible, title, last_modified, description=''):
+        return (f"<doc url={quoteattr(url)} contentType={quoteattr(content_type)} convertible='{convertible}' "
+                f"owner='{SIM_USER}' last_modified='{last_modified}'><title>{escape(title)}</title>"
+                f"<description>{escape(description)}</description></doc>\n")
+
+    def user_listing(self):
+        return self.doc_xml(f'{SIM_DEVICE}/', 'desktop', False, SIM_DEVICE, self.last_modified(''))
+
+    def folder_listing(self, path):
+        listing = ''
+        for name, content_type, convertible in self.folder_docs(path):
+            listing += self.doc_xml(name, content_type, convertible, name.rstrip('/'), self.last_modified(path + name))
+        return listing
+
+    def site_listing(self, site):
+        listing = ''
+        for i in range(self.pages):
+            key = f'sites/{site}/page{i}.html'
+            listing += self.doc_xml('/' + key, 'text/html', False, f'Page {i}', self.last_modified(key))
+        return listing
+
+    def site_page(self, site, page):
+        links = ''.join(f"<a href='/sites/{site}/page{i}.html'>page {i}</a> " for i in range(self.pages))
+        return (f"<html><head><meta property='og:title' content='{site} page {page}'/></head><body>"
+                f"<h1>{site} page {page}</h1><p>{self.text(f'sites/{site}/page{page}.html')}</p>{links}</body></html>")
+
+    def sites_list(self):
+        return {'list': [{'owner': SIM_USER, 'link': f'/sites/simsite{i}/', 'name': f'simsite{i}',
+                          'customAttributes': {'title': f'Simulated site {i}', 'description': 'A generated site.'}}
+                         for i in range(self.sites)]}
+
+    def route_get(self, path, query):
+        ''' Returns: the status, content type and body of a GET,
+        and the kind of request for the statistics.'''
+        parts = [p for p in path.split('/') if p]
+        if parts[:1] == ['sites'] and len(parts) >= 2:
+            site = parts[1]
+            if len(parts) == 2:
+                if query == 'direct':
+                    return 200, 'text/html', self.site_page(site, 0), 'page'
+                return 200, 'text/xml', f"<omd_index>\n{self.site_listing(site)}</omd_index>\n", 'listing'
+            page = parts[2].replace('page', '').replace('.html', '')
+            return 200, 'text/html', self.site_page(site, page), 'page'
+        if parts[:1] != [SIM_USER]:
+            return 404, 'text/plain', 'Not found', 'error'
+        if len(parts) == 1:
+            return 200, 'text/xml', f"<omd_index>\n{self.user_listing()}</omd_index>\n", 'listing'
+        if parts[1] != SIM_DEVICE:
+            return 404, 'text/plain', 'Not found', 'error'
+        rest = '/'.join(parts[2:]) + ('/' if path.endswith('/') and len(parts) > 2 else '')
+        if query == 'description':
+            return 200, 'text/plain', f'Folder {rest or SIM_DEVICE} of the simulated device.', 'description'
+        if rest == '' or self.is_folder(rest):
+            return 200, 'text/xml', f"<omd_index>\n{self.folder_listing(rest)}</omd_index>\n", 'listing'
+        return 200, 'text/plain', self.text(rest), 'totext' if query == 'totext' else 'file'
+
+    def route_post(self, path, data):
+        ''' Returns: the status and JSON body of a POST.'''
+        action = data.get('action')
+        if action == 'signin':
+            return 200, {'valid': True, 'profile': {'user': SIM_USER, 'isAdmin': True}, 'session_id': SIM_SESSION}
+        if action == 'getUserInfo':
+            return 200, {'valid': data.get('session_id') == SIM_SESSION, 'user': SIM_USER, 'isAdmin': True}
+        if action == 'signout':
+            return 200, {'valid': False}
+        if action == 'list':
+            return 200, self.sites_list()
+        if action in ['subscribe', 'unsubscribe']:
+            return 200, {'success': True}
+        return 400, {'error': f'Unknown action {action}'}
+
+    ##########
+    # SERVER
+    ##########
+
+    def record(self, kind, num_bytes):
+        with self.lock:
+            s = self.stats.setdefault(kind, {'requests': 0, 'bytes': 0})
+            s['requests'] += 1
+            s['bytes'] += num_bytes
+
+    def reset_stats(self):
+        with self.lock:
+            stats, self.stats = self.stats, {}
+        return stats
+
+    def delay(self):
+        ''' Wait for the configured latency, and tell whether
+        this request should fail.'''
+        if self.latency or self.jitter:
+            sleep(self.latency + random.uniform(0, self.jitter))
+        return random.random() < self.error_rate
+
+    def start(self, port=0):
+        ''' Serve in a background thread.
+        Returns: the base url of the simulated gateway.
+        '''
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(self))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f'http://127.0.0.1:{self.server.server_address[1]}/'
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def make_handler(sim):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            pass
+
+        def send(self, status, content_type, body, headers=None):
+            body = body.encode('utf-8') if isinstance(body, str) else body
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+            return len(body)
+
+        def do_GET(self):
+            if sim.delay():
+                sim.record('error', self.send(503, 'text/plain', 'Injected error'))
+                return
+            path, _, query = self.path.partition('?')
+            status, content_type, body, kind = sim.route_get(path, query)
+            if kind == 'listing':
+                etag = '"' + hashlib.sha1(body.encode('utf-8')).hexdigest() + '"'
+                if self.headers.get('If-None-Match') == etag:
+                    sim.record('not_modified', self.send(304, content_type, b'', {'ETag': etag}))
+                    return
+                sim.record(kind, self.send(status, content_type, body, {'ETag': etag}))
+                return
+            sim.record(kind, self.send(status, content_type, body))
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                data = json.loads(self.rfile.read(length) or b'{}')
+            except ValueError:
+                data = {}
+            status, body = sim.route_post(self.path, data)
+            sim.record('post', self.send(status, 'application/json', json.dumps(body)))
+
+    return Handler
+
+
+###########
+# BENCH
+###########
+
+def bench(sim, churn):
+    ''' Crawl the simulated gateway through the indexer views, as
+    the PeARS frontend does: pull the user's devices and folders,
+    subscribe to all of them and to the sites, run update_all and
+    follow progress_crawl to the end. Then re-crawl without
+    changes, and after churn.
+    Returns: the report, as a dictionary.
+    '''
+    base_url = sim.start()
+    os.environ['GATEWAY_PATH'] = base_url
+    # Crawls run in a thread of this process, on a scratch database and pod directory
+    os.environ['INDEXING_WORKERS'] = '0'
+    scratch = tempfile.mkdtemp(prefix='pears-bench-')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(scratch, 'bench.db')
+    os.environ['POD_DIR'] = os.path.join(scratch, 'pods')
+
+    from app import app, db, AUTH_TOKEN
+    from app.api.models import Locations, Sites, Jobs
+    from app.subscriptions.controllers import pull_sites_from_gateway
+
+    client = app.test_client()
+    headers = {'Token': AUTH_TOKEN}
+    with client.session_transaction() as session:
+        session['username'] = SIM_USER
+
+    def crawl(name, force=False):
+        sim.reset_stats()
+        start = perf_counter()
+        client.get('/indexer/update_all/' + ('?force=1' if force else ''), headers=headers)
+        client.get('/indexer/progress_crawl', headers=headers).get_data()
+        seconds = perf_counter() - start
+        with app.app_context():
+            job = Jobs.query.order_by(Jobs.id.desc()).first()
+            num_docs, num_indexed = job.num_docs or 0, job.num_indexed or 0
+        requests = sim.reset_stats()
+        print(f"{name}: {num_indexed} docs indexed out of {num_docs} listed in {seconds:.1f} s, "
+              f"{sum(r['requests'] for r in requests.values())} gateway requests.")
+        return {'seconds': seconds, 'docs_listed': num_docs, 'docs_indexed': num_indexed,
+                'docs_per_second': num_indexed / seconds, 'gateway': requests}
+
+    try:
+        client.post('/indexer/pull/', headers=headers)
+        with app.app_context():
+            pull_sites_from_gateway(SIM_SESSION)
+            db.session.query(Locations).update({'subscribed': True})
+            db.session.query(Sites).update({'subscribed': True})
+            db.session.commit()
+        report = {
+            'params': {k: getattr(sim, k) for k in ['depth', 'fanout', 'files', 'file_size', 'sites', 'pages',
+                                                   'latency', 'jitter', 'error_rate', 'seed']},
+            'first_crawl': crawl('first crawl'),
+            'unchanged_recrawl': crawl('unchanged re-crawl'),
+        }
+        report['params']['churn'] = churn
+        report['churned_files'] = sim.churn(churn)
+        report['churn_recrawl'] = crawl('re-crawl after churn')
+        report['forced_recrawl'] = crawl('forced re-crawl', force=True)
+    finally:
+        sim.stop()
+        rmtree(scratch, ignore_errors=True)
+    return report
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['serve', 'bench'])
+    parser.add_argument('--port', type=int, default=9191, help='Port to serve on (serve only).')
+    parser.add_argument('--depth', type=int, default=2, help='Depth of the folder tree.')
+    parser.add_argument('--fanout', type=int, default=3, help='Subfolders per folder.')
+    parser.add_argument('--files', type=int, default=10, help='Files per folder.')
+    parser.add_argument('--file-size', type=int, default=2000, help='Characters per file.')
+    parser.add_argument('--sites', type=int, default=1, help='Number of sites.')
+    parser.add_argument('--pages', type=int, default=5, help='Pages per site.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to each request.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random extra seconds, up to this value.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of GET requests answered with a 503.')
+    parser.add_argument('--churn', type=float, default=0.1, help='Fraction of files modified before the re-crawl (bench only).')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench-crawl.json', help='Path of the JSON report (bench only).')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    sim = GatewaySimulator(depth=args.depth, fanout=args.fanout, files=args.files, file_size=args.file_size,
+            sites=args.sites, pages=args.pages, latency=args.latency, jitter=args.jitter,
+            error_rate=args.error_rate, seed=args.seed)
+    if args.command == 'serve':
+        print(f"Simulated gateway on {sim.start(args.port)}, user {SIM_USER}. Set GATEWAY_PATH to this url.")
+        threading.Event().wait()
+    else:
+        report = bench(sim, args.churn)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report: {args.output}")
@@ -0,0 +1,64 @@
+# SPDX-FileCopyrightText: 2025 PeARS Project, <pears@possible-worlds.eu>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+""" Gunicorn settings for running PeARS in production:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Workers, threads and address can be set in conf/pears.ini with
+GUNICORN_WORKERS, GUNICORN_THREADS and GUNICORN_BIND. Indexing does not
+run in the web workers: set INDEXING_WORKERS, and run
+
+    flask --app app pears worker
+
+as a separate service.
+"""
+
+import gc
+import os
+from os.path import dirname, join, realpath
+from multiprocessing import cpu_count
+from dotenv import load_dotenv
+
+load_dotenv(join(dirname(realpath(__file__)), 'conf', 'pears.ini'))
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:9090')
+# Searches are CPU-bound: one process per core, and a few threads
+# each to cover the time spent waiting on the gateway
+workers = int(os.getenv('GUNICORN_WORKERS', cpu_count()))
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+worker_class = 'gthread'
+timeout = 120
+# Load the app and its models once, before forking the workers
+preload_app = True
+
+
+def on_starting(server):
+    # Crawl threads in the web workers would each have their own crawl
+    # lock, and none of them would resume interrupted jobs
+    from app import INDEXING_WORKERS
+    if INDEXING_WORKERS == 0:
+        raise SystemExit("INDEXING_WORKERS is 0: crawls would run in threads of the web workers. "
+                "Set INDEXING_WORKERS in conf/pears.ini and run 'flask --app app pears worker' "
+                "as a separate service.")
+
+
+def when_ready(server):
+    # Objects loaded so far are never collected, so the collector
+    # does not write to (and copy) the pages workers share
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # Connections opened by the server process cannot be shared
+    # with the workers: each opens its own
+    from app import app, db
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+def child_exit(server, worker):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,34 @@
+"""location fingerprints
+
+Revision ID: 078c410cdee8
+Revises: 76ee1b6550a4
+Create Date: 2026-10-19 19:10:07.072819
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '078c410cdee8'
+down_revision = '76ee1b6550a4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = [c['name'] for c in sa.inspect(op.get_bind()).get_columns('locations')]
+    with op.batch_alter_table('locations') as batch_op:
+        if 'fingerprint' not in columns:
+            batch_op.add_column(sa.Column('fingerprint', sa.String(length=64), nullable=True))
+        if 'etag' not in columns:
+            batch_op.add_column(sa.Column('etag', sa.String(length=200), nullable=True))
+        if 'last_modified' not in columns:
+            batch_op.add_column(sa.Column('last_modified', sa.String(length=100), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('locations') as batch_op:
+        batch_op.drop_column('last_modified')
+        batch_op.drop_column('etag')
+        batch_op.drop_column('fingerprint')
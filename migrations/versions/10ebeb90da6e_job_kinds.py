@@ -0,0 +1,29 @@
+"""job kinds
+
+Revision ID: 10ebeb90da6e
+Revises: 4ec57b7f6286
+Create Date: 2026-10-19 19:19:44.400103
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '10ebeb90da6e'
+down_revision = '4ec57b7f6286'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = [c['name'] for c in sa.inspect(op.get_bind()).get_columns('jobs')]
+    if 'kind' not in columns:
+        with op.batch_alter_table('jobs') as batch_op:
+            batch_op.add_column(sa.Column('kind', sa.String(length=20), nullable=True))
+    op.execute("UPDATE jobs SET kind = 'crawl' WHERE kind IS NULL")
+
+
+def downgrade():
+    with op.batch_alter_table('jobs') as batch_op:
+        batch_op.drop_column('kind')
@@ -0,0 +1,48 @@
+"""crawl jobs
+
+Revision ID: 2e5cae163ecd
+Revises: 078c410cdee8
+Create Date: 2026-10-19 19:12:13.873979
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2e5cae163ecd'
+down_revision = '078c410cdee8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    tables = sa.inspect(op.get_bind()).get_table_names()
+    if 'jobs' not in tables:
+        op.create_table('jobs',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('date_created', sa.DateTime(), nullable=True),
+            sa.Column('date_modified', sa.DateTime(), nullable=True),
+            sa.Column('username', sa.String(length=200), nullable=True),
+            sa.Column('status', sa.String(length=20), nullable=True),
+            sa.Column('force', sa.Boolean(), nullable=True),
+            sa.Column('current', sa.String(length=1000), nullable=True),
+            sa.Column('num_folders', sa.Integer(), nullable=True),
+            sa.Column('num_docs', sa.Integer(), nullable=True),
+            sa.Column('num_indexed', sa.Integer(), nullable=True),
+            sa.Column('message', sa.String(length=1000), nullable=True))
+    if 'frontier_links' not in tables:
+        op.create_table('frontier_links',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('date_created', sa.DateTime(), nullable=True),
+            sa.Column('date_modified', sa.DateTime(), nullable=True),
+            sa.Column('job_id', sa.Integer(), sa.ForeignKey('jobs.id'), nullable=True),
+            sa.Column('url', sa.String(length=1000), nullable=True),
+            sa.Column('done', sa.Boolean(), nullable=True))
+        op.create_index('ix_frontier_links_job_id', 'frontier_links', ['job_id'])
+
+
+def downgrade():
+    op.drop_index('ix_frontier_links_job_id', table_name='frontier_links')
+    op.drop_table('frontier_links')
+    op.drop_table('jobs')
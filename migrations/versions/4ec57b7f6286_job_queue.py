@@ -0,0 +1,31 @@
+"""job queue
+
+Revision ID: 4ec57b7f6286
+Revises: 2e5cae163ecd
+Create Date: 2026-10-19 19:13:49.955513
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4ec57b7f6286'
+down_revision = '2e5cae163ecd'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = [c['name'] for c in sa.inspect(op.get_bind()).get_columns('jobs')]
+    with op.batch_alter_table('jobs') as batch_op:
+        if 'priority' not in columns:
+            batch_op.add_column(sa.Column('priority', sa.Integer(), nullable=True))
+        if 'worker' not in columns:
+            batch_op.add_column(sa.Column('worker', sa.String(length=100), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('jobs') as batch_op:
+        batch_op.drop_column('worker')
+        batch_op.drop_column('priority')
@@ -0,0 +1,28 @@
+"""url truncation flag
+
+Revision ID: 58bcf1be79ea
+Revises: 79d67294f472
+Create Date: 2026-10-19 19:31:43.093983
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '58bcf1be79ea'
+down_revision = '79d67294f472'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = [c['name'] for c in sa.inspect(op.get_bind()).get_columns('urls')]
+    if 'truncated' not in columns:
+        with op.batch_alter_table('urls') as batch_op:
+            batch_op.add_column(sa.Column('truncated', sa.Boolean(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('urls') as batch_op:
+        batch_op.drop_column('truncated')
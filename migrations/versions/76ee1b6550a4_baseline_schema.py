@@ -0,0 +1,69 @@
+"""baseline schema
+
+Revision ID: 76ee1b6550a4
+Revises: 
+Create Date: 2026-10-19 19:10:04.730261
+
+Tables as created by db.create_all() before migrations were introduced.
+Existing installs already have them, so each table is only created if
+it is missing.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '76ee1b6550a4'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def base_columns():
+    return [
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('date_created', sa.DateTime(), nullable=True),
+        sa.Column('date_modified', sa.DateTime(), nullable=True),
+    ]
+
+
+def upgrade():
+    tables = sa.inspect(op.get_bind()).get_table_names()
+    if 'urls' not in tables:
+        op.create_table('urls', *base_columns(),
+            sa.Column('url', sa.String(length=1000), nullable=True),
+            sa.Column('title', sa.String(length=1000), nullable=True),
+            sa.Column('vector', sa.Integer(), nullable=True),
+            sa.Column('snippet', sa.String(length=1000), nullable=True),
+            sa.Column('pod', sa.String(length=1000), nullable=True),
+            sa.Column('description', sa.String(length=1000), nullable=True))
+    if 'pods' not in tables:
+        op.create_table('pods', *base_columns(),
+            sa.Column('name', sa.String(length=1000), nullable=True),
+            sa.Column('url', sa.String(length=1000), nullable=True),
+            sa.Column('description', sa.String(length=7000), nullable=True),
+            sa.Column('language', sa.String(length=1000), nullable=True),
+            sa.Column('owner', sa.String(length=2000), nullable=True))
+    if 'locations' not in tables:
+        op.create_table('locations', *base_columns(),
+            sa.Column('name', sa.String(length=1000), nullable=True),
+            sa.Column('device', sa.Boolean(), nullable=True),
+            sa.Column('subscribed', sa.Boolean(), nullable=True))
+    if 'groups' not in tables:
+        op.create_table('groups', *base_columns(),
+            sa.Column('name', sa.String(length=1000), nullable=True),
+            sa.Column('identifier', sa.String(length=64), nullable=True),
+            sa.Column('subscribed', sa.Boolean(), nullable=True))
+    if 'sites' not in tables:
+        op.create_table('sites', *base_columns(),
+            sa.Column('url', sa.String(length=1000), nullable=True),
+            sa.Column('name', sa.String(length=200), nullable=True),
+            sa.Column('title', sa.String(length=1000), nullable=True),
+            sa.Column('description', sa.String(length=1000), nullable=True),
+            sa.Column('owner', sa.String(length=100), nullable=True),
+            sa.Column('subscribed', sa.Boolean(), nullable=True))
+
+
+def downgrade():
+    for table in ['sites', 'groups', 'locations', 'pods', 'urls']:
+        op.drop_table(table)
@@ -0,0 +1,44 @@
+"""pod statistics
+
+Revision ID: 79d67294f472
+Revises: b7c71e87cd18
+Create Date: 2026-10-19 19:24:39.411264
+
+"""
+import os
+from os.path import dirname, join, realpath, isfile, getsize
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '79d67294f472'
+down_revision = 'b7c71e87cd18'
+branch_labels = None
+depends_on = None
+
+
+pod_dir = os.getenv('POD_DIR', join(dirname(dirname(dirname(realpath(__file__)))), 'app', 'pods'))
+
+
+def upgrade():
+    bind = op.get_bind()
+    columns = [c['name'] for c in sa.inspect(bind).get_columns('pods')]
+    with op.batch_alter_table('pods') as batch_op:
+        if 'num_urls' not in columns:
+            batch_op.add_column(sa.Column('num_urls', sa.Integer(), nullable=True))
+        if 'num_bytes' not in columns:
+            batch_op.add_column(sa.Column('num_bytes', sa.Integer(), nullable=True))
+
+    bind.execute(sa.text("UPDATE pods SET num_urls = (SELECT COUNT(*) FROM urls WHERE urls.pod_id = pods.id)"))
+    pods = bind.execute(sa.text("SELECT id, url FROM pods")).fetchall()
+    for pod_id, url in pods:
+        paths = [join(pod_dir, url+ext) for ext in ['.npz', '.pos']]
+        num_bytes = sum(getsize(p) for p in paths if isfile(p))
+        bind.execute(sa.text("UPDATE pods SET num_bytes = :num_bytes WHERE id = :id"), {'num_bytes': num_bytes, 'id': pod_id})
+
+
+def downgrade():
+    with op.batch_alter_table('pods') as batch_op:
+        batch_op.drop_column('num_bytes')
+        batch_op.drop_column('num_urls')
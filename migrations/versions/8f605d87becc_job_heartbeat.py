@@ -0,0 +1,29 @@
+"""job heartbeat
+
+Revision ID: 8f605d87becc
+Revises: 9067fc64e328
+Create Date: 2026-10-19 20:04:38.394034
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8f605d87becc'
+down_revision = '9067fc64e328'
+branch_labels = None
+depends_on = None
+
+
+
+def upgrade():
+    columns = [c['name'] for c in sa.inspect(op.get_bind()).get_columns('jobs')]
+    if 'heartbeat' not in columns:
+        with op.batch_alter_table('jobs') as batch_op:
+            batch_op.add_column(sa.Column('heartbeat', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('jobs') as batch_op:
+        batch_op.drop_column('heartbeat')
@@ -0,0 +1,28 @@
+"""location subfolders
+
+Revision ID: 9067fc64e328
+Revises: 58bcf1be79ea
+Create Date: 2026-10-19 20:02:15.507723
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9067fc64e328'
+down_revision = '58bcf1be79ea'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = [c['name'] for c in sa.inspect(op.get_bind()).get_columns('locations')]
+    if 'subfolders' not in columns:
+        with op.batch_alter_table('locations') as batch_op:
+            batch_op.add_column(sa.Column('subfolders', sa.Text(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('locations') as batch_op:
+        batch_op.drop_column('subfolders')
@@ -0,0 +1,52 @@
+"""pod postings bytes
+
+Revision ID: b1d9bc3c310b
+Revises: fd9670a92a58
+Create Date: 2026-10-19 20:37:47.044116
+
+"""
+import os
+from sys import getsizeof
+from os.path import dirname, join, realpath, isfile
+import joblib
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b1d9bc3c310b'
+down_revision = 'fd9670a92a58'
+branch_labels = None
+depends_on = None
+
+
+pod_dir = os.getenv('POD_DIR', join(dirname(dirname(dirname(realpath(__file__)))), 'app', 'pods'))
+
+
+def postings_bytes(posindex):
+    total = getsizeof(posindex)
+    for postings in posindex:
+        total += getsizeof(postings) + getsizeof(0) * len(postings) + sum(map(getsizeof, postings.values()))
+    return total
+
+
+def upgrade():
+    bind = op.get_bind()
+    columns = [c['name'] for c in sa.inspect(bind).get_columns('pods')]
+    if 'num_postings_bytes' not in columns:
+        with op.batch_alter_table('pods') as batch_op:
+            batch_op.add_column(sa.Column('num_postings_bytes', sa.BigInteger(), nullable=True))
+
+    pods = bind.execute(sa.text("SELECT id, url FROM pods")).fetchall()
+    for pod_id, url in pods:
+        path = join(pod_dir, url+'.pos')
+        if not isfile(path):
+            continue
+        num_postings_bytes = postings_bytes(joblib.load(path))
+        bind.execute(sa.text("UPDATE pods SET num_postings_bytes = :num_postings_bytes WHERE id = :id"),
+                {'num_postings_bytes': num_postings_bytes, 'id': pod_id})
+
+
+def downgrade():
+    with op.batch_alter_table('pods') as batch_op:
+        batch_op.drop_column('num_postings_bytes')
@@ -0,0 +1,67 @@
+"""pod foreign keys and indexes
+
+Revision ID: b7c71e87cd18
+Revises: 10ebeb90da6e
+Create Date: 2026-10-19 19:21:52.686422
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7c71e87cd18'
+down_revision = '10ebeb90da6e'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('ix_urls_url', 'urls', ['url']),
+    ('ix_urls_pod_id_vector', 'urls', ['pod_id', 'vector']),
+    ('ix_pods_name', 'pods', ['name']),
+    ('ix_pods_url', 'pods', ['url']),
+    ('ix_pods_language_permission_class', 'pods', ['language', 'permission_class']),
+    ('ix_locations_name', 'locations', ['name']),
+]
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    pods_columns = [c['name'] for c in inspector.get_columns('pods')]
+    with op.batch_alter_table('pods') as batch_op:
+        if 'device' not in pods_columns:
+            batch_op.add_column(sa.Column('device', sa.String(length=1000), nullable=True))
+        if 'permission_class' not in pods_columns:
+            batch_op.add_column(sa.Column('permission_class', sa.String(length=20), nullable=True))
+    if 'pod_id' not in [c['name'] for c in inspector.get_columns('urls')]:
+        with op.batch_alter_table('urls') as batch_op:
+            batch_op.add_column(sa.Column('pod_id', sa.Integer(), nullable=True))
+            batch_op.create_foreign_key('fk_urls_pod_id_pods', 'pods', ['pod_id'], ['id'])
+
+    # Pod paths are owner_hash/device/lang/permission_class
+    pods = bind.execute(sa.text("SELECT id, url FROM pods")).fetchall()
+    for pod_id, url in pods:
+        parts = url.split('/')
+        if len(parts) != 4:
+            continue
+        bind.execute(sa.text("UPDATE pods SET device = :device, permission_class = :permission_class WHERE id = :id"),
+                {'device': parts[1], 'permission_class': parts[3], 'id': pod_id})
+    bind.execute(sa.text("UPDATE urls SET pod_id = (SELECT pods.id FROM pods WHERE pods.url = urls.pod) WHERE pod_id IS NULL"))
+
+    for name, table, columns in INDEXES:
+        existing = [i['name'] for i in sa.inspect(bind).get_indexes(table)]
+        if name not in existing:
+            op.create_index(name, table, columns)
+
+
+def downgrade():
+    for name, table, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
+    with op.batch_alter_table('urls') as batch_op:
+        batch_op.drop_constraint('fk_urls_pod_id_pods', type_='foreignkey')
+        batch_op.drop_column('pod_id')
+    with op.batch_alter_table('pods') as batch_op:
+        batch_op.drop_column('permission_class')
+        batch_op.drop_column('device')
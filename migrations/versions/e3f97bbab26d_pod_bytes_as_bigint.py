@@ -0,0 +1,28 @@
+"""pod bytes as bigint
+
+Revision ID: e3f97bbab26d
+Revises: 8f605d87becc
+Create Date: 2026-10-19 20:33:02.877203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3f97bbab26d'
+down_revision = '8f605d87becc'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = {c['name']: c['type'] for c in sa.inspect(op.get_bind()).get_columns('pods')}
+    if not isinstance(columns.get('num_bytes'), sa.BigInteger):
+        with op.batch_alter_table('pods') as batch_op:
+            batch_op.alter_column('num_bytes', existing_type=sa.Integer(), type_=sa.BigInteger(), existing_nullable=True)
+
+
+def downgrade():
+    with op.batch_alter_table('pods') as batch_op:
+        batch_op.alter_column('num_bytes', existing_type=sa.BigInteger(), type_=sa.Integer(), existing_nullable=True)
@@ -0,0 +1,35 @@
+"""revoked tokens
+
+Revision ID: fd9670a92a58
+Revises: e3f97bbab26d
+Create Date: 2026-10-19 20:35:06.859844
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'fd9670a92a58'
+down_revision = 'e3f97bbab26d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    tables = sa.inspect(op.get_bind()).get_table_names()
+    if 'revoked_tokens' not in tables:
+        op.create_table('revoked_tokens',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('date_created', sa.DateTime(), nullable=True),
+            sa.Column('date_modified', sa.DateTime(), nullable=True),
+            sa.Column('token_hash', sa.String(length=64), nullable=True),
+            sa.Column('expires', sa.DateTime(), nullable=True))
+        op.create_index('ix_revoked_tokens_token_hash', 'revoked_tokens', ['token_hash'])
+        op.create_index('ix_revoked_tokens_expires', 'revoked_tokens', ['expires'])
+
+
+def downgrade():
+    op.drop_index('ix_revoked_tokens_expires', table_name='revoked_tokens')
+    op.drop_index('ix_revoked_tokens_token_hash', table_name='revoked_tokens')
+    op.drop_table('revoked_tokens')
@@ -2,16 +2,22 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-only
 
-# Run a test server.
+# Run a development server. In production, use gunicorn with wsgi.py.
 import os
 
 from app import app
 from app import SERVER_HOST
+from app.indexer.jobqueue import start_job_runners
 
 if os.getenv("FLASK_ENV") == "development":
     debug_mode = True
 else:
     debug_mode = False
 
+# Start the indexing workers, or resume crawls interrupted by a
+# previous shutdown. With the reloader on, only do it in the serving process.
+if not debug_mode or os.getenv("WERKZEUG_RUN_MAIN") == "true":
+    start_job_runners()
+
 host, port = SERVER_HOST.split(":")
 app.run(host=host, port=int(port), debug=debug_mode, threaded=True)
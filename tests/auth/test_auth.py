@@ -0,0 +1,78 @@
+from app import app
+from app.auth.tokens import TokenCache
+import app.auth.tokens as tokens
+
+from tests import client
+
+
+##################
+# AUTH: token cache
+##################
+
+def test_token_cache_expiry_and_size():
+    cache = TokenCache(max_tokens=2, ttl=60, negative_ttl=-1)
+    cache.set('t1', 'alice', True)
+    cache.set('t2', None)
+    assert cache.get('t1') == ('alice', True)
+    # Negative entries expire on their own ttl
+    assert cache.get('t2') is None
+    cache.set('t3', 'bob')
+    cache.set('t4', 'carol')
+    # Least recently used token evicted
+    assert cache.get('t1') is None
+    assert cache.get('t4') == ('carol', False)
+
+
+def test_validate_token_cached(client, monkeypatch):
+    calls = []
+
+    class FakeResponse:
+        status_code = 200
+        def json(self):
+            return {'valid': True, 'user': 'alice', 'isAdmin': False}
+
+    def fake_post(*args, **kwargs):
+        calls.append(kwargs['timeout'])
+        return FakeResponse()
+
+    monkeypatch.setattr(tokens.gateway, 'post', fake_post)
+    monkeypatch.setattr(tokens, 'token_cache', TokenCache())
+    with app.app_context():
+        assert tokens.validate_token('sometoken') == ('alice', False)
+        assert tokens.validate_token('sometoken') == ('alice', False)
+    assert calls == [tokens.AUTH_TIMEOUT]
+
+
+def test_validate_token_revoked_elsewhere(client, monkeypatch):
+    from app import db
+    from app.api.models import RevokedTokens
+    calls = []
+
+    class FakeResponse:
+        status_code = 401
+
+    def fake_post(*args, **kwargs):
+        calls.append(kwargs['timeout'])
+        return FakeResponse()
+
+    monkeypatch.setattr(tokens.gateway, 'post', fake_post)
+    monkeypatch.setattr(tokens, 'token_cache', TokenCache())
+    with app.app_context():
+        try:
+            # Rejected tokens cost one gateway call
+            assert tokens.validate_token('badtoken') == (None, False)
+            assert tokens.validate_token('badtoken') == (None, False)
+            assert len(calls) == 1
+
+            # A logout served by another process revokes the cached token
+            this_process = tokens.token_cache
+            this_process.set('goodtoken', 'alice')
+            assert tokens.validate_token('goodtoken') == ('alice', False)
+            monkeypatch.setattr(tokens, 'token_cache', TokenCache())
+            tokens.revoke_token('goodtoken')
+            monkeypatch.setattr(tokens, 'token_cache', this_process)
+            assert tokens.validate_token('goodtoken') == (None, False)
+            assert len(calls) == 1
+        finally:
+            db.session.query(RevokedTokens).filter_by(token_hash=tokens.hash_token('goodtoken')).delete()
+            db.session.commit()
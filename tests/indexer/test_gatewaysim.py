@@ -0,0 +1,37 @@
+from os.path import join
+import requests
+from app import OMD_PATH
+from app.utils import get_device_from_url, get_username_from_url
+from app.indexer.spider import iter_docs_from_xml
+from gatewaysim import GatewaySimulator, SIM_USER, SIM_DEVICE
+
+from tests import client
+
+
+def test_gatewaysim_listings(client):
+    sim = GatewaySimulator(depth=1, fanout=2, files=5)
+    base_url = sim.start()
+    try:
+        folder = join(base_url, SIM_USER, SIM_DEVICE)+'/'
+        resp = requests.get(folder, stream=True)
+        docs = list(iter_docs_from_xml(resp.raw))
+        assert [d['@url'] for d in docs][:3] == ['sub0/', 'sub1/', 'doc0.txt']
+        assert docs[-1]['@convertible'] == 'True'
+
+        # Unchanged listings are not sent again
+        etag = resp.headers['ETag']
+        assert requests.get(folder, headers={'If-None-Match': etag}).status_code == 304
+        assert sim.churn(1.0) == 15
+        assert requests.get(folder, headers={'If-None-Match': etag}).status_code == 200
+
+        resp = requests.get(join(folder, 'doc0.txt?totext'))
+        assert len(resp.text) >= sim.file_size
+        assert requests.post(join(base_url, 'sites'), json={'action': 'list'}).json()['list'][0]['name'] == 'simsite0'
+    finally:
+        sim.stop()
+
+
+def test_get_device_from_url(client):
+    url = join(OMD_PATH, 'someuser', 'somedevice', 'Documents')+'/'
+    assert get_device_from_url(url) == 'somedevice'
+    assert get_username_from_url(url) == 'someuser'
@@ -1,13 +1,25 @@
 import os
+import subprocess
+from io import BytesIO
+from socket import gethostname
+from datetime import datetime, timedelta
 from os.path import join
 import numpy as np
+import pytest
 from flask import session
-from app import app, db, AUTH_TOKEN, VEC_SIZE
-from app.utils_db import create_pod, create_url_in_db, delete_url, add_to_npz, rm_from_npz
-from app.api.models import Urls, Pods, Sites
+from sqlalchemy import text
+from app import app, db, AUTH_TOKEN, VEC_SIZE, OMD_PATH, LANGS, LanguageModels
+from app.readers import read_vocab, load_vocab
+from app.utils_db import create_pod, create_url_in_db, delete_url, add_to_npz, rm_from_npz, delete_urls, delete_unsubscribed, delete_pod, get_index_stats, \
+        record_location_validators, get_location_validators
+from app.api.models import Urls, Pods, Sites, Locations, Jobs, FrontierLinks
 from app.cli.consistency import check_db_vs_npz, check_db_vs_pos
 from app.indexer.controllers import run_indexing
-from app.indexer.spider import get_xml, read_xml, get_docs_from_xml_parse, process_xml, get_doc_url
+from app.indexer.crawler import create_crawl_job, run_crawl_job, get_job_progress, worker_name
+from app.indexer.jobqueue import claim_next_job, requeue_stale_jobs, submit_cleanup_job, PRIORITY_INTERACTIVE, PRIORITY_SCHEDULED
+from app.indexer.spider import get_xml, read_xml, get_docs_from_xml_parse, iter_docs_from_xml, process_xml, get_doc_url, process_html_links, XmlListing
+from app.indexer import htmlparser
+from app.indexer.htmlparser import Page, PageCache, extract_html, fetch_capped
 
 from tests import client
 
@@ -76,6 +88,135 @@ def test_spider_get_docs_from_xml_parse(client):
     assert '@url' in docs[0]
 
 
+####################################
+# SPIDER: iter_docs_from_xml (offline)
+####################################
+
+def test_spider_iter_docs_from_xml(client):
+    xml = BytesIO(b"<omd_index>"
+                  b"<doc url='Documents/' contentType='folder'><title>Documents</title></doc>"
+                  b"<doc url='a.txt' contentType='text/plain'><title></title><description>Tom & Jerry</description></doc>"
+                  b"</omd_index>")
+
+    # Use a tiny chunk size to make sure docs spanning several chunks are parsed
+    docs = list(iter_docs_from_xml(xml, chunk_size=7))
+    assert len(docs) == 2
+    assert docs[0] == {'@url': 'Documents/', '@contentType': 'folder', 'title': 'Documents'}
+    assert docs[1]['title'] is None
+    assert docs[1]['description'] == 'Tom  and  Jerry'
+
+def test_spider_iter_docs_from_xml_bad_xml(client):
+    xml = BytesIO(b"<omd_index><doc url='a.txt'><title>A</title></doc><doc url=")
+    docs = list(iter_docs_from_xml(xml))
+    assert [d['@url'] for d in docs] == ['a.txt']
+
+
+###########################################
+# SPIDER: process_html_links (offline cache)
+###########################################
+
+def test_spider_process_html_links_cached(client):
+    site = join(OMD_PATH, 'sites/testsite/')
+    pages = {
+        site+'?direct': "<a href='/sites/testsite/a.html'>a</a><a href='/sites/testsite/b.html'>b</a><a href='/sites/testsite/'>home</a>",
+        site+'a.html': "<h1>A</h1><a href='/sites/testsite/'>home</a>",
+        site+'b.html': "<h1>B</h1>",
+    }
+    cache = PageCache()
+    for url, html in pages.items():
+        cache.put(url, Page(url, 200, 'text/html; charset=utf-8', html))
+
+    links = process_html_links(site+'?direct', cache)
+    assert links == [site+'a.html', site+'b.html']
+
+    # Pages fetched for link extraction are reused for indexing
+    title, _, _, _, _ = extract_html(site+'a.html', cache)
+    assert title == 'A'
+    assert cache.misses == 0
+    assert cache.hits == 4
+    # Trees built after caching are counted as they are built
+    assert cache.num_bytes == sum(page.size for page in cache.pages.values())
+    assert cache.pages[site+'a.html'].size > len(pages[site+'a.html'])
+
+    # Least recently used pages are dropped beyond the byte limit
+    cache.max_bytes = 1
+    assert cache.get(site+'b.html').text == pages[site+'b.html']
+    assert list(cache.pages) == [site+'b.html']
+    cache.clear()
+    assert cache.num_bytes == 0 and cache.num_entries == 0
+
+
+def test_fetch_capped(client, monkeypatch):
+    class FakeResponse:
+        status_code = 200
+        headers = {'content-type': 'text/plain'}
+        def __init__(self, content=b'lorem ipsum '):
+            self.chunks_read = 0
+            self.content = content
+        def iter_content(self, chunk_size):
+            while True:
+                self.chunks_read += 1
+                yield self.content * (chunk_size // len(self.content))
+        def close(self):
+            pass
+    resp = FakeResponse()
+    monkeypatch.setattr(htmlparser.gateway, 'get', lambda url, **kwargs: resp)
+    _, text, truncated = fetch_capped(OMD_PATH+'big.txt', timeout=1, limit=100000)
+    assert truncated
+    # The stream is abandoned at the limit, on a word boundary
+    assert resp.chunks_read == 2
+    assert len(text) <= 100000
+    assert text.split()[-1] in ['lorem', 'ipsum']
+
+    # A text without any whitespace is a single partial word
+    resp = FakeResponse(b'x')
+    _, text, truncated = fetch_capped(OMD_PATH+'big.bin', timeout=1, limit=1000000)
+    assert truncated and text == ''
+
+
+def test_gateway_client_stats(client):
+    import requests
+    from app.gateway import GatewayClient
+    gateway = GatewayClient(retries=0)
+    try:
+        gateway.get('http://localhost:9/testuser/', token=AUTH_TOKEN, timeout=1)
+    except requests.exceptions.ConnectionError:
+        pass
+    stats = gateway.get_stats()
+    assert stats['GET localhost:9']['calls'] == 1
+    assert stats['GET localhost:9']['errors'] == 1
+    # Connections are pooled in one session per process
+    assert gateway.get_session() is gateway.get_session()
+
+
+def test_gateway_client_drops_cookies(client):
+    import threading
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from app.gateway import GatewayClient
+    received = []
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            received.append(self.headers.get('Cookie'))
+            self.send_response(200)
+            self.send_header('Set-Cookie', 'OMD_SESSION_ID=secret; Path=/')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        def log_message(self, *args):
+            pass
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        gateway = GatewayClient(retries=0)
+        url = f'http://127.0.0.1:{server.server_port}/'
+        gateway.get(url, timeout=5)
+        gateway.get(url, timeout=5)
+        assert received == [None, None]
+        assert len(gateway.get_session().cookies) == 0
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
 #####################
 # SPIDER: get_doc_url
 #####################
@@ -116,6 +257,31 @@ def test_db_pos_consistency(client):
             assert len(errors2) == 0
 
 
+def test_sqlite_wal_mode(client):
+    with app.app_context():
+        if db.engine.dialect.name != 'sqlite':
+            pytest.skip("WAL mode only applies to SQLite")
+        assert db.session.execute(text("PRAGMA journal_mode")).scalar() == 'wal'
+        assert db.session.execute(text("PRAGMA busy_timeout")).scalar() > 0
+
+
+def test_create_url_truncates_long_fields(client):
+    pod_path = 'testuser1/testdevice/en/test_truncation'
+    url = join(OMD_PATH, 'testuser1', 'testdevice', 'long.txt')
+    with app.app_context():
+        db.session.add(Pods(url=pod_path))
+        db.session.commit()
+        try:
+            # Would be rejected by PostgreSQL without truncation
+            idx = create_url_in_db(url, 't'*2000, 's'*2000, 'd'*2000, 0, pod_path)
+            u = db.session.get(Urls, idx)
+            assert (len(u.title), len(u.snippet), len(u.description)) == (1000, 1000, 100)
+        finally:
+            Urls.query.filter_by(url=url).delete()
+            Pods.query.filter_by(url=pod_path).delete()
+            db.session.commit()
+
+
 def test_run_indexing(client):
     title = 'Testing run_indexing'
     snippet = 'This is a test of the run_indexing function.'
@@ -179,3 +345,327 @@ def test_run_indexing_npz_inconsistent_with_db(client):
         rm_from_npz(vid - 1, random_pod_url)
 
 
+def test_bulk_delete_urls(client):
+    folder = 'http://localhost:9/testuser/testdevice/bulk/'
+    urls = [join(folder, f'doc{i}.txt') for i in range(6)]
+
+    with app.app_context():
+        pod_path = create_pod(urls[0], 'testuser', 'en', 'testdevice')
+        for i, url in enumerate(urls):
+            run_indexing(url, pod_path, f'Doc {i}', '', '', 'en', f'Bulk deletion test document number {i}')
+        pod = db.session.query(Pods).filter_by(url=pod_path).first()
+        assert (pod.device, pod.language, pod.permission_class) == ('testdevice', 'en', 'user')
+        assert db.session.query(Urls).filter_by(pod_id=pod.id).count() == len(urls)
+        assert pod.num_urls == len(urls) and pod.num_bytes > 0
+
+        # One rewrite of the pod, vectors renumbered in place
+        assert delete_urls([urls[1], urls[3], urls[4]]) == 3
+        remaining = db.session.query(Urls).filter_by(pod=pod_path).order_by(Urls.vector).all()
+        assert [u.url for u in remaining] == [urls[0], urls[2], urls[5]]
+        assert [u.vector for u in remaining] == [1, 2, 3]
+        assert check_db_vs_npz(pod) == (3, 4)
+        assert check_db_vs_pos(pod) == ([], [])
+        db.session.refresh(pod)
+        assert pod.num_urls == 3
+        assert get_index_stats('testuser')['user']['num_urls'] == 3
+
+        # Docs in an unsubscribed location are removed, with the emptied pod
+        l = Locations(name=folder, subscribed=False)
+        db.session.add(l)
+        db.session.commit()
+        assert delete_unsubscribed() == 3
+        assert db.session.query(Urls).filter_by(pod=pod_path).count() == 0
+        assert db.session.query(Pods).filter_by(url=pod_path).first() is None
+        db.session.delete(l)
+        db.session.commit()
+
+
+def test_delete_unsubscribed_location(client):
+    folder = 'http://localhost:9/testuser/testdevice/unsub/'
+    urls = [folder+'doc0.txt', folder+'sub/', folder+'sub/doc1.txt']
+
+    with app.app_context():
+        pod_path = create_pod(urls[0], 'testuser', 'en', 'testdevice')
+        for i, url in enumerate(urls):
+            run_indexing(url, pod_path, f'Doc {i}', '', '', 'en', f'Unsubscription test document number {i}')
+        locations = [Locations(name=folder, subscribed=False), Locations(name=folder+'sub/', subscribed=True)]
+        db.session.add_all(locations)
+        db.session.commit()
+        try:
+            # Only the docs directly in the unsubscribed folder go, as before:
+            # a subfolder is its own location
+            assert delete_unsubscribed() == 1
+            remaining = db.session.query(Urls).filter_by(pod=pod_path).order_by(Urls.vector).all()
+            assert [u.url for u in remaining] == urls[1:]
+        finally:
+            delete_urls(urls[1:])
+            for l in locations:
+                db.session.delete(l)
+            db.session.commit()
+
+
+#####################
+# CRAWL JOBS
+#####################
+
+def test_crawl_job_lifecycle(client):
+    # Nothing listens on that port: the folder fails and the job moves on
+    start_url = 'http://localhost:9/testuser/testdevice/'
+
+    with app.app_context():
+        job_id = create_crawl_job('testuser', [start_url])
+        p, _, finished = get_job_progress(job_id)
+        assert p < 100 and not finished
+
+        run_crawl_job(job_id)
+        job = db.session.get(Jobs, job_id, populate_existing=True)
+        assert job.status == 'done'
+        assert job.num_folders == 1
+        links = db.session.query(FrontierLinks).filter_by(job_id=job_id).all()
+        assert [(l.url, l.done) for l in links] == [(start_url, True)]
+        assert get_job_progress(job_id) == (100, "Finished!", True)
+
+        # Finished jobs are not run again
+        run_crawl_job(job_id)
+        for l in links:
+            db.session.delete(l)
+        db.session.delete(job)
+        db.session.commit()
+
+
+def test_resume_crawls_of_dead_worker(client):
+    with app.app_context():
+        job_id = create_crawl_job('testuser', ['http://localhost:9/testuser/testdevice/'])
+        dead = subprocess.Popen(['true'])
+        dead.wait()
+        job = db.session.get(Jobs, job_id)
+        job.status, job.worker, job.heartbeat = 'running', f"{gethostname()}:{dead.pid}", datetime.utcnow()
+        db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=['pears', 'resumecrawls'])
+    assert f"Resuming crawl job {job_id}" in result.output
+
+    with app.app_context():
+        job = db.session.get(Jobs, job_id)
+        assert job.status == 'done'
+        for l in db.session.query(FrontierLinks).filter_by(job_id=job_id).all():
+            db.session.delete(l)
+        db.session.delete(job)
+        db.session.commit()
+
+
+def test_job_status_of_other_user(client):
+    with app.app_context():
+        job_id = create_crawl_job('testuser1', ['http://localhost:9/testuser1/testdevice/'])
+        try:
+            with client.session_transaction() as s:
+                s['username'] = 'testuser1'
+            page = client.get(f"/indexer/jobs/{job_id}", headers={"Token": AUTH_TOKEN})
+            assert page.status_code == 200 and page.json['id'] == job_id
+            # Other users cannot see the job, nor the folders it crawls
+            with client.session_transaction() as s:
+                s['username'] = 'testuser2'
+            page = client.get(f"/indexer/jobs/{job_id}", headers={"Token": AUTH_TOKEN})
+            assert page.status_code == 404
+        finally:
+            for l in db.session.query(FrontierLinks).filter_by(job_id=job_id).all():
+                db.session.delete(l)
+            db.session.delete(db.session.get(Jobs, job_id))
+            db.session.commit()
+
+
+def test_delete_job(client):
+    site = 'http://localhost:9/sites/testsite/'
+    urls = [join(site, 'a.html'), join(site, 'blog/b.html'), join(site, 'blog/c.html'), 'http://localhost:9/sites/othersite/d.html']
+
+    with app.app_context():
+        pod_path = create_pod(urls[0], 'testuser', 'en', 'testdevice')
+        for i, url in enumerate(urls):
+            run_indexing(url, pod_path, f'Doc {i}', '', '', 'en', f'Prefix deletion test document number {i}')
+
+        job_id = create_crawl_job('testuser', [join(site, 'blog/'), site], kind='delete')
+        run_crawl_job(job_id)
+        job = db.session.get(Jobs, job_id, populate_existing=True)
+        assert job.status == 'done'
+        assert job.num_docs == 3
+        assert [u.url for u in db.session.query(Urls).filter_by(pod=pod_path).all()] == [urls[3]]
+        pod = db.session.query(Pods).filter_by(url=pod_path).first()
+        assert check_db_vs_npz(pod) == (1, 2)
+        assert check_db_vs_pos(pod) == ([], [])
+
+        delete_pod(pod_path)
+        for l in db.session.query(FrontierLinks).filter_by(job_id=job_id).all():
+            db.session.delete(l)
+        db.session.delete(job)
+        db.session.commit()
+
+
+def test_job_queue_claim(client):
+    with app.app_context():
+        scheduled = create_crawl_job('testuser1', ['http://localhost:9/a/'], priority=PRIORITY_SCHEDULED)
+        interactive = create_crawl_job('testuser1', ['http://localhost:9/b/'], priority=PRIORITY_INTERACTIVE)
+        other_user = create_crawl_job('testuser2', ['http://localhost:9/c/'], priority=PRIORITY_SCHEDULED)
+
+        # Interactive jobs first, then no concurrent job for the same user
+        assert claim_next_job('w1') == interactive
+        assert claim_next_job('w2') == other_user
+        assert claim_next_job('w3') is None
+
+        job = db.session.get(Jobs, interactive, populate_existing=True)
+        assert job.status == 'running' and job.worker == 'w1'
+        job.status = 'done'
+        db.session.commit()
+        assert claim_next_job('w1') == scheduled
+
+        # Jobs of live workers stay running, those of dead workers are requeued
+        job = db.session.get(Jobs, other_user, populate_existing=True)
+        job.worker = worker_name()
+        db.session.commit()
+        assert requeue_stale_jobs() == 0
+        dead = subprocess.Popen(['true'])
+        dead.wait()
+        job.worker = f"{gethostname()}:{dead.pid}"
+        db.session.commit()
+        assert requeue_stale_jobs() == 1
+        job = db.session.get(Jobs, other_user, populate_existing=True)
+        assert job.status == 'queued' and job.worker is None
+        job.status, job.worker, job.heartbeat = 'running', 'otherhost:1', datetime.utcnow() - timedelta(hours=1)
+        db.session.commit()
+        assert requeue_stale_jobs() == 1
+
+        for job_id in [scheduled, interactive, other_user]:
+            for l in db.session.query(FrontierLinks).filter_by(job_id=job_id).all():
+                db.session.delete(l)
+            db.session.delete(db.session.get(Jobs, job_id))
+        db.session.commit()
+
+
+def test_cleanup_job_runs_alone(client):
+    with app.app_context():
+        crawl = create_crawl_job('testuser1', ['http://localhost:9/a/'])
+        cleanup = submit_cleanup_job()
+        assert submit_cleanup_job() == cleanup
+        other_user = create_crawl_job('testuser2', ['http://localhost:9/b/'], priority=PRIORITY_SCHEDULED)
+
+        # The cleanup job waits for running jobs, even if queued first
+        assert claim_next_job('w1') == crawl
+        assert claim_next_job('w2') == other_user
+        assert claim_next_job('w3') is None
+        for job_id in [crawl, other_user]:
+            db.session.get(Jobs, job_id, populate_existing=True).status = 'done'
+        db.session.commit()
+
+        # No other job starts while it runs
+        assert claim_next_job('w1') == cleanup
+        later = create_crawl_job('testuser3', ['http://localhost:9/c/'])
+        assert claim_next_job('w2') is None
+        job = db.session.get(Jobs, cleanup, populate_existing=True)
+        assert job.username is None and job.kind == 'cleanup'
+        job.status = 'done'
+        db.session.commit()
+        assert claim_next_job('w2') == later
+
+        for job_id in [crawl, cleanup, other_user, later]:
+            for l in db.session.query(FrontierLinks).filter_by(job_id=job_id).all():
+                db.session.delete(l)
+            db.session.delete(db.session.get(Jobs, job_id))
+        db.session.commit()
+
+
+def test_vocab_cache(tmp_path):
+    vocab_file = str(tmp_path / 'xxwiki.vocab')
+    with open(vocab_file, 'w') as f:
+        f.write('<unk>\t0\n▁pear\t-3.5\n▁tree\t-4.25\n▁pear\t-5\n')
+    expected = read_vocab(vocab_file)
+    assert load_vocab(vocab_file) == expected
+    assert os.path.exists(vocab_file + '.npz')
+    # Read from the cache, then rebuilt when the text file changes
+    assert load_vocab(vocab_file) == expected
+    with open(vocab_file, 'a') as f:
+        f.write('▁orchard\t-6\n')
+    assert load_vocab(vocab_file)[0]['▁orchard'] == 3
+
+
+def test_language_models_lazy():
+    models = LanguageModels()
+    assert len(models) == 0
+    assert len(models[LANGS[0]]['vocab']) == VEC_SIZE
+    assert models[LANGS[0]]['tokenizer'].get_piece_size() == VEC_SIZE
+    assert list(models) == [LANGS[0]]
+
+
+def test_crawl_folder_not_modified_keeps_subfolders(client, monkeypatch):
+    from types import SimpleNamespace
+    from app.indexer import crawler
+    folder = join(OMD_PATH, 'testuser1', 'testdevice')+'/'
+    with app.app_context():
+        db.session.add(Locations(name=folder, subscribed=True))
+        db.session.commit()
+        record_location_validators(folder, 'fingerprint', '"etag"', None, [folder+'sub0/'])
+        # The gateway answers 304: the docs of the folder are skipped,
+        # but files below it may have changed
+        listing = XmlListing()
+        listing.failed, listing.not_modified = False, True
+        monkeypatch.setattr(crawler, 'process_xml', lambda *args, **kwargs: (listing, folder))
+        try:
+            assert crawler.crawl_folder(SimpleNamespace(force=False), folder, PageCache(), set()) == ([folder+'sub0/'], True)
+        finally:
+            Locations.query.filter_by(name=folder).delete()
+            db.session.commit()
+
+
+def test_crawl_folder_unchanged_fingerprint(client, monkeypatch):
+    from hashlib import sha1
+    from types import SimpleNamespace
+    from app.indexer import crawler
+    folder = join(OMD_PATH, 'testuser1', 'testdevice')+'/'
+    xml = b"<omd_index><doc url='sub1/' contentType='folder'><title>sub1</title></doc></omd_index>"
+    read = []
+    monkeypatch.setattr(crawler, 'get_doc_info', lambda doc, *args: read.append(doc))
+    with app.app_context():
+        db.session.add(Locations(name=folder, subscribed=True))
+        db.session.commit()
+        try:
+            # The gateway sends no validators, but the listing is the same:
+            # its docs are skipped, its recorded subfolders still crawled
+            record_location_validators(folder, sha1(xml).hexdigest(), None, None, [folder+'sub0/'])
+            monkeypatch.setattr(crawler, 'process_xml', lambda *args, **kwargs: (XmlListing(BytesIO(xml)), folder[:-1]))
+            assert crawler.crawl_folder(SimpleNamespace(force=False), folder, PageCache(), set()) == ([folder+'sub0/'], True)
+            assert read == []
+
+            # A changed listing is read from the buffer
+            record_location_validators(folder, 'other', None, None, [folder+'sub0/'])
+            job = SimpleNamespace(force=False, num_docs=0)
+            assert crawler.crawl_folder(job, folder, PageCache(), set()) == ([folder+'sub1/'], True)
+            assert len(read) == 1
+            assert get_location_validators(folder)[0] == sha1(xml).hexdigest()
+        finally:
+            Locations.query.filter_by(name=folder).delete()
+            db.session.commit()
+
+
+def test_folder_unsubscribe_queues_delete_job(client, monkeypatch):
+    from app.indexer import controllers
+    base = join(OMD_PATH, 'testuser1', 'testdevice')+'/'
+    folders = [base, base+'a/', base+'a/b/', base+'c/', base+'c/d/']
+    submitted = []
+    def fake_submit(username, prefixes):
+        submitted.append(prefixes)
+        return 42
+    monkeypatch.setattr(controllers, 'submit_delete_job', fake_submit)
+    with app.app_context():
+        for name in folders:
+            db.session.add(Locations(name=name, subscribed=True))
+        db.session.commit()
+        try:
+            with client.session_transaction() as s:
+                s['username'] = 'testuser1'
+            # Only keep c/d/: c/ still has a subscribed subfolder
+            page = client.post("/indexer/update_folder_subscriptions/", data={'folders': [base+'c/d/'], 'async': 1},
+                    headers={"Token": AUTH_TOKEN})
+            assert page.status_code == 202
+            assert page.json['job'] == 42
+            assert submitted == [[base+'a/']]
+        finally:
+            Locations.query.filter(Locations.name.in_(folders)).delete()
+            db.session.commit()
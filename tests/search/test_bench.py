@@ -0,0 +1,17 @@
+from app import LANGS
+from app.api.models import Pods
+from app.cli.bench import bench_search
+
+from tests import client
+
+
+def test_bench_search(client):
+    with client.application.app_context():
+        num_pods = Pods.query.count()
+        report = bench_search(LANGS[0], mix=['user', 'shared'], num_docs=3, doc_length=50, num_queries=5)
+        assert report['indexing']['docs'] == 6
+        assert set(report['latency_ms']) == {'p50', 'p95', 'p99', 'mean'}
+        assert 'score_pods' in report['stages_ms']
+        assert report['pod_bytes_read']['score_pods'] > 0
+        # Synthetic pods are removed after the run
+        assert Pods.query.count() == num_pods
@@ -0,0 +1,38 @@
+from os.path import join
+from app import OMD_PATH, LANGS
+from app.utils_db import create_pod, delete_pod
+from app.indexer.crawler import run_indexing
+from app.cli.evaluation import reciprocal_rank, ndcg, recall, evaluate, compare_reports
+
+from tests import client
+
+
+def test_ranking_metrics():
+    ranking = ['a', 'b', 'c', 'd']
+    assert reciprocal_rank(ranking, {'b', 'd'}) == 0.5
+    assert ndcg(ranking, {'a'}) == 1.0
+    assert 0 < ndcg(ranking, {'c'}) < 1
+    assert recall(ranking, {'a', 'e'}) == 0.5
+
+
+def test_evaluate_golden_queries(client):
+    docs = {'orchard': 'pears grow in the orchard near the river',
+            'library': 'the library lends books about history and music'}
+    lang = LANGS[0]
+    with client.application.app_context():
+        pod_paths = set()
+        try:
+            for name, text in docs.items():
+                url = join(OMD_PATH, 'shared', 'pearsbench', 'eval', name+'.txt')
+                pod_path = create_pod(url, 'pearsbench', lang, 'eval')
+                pod_paths.add(pod_path)
+                run_indexing(url, pod_path, name, text, '', lang, text)
+            golden = [{'query': 'orchard pears', 'relevant': [join(OMD_PATH, 'shared', 'pearsbench', 'eval', 'orchard.txt')]}]
+            report = evaluate(golden)
+        finally:
+            for pod_path in pod_paths:
+                delete_pod(pod_path)
+    assert report['queries'] == 1
+    assert report['metrics']['mrr'] == 1.0
+    regressions, changed = compare_reports(report, report)
+    assert regressions == {} and changed == []
@@ -34,3 +34,135 @@ def test_user_search(client):
     html = response.data.decode()
     assert "Search results" in html
     assert response.status_code == 200
+
+def test_search_metrics(client):
+    client.post("/anonymous", data={"query": "pears"})
+    response = client.get("/metrics")
+    text = response.data.decode()
+    assert response.status_code == 200
+    assert 'pears_search_stage_seconds_count{stage="tokenize"}' in text
+    assert 'pears_search_stage_seconds_count{stage="score_pods"}' in text
+
+def test_search_trace(client):
+    with client.session_transaction() as session:
+        session['admin'] = True
+    response = client.post("/anonymous?trace=1", data={"query": "pears"})
+    trace = response.get_json()
+    assert trace['name'] == 'anonymous search'
+    stages = [s['name'] for s in trace['children'][0]['children']]
+    assert stages[:3] == ['get_language', 'compute_query_vectors', 'score_pods']
+
+def test_search_trace_not_admin(client, monkeypatch):
+    from app.search import controllers as search_controllers
+    monkeypatch.setattr(search_controllers, 'LOCAL_MODE', False)
+    response = client.post("/anonymous?trace=1", data={"query": "pears"})
+    assert response.mimetype != 'application/json'
+
+def test_logging_module_levels(monkeypatch):
+    import logging
+    from app import configure_logging
+    monkeypatch.setenv('LOG_LEVELS', 'app.search.score_pages=DEBUG')
+    configure_logging()
+    assert logging.getLogger('app.search.score_pages').isEnabledFor(logging.DEBUG)
+    logging.getLogger('app.search.score_pages').setLevel(logging.NOTSET)
+
+def test_async_logging_after_fork(monkeypatch, tmp_path):
+    import os
+    import logging
+    from time import sleep
+    from app import configure_logging
+    root = logging.getLogger()
+    handlers = root.handlers
+    log_file = tmp_path / 'pears.log'
+    root.handlers = [logging.FileHandler(log_file)]
+    monkeypatch.setenv('LOG_ASYNC', 'true')
+    try:
+        configure_logging()
+        pid = os.fork()
+        if pid == 0:
+            # The child writes its records without the parent's thread
+            logging.getLogger('app').warning("Logged after fork")
+            for _ in range(50):
+                if "Logged after fork" in log_file.read_text():
+                    os._exit(0)
+                sleep(0.1)
+            os._exit(1)
+        _, status = os.waitpid(pid, 0)
+        assert os.waitstatus_to_exitcode(status) == 0
+    finally:
+        root.handlers = handlers
+
+def test_carbon_sampling(tmp_path, monkeypatch):
+    import json
+    from types import SimpleNamespace
+    from app.carbon import CarbonSampler
+
+    class FakeTracker:
+        def __init__(self):
+            self._tasks = {}
+        def start_task(self, name):
+            self._tasks[name] = None
+            self._active_task = name
+        def stop_task(self):
+            return SimpleNamespace(duration=0.5, energy_consumed=2.0, emissions=1.0)
+
+    sampler = CarbonSampler(str(tmp_path), sample_rate=3, report_interval=3600)
+    monkeypatch.setattr(sampler, 'make_tracker', FakeTracker)
+    for _ in range(6):
+        with sampler.task('search'):
+            pass
+    assert sampler.tracker._tasks == {}
+    sampler.flush()
+    report = [json.loads(l) for l in open(next(tmp_path.glob('carbon.*.jsonl')))]
+    assert report[0]['operation'] == 'search'
+    assert report[0]['calls'] == 6 and report[0]['sampled'] == 2
+    assert report[0]['estimated_energy_kwh'] == 12.0
+
+def test_search_memory_budget(client):
+    from app import LANGS
+    from app.cli.bench import BENCH_USER, bench_words, generate_pods, remove_pods
+    from app.indexer.mk_page_vector import compute_query_vectors
+    from app.memory import memory_account
+    from app.search.score_pages import score_pods
+    lang = LANGS[0]
+    with client.application.app_context():
+        try:
+            generate_pods(lang, mix=['user'], num_docs=3, doc_length=50)
+            query = bench_words(lang)[0]
+            q_vector, _ = compute_query_vectors(query, lang)
+            with memory_account('search') as account:
+                assert len(score_pods(query, q_vector, lang, BENCH_USER)) > 0
+            assert account.peak > 0 and account.held == 0
+            # Over budget, pods are left out instead of loaded
+            with memory_account('search', budget=1) as account:
+                assert score_pods(query, q_vector, lang, BENCH_USER) == []
+            assert account.skipped > 0
+        finally:
+            remove_pods()
+
+def test_search_memory_budget_across_pods(client):
+    from os.path import join
+    from app import LANGS, POD_DIR
+    from app.api.models import Pods
+    from app.cli.bench import BENCH_USER, bench_words, generate_pods, remove_pods
+    from app.indexer.mk_page_vector import compute_query_vectors
+    from app.indexer.posix import get_posix_bytes
+    from app.memory import memory_account, npz_decoded_bytes
+    from app.search.score_pages import score_pods
+    lang = LANGS[0]
+    with client.application.app_context():
+        try:
+            user_pod, shared_pod = generate_pods(lang, mix=['user', 'shared'], num_docs=3, doc_length=50)
+            pod = Pods.query.filter_by(url=user_pod).first()
+            # Postings take several times their size on disk once unpickled
+            assert pod.num_postings_bytes > pod.num_bytes
+            query = bench_words(lang)[0]
+            q_vector, _ = compute_query_vectors(query, lang)
+            user_bytes = npz_decoded_bytes(join(POD_DIR, user_pod+'.npz')) + get_posix_bytes(user_pod)
+            # The budget is shared by all pods of the search: the
+            # user's own pod fits, the shared one is left out
+            with memory_account('search', budget=user_bytes + 1) as account:
+                assert score_pods(query, q_vector, lang, BENCH_USER) == [user_pod]
+            assert account.skipped == 1 and list(account.admitted) == [user_pod]
+        finally:
+            remove_pods()
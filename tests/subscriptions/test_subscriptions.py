@@ -1,6 +1,7 @@
 import os
-from app import db, AUTH_TOKEN
+from app import app, db, AUTH_TOKEN
 from app.api.models import Sites
+from app.utils_db import update_sites_in_db
 from flask import session as flask_session
 
 from tests import client, utils
@@ -336,3 +337,47 @@ def test_update_subscriptions_unsubscribe_equal_title(client, utils):
         # check that we were redirected to the index page
         assert page.status_code == 200
         assert "<b>Subscriptions: your websites</b>" in html
+
+
+# check that syncing the site catalog inserts, updates and deletes sites, and keeps subscriptions
+def test_update_sites_in_db(client):
+    test_site = {'url': 'http://localhost:9/sites/testsite/', 'name': 'testsite', 'title': 'Test site', 'owner': 'testuser', 'description': ''}
+    with app.app_context():
+        known_sites = [{'url': s.url, 'name': s.name, 'title': s.title, 'owner': s.owner, 'description': s.description} for s in Sites.query.all()]
+        subscribed = sorted(s.url for s in Sites.query.filter_by(subscribed=True).all())
+
+        update_sites_in_db(known_sites + [test_site])
+        s = Sites.query.filter_by(url=test_site['url']).first()
+        assert (s.name, s.title, s.subscribed) == ('testsite', 'Test site', False)
+
+        update_sites_in_db(known_sites + [dict(test_site, title='New title')])
+        assert db.session.get(Sites, s.id, populate_existing=True).title == 'New title'
+
+        update_sites_in_db(known_sites)
+        assert Sites.query.filter_by(url=test_site['url']).first() is None
+        assert sorted(s.url for s in Sites.query.filter_by(subscribed=True).all()) == subscribed
+
+
+# check that an unchanged site listing is not synced to the database again
+def test_pull_sites_unchanged_listing(client, monkeypatch):
+    import app.subscriptions.controllers as subscription_controllers
+
+    class FakeResponse:
+        status_code = 200
+        content = b'{"list": []}'
+        def json(self):
+            return {'list': []}
+
+    synced = []
+    monkeypatch.setattr(subscription_controllers.gateway, 'post', lambda *args, **kwargs: FakeResponse())
+    monkeypatch.setattr(subscription_controllers, 'update_sites_in_db', lambda sites: synced.append(sites))
+    monkeypatch.setattr(subscription_controllers, 'site_catalog', {'digest': None, 'users': {}, 'refreshing': set()})
+    with app.app_context():
+        assert subscription_controllers.pull_sites_from_gateway('token', 'user1') == (True, "Sites pulled from gateway.")
+        assert subscription_controllers.pull_sites_from_gateway('token', 'user1') == (True, "Sites unchanged on gateway.")
+        # The listing is kept per user: another user's view syncs it again if it differs
+        FakeResponse.content = b'{"list": [] }'
+        assert subscription_controllers.pull_sites_from_gateway('token2', 'user2') == (True, "Sites pulled from gateway.")
+    assert synced == [[], []]
+    users = subscription_controllers.site_catalog['users']
+    assert users['user1']['digest'] != subscription_controllers.site_catalog['digest'] == users['user2']['digest']
@@ -0,0 +1,11 @@
+# SPDX-FileCopyrightText: 2025 PeARS Project, <pears@possible-worlds.eu>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+# Production entry point, e.g.:
+#   gunicorn -c gunicorn.conf.py wsgi:app
+# With preload_app, this is imported once by the server process,
+# and the workers it forks share the language models copy-on-write.
+from app import app, models
+
+models.preload()